@@ -4,26 +4,57 @@ from transformers import (
     BartTokenizer,
 )
 import torch
-import wandb
 from tqdm import tqdm
-from evaluation_metrics import compute_bleu_scores
+from loggers import create_logger
+from metrics_sink import MetricsSink
+from model_utils import (
+    apply_vision_encoder_policy,
+    vision_encoder_context,
+    trainable_parameters,
+    enable_vision_gradient_checkpointing,
+    accumulation_size,
+    Precision,
+)
 
 
 class BaselineModel:
 
     def __init__(self,
                  model_ckpt=None,
-                 beam_size=5):
+                 beam_size=5,
+                 vision_encoder_policy='frozen',
+                 num_trainable_vision_layers=0,
+                 precision='fp32',
+                 gradient_accumulation_steps=1,
+                 gradient_checkpointing=False,
+                 mode='train',
+                 logger='wandb',
+                 metrics_file='metrics.jsonl',
+                 watch_gradients=False,
+                 cache_dir=None,
+                 local_files_only=False):
         '''
         Baseline Model - Vit Image Extractor and Encoder and BART Decoder
         The Model contains a VIT (Image) Encoder and BART (Text) Decoder
         The image features are passed to model to get image embeddings which
         are sent to text decoder.
         The weights of image encoder are frozen and not updated during training
+        unless vision_encoder_policy is 'last_n' or 'trainable' (see model_utils)
 
         This model cannot be used for VQA because it doesnt have text encoder.
+
+        :param mode: 'train' or 'predict', a predict model has no optimizer or gradient hooks
+        :param logger: 'wandb', 'jsonl' or 'none', or a list of them (see loggers.py), logged by a MetricsSink
+        :param metrics_file: file of the jsonl logger
+        :param watch_gradients: log gradient histograms with wandb.watch
+        :param cache_dir: Hugging Face cache dir of the pretrained ViT, BART and their tokenizers
+        :param local_files_only: load the pretrained files from the cache without requests to the hub
         '''
 
+        if mode not in ['train', 'predict']:
+            raise ValueError(f'Unknown mode {mode}, expected train or predict')
+        self.mode = mode
+
 
         if torch.cuda.is_available():
             self.device = 'cuda:0'
@@ -33,35 +64,52 @@ class BaselineModel:
         image_encoder = "google/vit-base-patch16-224-in21k"
         text_decoder = "facebook/bart-base"
 
+        hub_kwargs = {'cache_dir': cache_dir, 'local_files_only': local_files_only}
+
         # Image and Text Tokenizers
-        self.tokenizer = BartTokenizer.from_pretrained(text_decoder)
-        self.image_feature_extractor = ViTFeatureExtractor.from_pretrained(image_encoder)
+        self.tokenizer = BartTokenizer.from_pretrained(text_decoder, **hub_kwargs)
+        self.image_feature_extractor = ViTFeatureExtractor.from_pretrained(image_encoder, **hub_kwargs)
 
         # Model Initialization
         if model_ckpt is None:
             self.model = VisionEncoderDecoderModel.from_encoder_decoder_pretrained(
                 image_encoder,
-                text_decoder)
+                text_decoder,
+                **{f'{prefix}_{key}': value for prefix in ['encoder', 'decoder'] for key, value in hub_kwargs.items()})
             self._set_bart_decoder()
         else:
-            self.model = VisionEncoderDecoderModel.from_pretrained(model_ckpt)
+            self.model = VisionEncoderDecoderModel.from_pretrained(model_ckpt, **hub_kwargs)
+        self.vision_encoder_policy = vision_encoder_policy
+        apply_vision_encoder_policy(self.model.encoder, vision_encoder_policy, num_trainable_vision_layers)
         self.model.to(self.device)
+        if gradient_checkpointing:
+            self.model.decoder.gradient_checkpointing_enable()
+            if vision_encoder_policy != 'frozen':
+                enable_vision_gradient_checkpointing(self.model.encoder)
 
         # Hyperparameters
-        self.optimizer = torch.optim.AdamW(self.model.parameters(),
-                                           lr=0.0001,
-                                           eps=1e-8,
-                                           weight_decay=0.01
-                                           )
-        self.lr_scheduler = torch.optim.lr_scheduler.ExponentialLR(
-            self.optimizer,
-            gamma=0.9)
+        if mode == 'train':
+            self.optimizer = torch.optim.AdamW(trainable_parameters(self.model),
+                                               lr=0.0001,
+                                               eps=1e-8,
+                                               weight_decay=0.01
+                                               )
+            self.lr_scheduler = torch.optim.lr_scheduler.ExponentialLR(
+                self.optimizer,
+                gamma=0.9)
+        else:
+            self.model.eval()
+            self.optimizer = self.lr_scheduler = None
         self.beam_size = beam_size
+        self.precision = Precision(precision, self.device)
+        self.gradient_accumulation_steps = gradient_accumulation_steps
 
-        # Wandb
+        # Logging
         self.log_freq = 10
-        wandb.init(project='multi-modal-image-caption')
-        wandb.watch(self.model, self.log_freq)
+        self.logger = create_logger(logger, project='multi-modal-image-caption', metrics_file=metrics_file)
+        self.metrics = MetricsSink(self.logger)
+        if mode == 'train' and watch_gradients:
+            self.logger.watch(self.model, self.log_freq)
 
     def _set_bart_decoder(self):
 
@@ -71,34 +119,85 @@ class BaselineModel:
         model_config.eos_token_id = self.tokenizer.eos_token_id
         model_config.vocab_size = model_config.decoder.vocab_size
 
+    def forward_batch(self, image_pixel_values, label_input_ids):
+
+        '''
+        Run the image encoder separately so a frozen encoder runs without autograd
+        '''
+
+        with vision_encoder_context(self.vision_encoder_policy):
+            encoder_outputs = self.model.encoder(pixel_values=image_pixel_values, return_dict=True)
+        return self.model(
+            encoder_outputs=encoder_outputs,
+            labels=label_input_ids,
+            return_dict=True,
+        )
+
+    def training_state(self):
+
+        '''
+        Weights, optimizer, lr scheduler and gradient scaler states to resume training (see trainer.py)
+        '''
+
+        return {'model': self.model.state_dict(),
+                'optimizer': self.optimizer.state_dict(),
+                'lr_scheduler': self.lr_scheduler.state_dict(),
+                'scaler': self.precision.scaler.state_dict()}
+
+    def load_training_state(self, state):
+
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.lr_scheduler.load_state_dict(state['lr_scheduler'])
+        self.precision.scaler.load_state_dict(state['scaler'])
+
     def train(self,
               epoch,
-              train_dataloader):
+              train_dataloader,
+              path=None,
+              start_batch=0,
+              step_callback=None):
 
         self.model.train()
-        total_loss = 0.0
+        # Frozen ViT stays in eval mode
+        self.model.encoder.train(self.vision_encoder_policy != 'frozen')
+        # Losses stay on the device, they are only read at the end of the epoch and by the metrics sink
+        total_loss = torch.zeros((), device=self.device)
+        optimizer_steps = start_batch // self.gradient_accumulation_steps
+        num_batches = start_batch + len(train_dataloader)
+        self.optimizer.zero_grad(set_to_none=True)
         progress_bar = tqdm(train_dataloader)
-        for batch_idx, batch_data in enumerate(progress_bar):
+        for batch_idx, batch_data in enumerate(progress_bar, start=start_batch):
             progress_bar.set_description(f'Train Epoch {epoch}')
             image_pixel_values = batch_data[0].to(self.device)
             label_encodings = batch_data[1]
             label_input_ids = label_encodings.input_ids.to(self.device)
-            outputs = self.model(
-                pixel_values=image_pixel_values,
-                labels=label_input_ids,
-                return_dict=True,
-            )
+            with self.precision.autocast():
+                outputs = self.forward_batch(image_pixel_values, label_input_ids)
             loss = outputs.loss
-            progress_bar.set_postfix(loss=loss.item())
-            total_loss += loss.item()
-            self.model.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+            total_loss += loss.detach()
+            self.metrics.add('train/loss', loss)
+
+            # Gradients of the micro-batches are summed, scale the loss to get their mean
+            window_size = accumulation_size(batch_idx, num_batches, self.gradient_accumulation_steps)
+            self.precision.backward(loss / window_size)
+            if (batch_idx + 1) % self.gradient_accumulation_steps != 0 and batch_idx + 1 != num_batches:
+                continue
 
-            if batch_idx % self.log_freq == 0:
-                wandb.log({"train/loss": loss.item()})
+            self.precision.step(self.optimizer)
+            self.optimizer.zero_grad(set_to_none=True)
+            optimizer_steps += 1
+            # Mean loss of the last log_freq optimizer steps, the progress bar shows the previous one
+            if optimizer_steps % self.log_freq == 0:
+                self.metrics.flush()
+                progress_bar.set_postfix(loss=self.metrics.last('train/loss'))
+            if step_callback is not None:
+                step_callback(batch_idx + 1)
 
-        return total_loss / (batch_idx + 1)
+        self.metrics.flush()
+        # An epoch resumed after its last batch has no batches left to train
+        num_trained = num_batches - start_batch
+        return total_loss.item() / num_trained if num_trained else 0.0
 
     def test(self,
              epoch,
@@ -108,45 +207,47 @@ class BaselineModel:
         self.model.eval()
         loss_name = 'val/loss' if validation else 'test/loss'
         step = 'Val' if validation else 'Test'
-        total_loss = 0.0
+        total_loss = torch.zeros((), device=self.device)
         progress_bar = tqdm(dataloader)
         for batch_idx, batch_data in enumerate(progress_bar):
             progress_bar.set_description(f'{step} Epoch {epoch}')
             image_pixel_values = batch_data[0].to(self.device)
             label_encodings = batch_data[1]
             label_input_ids = label_encodings.input_ids.to(self.device)
-            outputs = self.model(
-                pixel_values=image_pixel_values,
-                labels=label_input_ids,
-                return_dict=True,
-            )
-            loss = outputs.loss.item()
-            progress_bar.set_postfix(loss=loss)
-            total_loss += loss
-            if batch_idx % self.log_freq == 0:
-                wandb.log({loss_name: loss})
-
-        return total_loss / (batch_idx + 1)
+            with self.precision.autocast():
+                outputs = self.forward_batch(image_pixel_values, label_input_ids)
+            total_loss += outputs.loss.detach()
+            self.metrics.add(loss_name, outputs.loss)
+            if (batch_idx + 1) % self.log_freq == 0:
+                self.metrics.flush()
+                progress_bar.set_postfix(loss=self.metrics.last(loss_name))
+
+        self.metrics.flush()
+        return total_loss.item() / (batch_idx + 1)
 
     def predict(self,
                 dataloader,
                 filename):
 
+        # nltk is only imported when predicting
+        from evaluation_metrics import compute_bleu_scores
+
         self.model.eval()
         progress_bar = tqdm(dataloader)
         progress_bar.set_description('Inference')
         bleu_scores = []
         columns = ['Image', 'Generated Caption', 'Reference Captions', 'Bleu Score']
-        wandb_table = wandb.Table(columns=columns)
+        wandb_table = self.logger.table(columns=columns)
 
         for batch_idx, batch_data in enumerate(progress_bar):
             image_pixel_values = batch_data[0].to(self.device)
             reference_captions = batch_data[1]
             image_file_name = batch_data[2]
 
-            generated_ids = self.model.generate(image_pixel_values,
-                                                num_beams=self.beam_size,
-                                                max_length=24)
+            with self.precision.autocast():
+                generated_ids = self.model.generate(image_pixel_values,
+                                                    num_beams=self.beam_size,
+                                                    max_length=24)
             generated_captions = self.tokenizer.batch_decode(generated_ids,
                                                              skip_special_tokens=True,
                                                              clean_up_tokenization_spaces=False)
@@ -163,19 +264,21 @@ class BaselineModel:
 
             if batch_idx % 10 == 0:
                 wandb_table.add_data(
-                    wandb.Image(f'datasets/flickr30k_images/{image_file_name[0]}'),
+                    self.logger.image(f'datasets/flickr30k_images/{image_file_name[0]}'),
                     generated_captions[0],
                     reference_captions[0],
                     bleu_score_list[0]
                 )
 
-        wandb.log({'Bleu Score': sum(bleu_scores) / len(bleu_scores),
-                   f'{filename} Prediction Samples': wandb_table,
-                   f'{filename} Scores Plot': wandb.plot.histogram(
-                       wandb.Table(data=[[s] for s in bleu_scores],
-                                   columns=['bleu score'])
-                   )
-                   })
+        self.metrics.log({'Bleu Score': sum(bleu_scores) / len(bleu_scores),
+                          f'{filename} Prediction Samples': wandb_table,
+                          f'{filename} Scores Plot': self.logger.histogram(
+                              self.logger.table(data=[[s] for s in bleu_scores],
+                                                columns=['bleu score']),
+                              'bleu score'
+                          )
+                          })
+        self.metrics.wait()
 
 
     def save_pretrained(self, path):
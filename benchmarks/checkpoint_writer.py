@@ -0,0 +1,84 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import torch
+from transformers import ViTModel
+
+from benchmarks.common import write_results, print_table, tiny_configs
+from checkpoint_writer import CheckpointWriter
+from model_utils import apply_vision_encoder_policy
+from modelling_bartMultiModal import BartMultiModalGenerationModel
+
+
+def dir_size_mb(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files) / 2 ** 20
+
+
+def run(args, mode, model, image_model, output_dir):
+
+    '''
+    Time the training loop is blocked by each save, and the time until the checkpoints are on disk
+    '''
+
+    if mode == 'save_pretrained':
+        writer = None
+    else:
+        writer = CheckpointWriter(dtype=torch.float16 if mode.endswith('fp16') else None,
+                                  trainable_only=mode.startswith('trainable_only'),
+                                  max_pending=args.max_pending)
+
+    blocked = []
+    start = time.perf_counter()
+    for i in range(args.num_saves):
+        path = os.path.join(output_dir, mode, f'epoch_{i}')
+        begin = time.perf_counter()
+        if writer is None:
+            model.save_pretrained(path)
+            image_model.save_pretrained(os.path.join(path, 'vision_encoder'))
+        else:
+            writer.save(path, {'': model, 'vision_encoder': image_model})
+        blocked.append(time.perf_counter() - begin)
+        # Training between the saves
+        time.sleep(args.seconds_between_saves)
+    if writer is not None:
+        writer.flush()
+    total = time.perf_counter() - start - args.num_saves * args.seconds_between_saves
+
+    return {'mode': mode,
+            'blocked_ms_per_save': round(1000 * sum(blocked) / len(blocked), 1),
+            'max_blocked_ms': round(1000 * max(blocked), 1),
+            'written_ms_per_save': round(1000 * total / args.num_saves, 1),
+            'checkpoint_mb': round(dir_size_mb(os.path.join(output_dir, mode, 'epoch_0')), 1)}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hidden_size', type=int, default=768)
+    parser.add_argument('--num_layers', type=int, default=6)
+    parser.add_argument('--num_trainable_vision_layers', type=int, default=1)
+    parser.add_argument('--num_saves', type=int, default=5)
+    parser.add_argument('--seconds_between_saves', type=float, default=1.0)
+    parser.add_argument('--max_pending', type=int, default=1)
+    parser.add_argument('--output_file', type=str, default='benchmark_results/checkpoint_writer.json')
+
+    args = parser.parse_args()
+
+    # bart-base and a last_n ViT of the same size with random weights
+    vit_config, bart_config = tiny_configs(hidden_size=args.hidden_size, num_layers=args.num_layers)
+    model = BartMultiModalGenerationModel(bart_config)
+    image_model = ViTModel(vit_config)
+    apply_vision_encoder_policy(image_model, 'last_n', args.num_trainable_vision_layers)
+
+    output_dir = tempfile.mkdtemp()
+    try:
+        rows = [run(args, mode, model, image_model, output_dir)
+                for mode in ['save_pretrained', 'async', 'async_fp16', 'trainable_only_fp16']]
+    finally:
+        shutil.rmtree(output_dir)
+    print_table(rows, list(rows[0]))
+    write_results({'benchmark': 'checkpoint_writer', 'args': vars(args), 'results': rows}, args.output_file)
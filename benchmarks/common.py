@@ -0,0 +1,94 @@
+import json
+import os
+import time
+
+import psutil
+import torch
+
+
+def write_results(results, output_file):
+
+    '''
+    Write benchmark results as json so that runs can be compared
+    '''
+
+    if os.path.dirname(output_file):
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    results = dict(results, timestamp=time.strftime('%Y-%m-%d %H:%M:%S'))
+    with open(output_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {output_file}')
+
+
+def unique_memory_mb(process):
+
+    '''
+    Memory private to the process (USS). Pages shared with the parent after fork are not counted,
+    so copy-on-write copies show up as USS growth.
+    '''
+
+    return process.memory_full_info().uss / 2 ** 20
+
+
+class FilenameImages:
+
+    '''
+    Stand-in for an ImageEmbeddingStore that returns the image filename, for benchmarks of the text
+    pipeline that should not read images
+    '''
+
+    def __getitem__(self, image_filename):
+        return image_filename
+
+
+def print_table(rows, columns):
+
+    widths = [max(len(str(column)), *(len(str(row[column])) for row in rows)) for column in columns]
+    print('  '.join(str(column).ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(row[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+def tiny_configs(image_size=224, patch_size=16, hidden_size=64, num_layers=2, vocab_size=50265):
+
+    '''
+    Small ViT and BART configs with the architecture of the real models, for benchmarks that
+    should run without downloading the pretrained weights
+    '''
+
+    from transformers import BartConfig, ViTConfig
+
+    vit_config = ViTConfig(image_size=image_size,
+                           patch_size=patch_size,
+                           hidden_size=hidden_size,
+                           num_hidden_layers=num_layers,
+                           num_attention_heads=4,
+                           intermediate_size=4 * hidden_size)
+    bart_config = BartConfig(vocab_size=vocab_size,
+                             d_model=hidden_size,
+                             encoder_layers=num_layers,
+                             decoder_layers=num_layers,
+                             encoder_attention_heads=4,
+                             decoder_attention_heads=4,
+                             encoder_ffn_dim=4 * hidden_size,
+                             decoder_ffn_dim=4 * hidden_size,
+                             max_position_embeddings=128)
+    return vit_config, bart_config
+
+
+def saved_activation_mb(step):
+
+    '''
+    Bytes of the tensors autograd saves for backward during step, i.e. the activation memory of a training step
+    '''
+
+    saved_bytes = 0
+
+    def pack(tensor):
+        nonlocal saved_bytes
+        saved_bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = step()
+    return loss, saved_bytes / 2 ** 20
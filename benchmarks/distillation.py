@@ -0,0 +1,94 @@
+import argparse
+import os
+import time
+
+import torch
+
+from benchmarks.common import write_results, print_table
+from benchmarks.quantization import data_module_for
+
+
+def load_models(args, model_ckpt, device):
+
+    from transformers import BartConfig, ViTModel
+    from modelling_bartMultiModal import BartMultiModalGenerationModel
+
+    vision_path = os.path.join(model_ckpt, 'vision_encoder')
+    image_model = ViTModel.from_pretrained(vision_path if os.path.isdir(vision_path) else args.image_encoder)
+    model = BartMultiModalGenerationModel.from_pretrained(model_ckpt, config=BartConfig.from_pretrained(model_ckpt))
+    return model.to(device).eval(), image_model.to(device).eval()
+
+
+def run(args, model_ckpt, data_module, device):
+
+    '''
+    Caption the held out split with one checkpoint, the latency covers the ViT and generate
+    '''
+
+    from evaluation_metrics import compute_bleu_scores, compute_meteor_score
+
+    model, image_model = load_models(args, model_ckpt, device)
+    seconds, num_images = 0.0, 0
+    bleu_scores, meteor_scores = [], []
+    with torch.no_grad():
+        for batch_idx, batch_data in enumerate(data_module.predict_dataloader()):
+            if batch_idx == args.num_batches:
+                break
+            input_encodings = batch_data[1].to(device)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            image_embeddings = image_model(batch_data[0].to(device)).last_hidden_state
+            generated_ids = model.generate(input_ids=input_encodings.input_ids,
+                                           attention_mask=input_encodings.attention_mask,
+                                           image_embeddings=image_embeddings,
+                                           num_beams=args.num_beams,
+                                           max_length=24)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            seconds += time.perf_counter() - start
+            num_images += len(batch_data[3])
+            generated_text = data_module.tokenizer.batch_decode(generated_ids,
+                                                                skip_special_tokens=True,
+                                                                clean_up_tokenization_spaces=False)
+            bleu_scores += compute_bleu_scores(generated_text, batch_data[2])[1]
+            meteor_scores += compute_meteor_score(generated_text, batch_data[2])[1]
+
+    return {'checkpoint': model_ckpt,
+            'decoder_layers': model.config.decoder_layers,
+            'd_model': model.config.d_model,
+            'parameters_m': round(sum(p.numel() for p in model.parameters()) / 1e6, 1),
+            'ms_per_image': round(1000 * seconds / num_images, 1),
+            'bleu': round(sum(bleu_scores) / len(bleu_scores), 2),
+            'meteor': round(sum(meteor_scores) / len(meteor_scores), 2)}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--teacher_ckpt', type=str, required=True)
+    parser.add_argument('--student_ckpts', type=str, nargs='+', required=True)
+    parser.add_argument('--image_encoder', type=str, default='google/vit-base-patch16-224-in21k')
+    parser.add_argument('--tokenizer', type=str, default='facebook/bart-base')
+    parser.add_argument('--pixel_cache_dir', type=str, default=None)
+    parser.add_argument('--split', type=str, default='test', choices=['train', 'valid', 'test'])
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_batches', type=int, default=50)
+    parser.add_argument('--num_beams', type=int, default=5)
+    parser.add_argument('--output_file', type=str, default='benchmark_results/distillation.json')
+
+    args = parser.parse_args()
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    data_module = data_module_for(args)
+    rows = [run(args, model_ckpt, data_module, device) for model_ckpt in [args.teacher_ckpt] + args.student_ckpts]
+
+    # Relative to the teacher
+    teacher = rows[0]
+    for row in rows:
+        row['speedup'] = round(teacher['ms_per_image'] / row['ms_per_image'], 2)
+        row['bleu_delta'] = round(row['bleu'] - teacher['bleu'], 2)
+
+    print_table(rows, list(rows[0]))
+    write_results({'benchmark': 'distillation', 'device': str(device), 'args': vars(args), 'results': rows},
+                  args.output_file)
@@ -0,0 +1,188 @@
+import argparse
+import platform
+import tempfile
+import time
+
+import torch
+from transformers import ViTModel
+
+import evaluation_metrics
+from benchmarks.common import write_results, print_table, tiny_configs
+from benchmarks.synthetic import (
+    synthetic_captions,
+    synthetic_images,
+    synthetic_flickr_dataset,
+    offline_tokenizer,
+    offline_feature_extractor,
+    SyntheticFlickrDatasetModule,
+)
+from masking_stratergies import gaussian_mask, epoch_aware_mask, text_infilling
+from modelling_bartMultiModal import BartMultiModalGenerationModel
+
+
+def measure(name, variant, function, num_samples, args):
+
+    '''
+    Mean and min latency of function over args.repeats calls after args.warmup calls
+    '''
+
+    for _ in range(args.warmup):
+        function()
+    seconds = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    mean = sum(seconds) / len(seconds)
+    return {'benchmark': name,
+            'variant': variant,
+            'samples': num_samples,
+            'mean_ms': round(1000 * mean, 3),
+            'min_ms': round(1000 * min(seconds), 3),
+            'samples_per_second': round(num_samples / mean, 1)}
+
+
+def masking_benchmarks(args, tokenizer):
+
+    encodings = tokenizer(synthetic_captions(args.batch_size), padding='longest', return_tensors='pt')
+    special_token_ids = [tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.pad_token_id]
+    generator = torch.Generator().manual_seed(0)
+    strategies = {
+        'gaussian_mask': lambda: gaussian_mask(encodings.input_ids, encodings.attention_mask,
+                                               tokenizer.mask_token_id, special_token_ids, generator=generator),
+        'epoch_aware_mask': lambda: epoch_aware_mask(5, encodings.input_ids, encodings.attention_mask,
+                                                     tokenizer.mask_token_id, special_token_ids, generator=generator),
+        'text_infilling': lambda: text_infilling(encodings.input_ids, encodings.attention_mask,
+                                                 tokenizer.mask_token_id, special_token_ids,
+                                                 tokenizer.pad_token_id, generator=generator),
+    }
+    return [measure('masking_stratergies', name, function, args.batch_size, args)
+            for name, function in strategies.items()]
+
+
+def collate_benchmarks(args, tokenizer, feature_extractor):
+
+    dataset = synthetic_flickr_dataset(args.batch_size)
+    images = synthetic_images(args.batch_size, args.image_size)
+    train_batch = [(image, captions[0]) for image, captions in zip(images, dataset.values())]
+    predict_batch = [(image, captions, filename) for image, (filename, captions) in zip(images, dataset.items())]
+
+    rows = []
+    for mask in ['empty', 'epoch_aware_mask', 'text_infilling']:
+        data_module = SyntheticFlickrDatasetModule(dataset, num_workers=0, multi_modal=True, mask=mask)
+        data_module._set_tokenizer(tokenizer)
+        data_module._set_image_feature_extractor(feature_extractor)
+        rows.append(measure('tokenize_data', mask, lambda: data_module.tokenize_data(train_batch),
+                            args.batch_size, args))
+        rows.append(measure('prediction_tokenization', mask, lambda: data_module.prediction_tokenization(predict_batch),
+                            args.batch_size, args))
+    return rows
+
+
+def model_benchmarks(args, tokenizer, feature_extractor):
+
+    vit_config, bart_config = tiny_configs(image_size=args.image_size,
+                                           hidden_size=args.hidden_size,
+                                           num_layers=args.num_layers,
+                                           vocab_size=len(tokenizer))
+    torch.manual_seed(0)
+    model = BartMultiModalGenerationModel(bart_config)
+    model.tie_weights()
+    image_model = ViTModel(vit_config).eval()
+
+    pixel_values = feature_extractor(synthetic_images(args.batch_size, args.image_size), return_tensors='pt').pixel_values
+    with torch.no_grad():
+        image_embeddings = image_model(pixel_values).last_hidden_state
+    labels = tokenizer(synthetic_captions(args.batch_size), padding='longest', return_tensors='pt')
+    inputs = tokenizer(['<mask>'] * args.batch_size, return_tensors='pt')
+
+    def forward():
+        with torch.no_grad():
+            model.model(input_ids=labels.input_ids,
+                        attention_mask=labels.attention_mask,
+                        decoder_input_ids=labels.input_ids,
+                        image_embeddings=image_embeddings)
+
+    def forward_backward():
+        model.zero_grad(set_to_none=True)
+        model(input_ids=labels.input_ids,
+              attention_mask=labels.attention_mask,
+              image_embeddings=image_embeddings,
+              labels=labels.input_ids).loss.backward()
+
+    def generate(num_beams):
+        with torch.no_grad():
+            model.generate(input_ids=inputs.input_ids,
+                           attention_mask=inputs.attention_mask,
+                           image_embeddings=image_embeddings,
+                           num_beams=num_beams,
+                           max_length=args.max_length)
+
+    model.eval()
+    rows = [measure('BartMultiModalModel.forward', 'no_grad', forward, args.batch_size, args)]
+    for num_beams in args.num_beams:
+        rows.append(measure('generate', f'num_beams={num_beams}', lambda: generate(num_beams), args.batch_size, args))
+    model.train()
+    rows.append(measure('BartMultiModalGenerationModel.forward', 'loss_backward', forward_backward, args.batch_size, args))
+    return rows
+
+
+def metric_benchmarks(args):
+
+    references = [synthetic_captions(5, seed=i) for i in range(args.num_metric_samples)]
+    outputs = synthetic_captions(args.num_metric_samples, seed=-1)
+    rows = []
+    for name in ['compute_bleu_scores', 'compute_rouge_score', 'compute_meteor_score']:
+        function = getattr(evaluation_metrics, name)
+        try:
+            rows.append(measure('evaluation_metrics', name, lambda: function(outputs, references),
+                                args.num_metric_samples, args))
+        except (LookupError, OSError):
+            # nltk data (wordnet for METEOR, punkt for ROUGE-Lsum) is downloaded separately and needs the network
+            print(f'Skipping {name}, its nltk data is not installed')
+    return rows
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--image_size', type=int, default=224)
+    parser.add_argument('--hidden_size', type=int, default=64)
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--num_beams', type=int, nargs='+', default=[1, 3, 5])
+    parser.add_argument('--max_length', type=int, default=24)
+    parser.add_argument('--num_metric_samples', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--benchmarks', type=str, nargs='+', default=['masking', 'collate', 'model', 'metrics'],
+                        choices=['masking', 'collate', 'model', 'metrics'])
+    parser.add_argument('--output_file', type=str, default='benchmark_results/microbenchmarks.json')
+
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    # Everything is synthetic and randomly initialised, nothing is downloaded
+    with tempfile.TemporaryDirectory() as tokenizer_dir:
+        tokenizer = offline_tokenizer(tokenizer_dir)
+    feature_extractor = offline_feature_extractor(args.image_size)
+
+    rows = []
+    if 'masking' in args.benchmarks:
+        rows += masking_benchmarks(args, tokenizer)
+    if 'collate' in args.benchmarks:
+        rows += collate_benchmarks(args, tokenizer, feature_extractor)
+    if 'model' in args.benchmarks:
+        rows += model_benchmarks(args, tokenizer, feature_extractor)
+    if 'metrics' in args.benchmarks:
+        rows += metric_benchmarks(args)
+
+    print_table(rows, list(rows[0]))
+    write_results({'benchmark': 'microbenchmarks',
+                   'args': vars(args),
+                   'environment': {'torch': torch.__version__,
+                                   'num_threads': torch.get_num_threads(),
+                                   'processor': platform.processor()},
+                   'results': rows}, args.output_file)
@@ -0,0 +1,88 @@
+import argparse
+import tempfile
+import time
+
+import torch
+from transformers import ViTModel
+
+from benchmarks.common import write_results, print_table, tiny_configs
+from modelling_bartMultiModal import BartMultiModalGenerationModel
+from onnx_export import export_multi_modal_model
+from onnx_generation import OnnxMultiModalGenerator
+
+
+def load_models(args):
+
+    if args.model_ckpt is None:
+        vit_config, bart_config = tiny_configs(hidden_size=args.hidden_size, num_layers=args.num_layers)
+        torch.manual_seed(0)
+        return BartMultiModalGenerationModel(bart_config).eval(), ViTModel(vit_config).eval()
+    return (BartMultiModalGenerationModel.from_pretrained(args.model_ckpt).eval(),
+            ViTModel.from_pretrained(args.image_encoder).eval())
+
+
+def run(args):
+
+    '''
+    Caption the same random images and prompts with model.generate and with the ONNX Runtime driver,
+    compare the latency and the generated ids
+    '''
+
+    torch.set_num_threads(args.num_threads)
+    model, image_model = load_models(args)
+    export_dir = args.export_dir or tempfile.mkdtemp()
+    export_multi_modal_model(model, image_model, export_dir, image_size=image_model.config.image_size)
+    generator = OnnxMultiModalGenerator(export_dir, num_threads=args.num_threads)
+
+    random = torch.Generator().manual_seed(0)
+    image_size = image_model.config.image_size
+    torch_seconds, onnx_seconds, num_matches, num_captions = 0.0, 0.0, 0, 0
+    for _ in range(args.num_batches):
+        pixel_values = torch.randn(args.batch_size, 3, image_size, image_size, generator=random)
+        input_ids = torch.randint(4, model.config.vocab_size, (args.batch_size, args.prompt_length), generator=random)
+        input_ids[:, 0] = model.config.bos_token_id
+        input_ids[:, -1] = model.config.eos_token_id
+        generate_kwargs = {'num_beams': args.num_beams, 'max_length': args.max_length}
+
+        start = time.perf_counter()
+        with torch.no_grad():
+            image_embeddings = image_model(pixel_values).last_hidden_state
+            torch_ids = model.generate(input_ids=input_ids, image_embeddings=image_embeddings, **generate_kwargs)
+        torch_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        onnx_ids = generator.generate(input_ids.numpy(), pixel_values=pixel_values.numpy(), **generate_kwargs)
+        onnx_seconds += time.perf_counter() - start
+
+        torch_ids = torch_ids.numpy()
+        if torch_ids.shape == onnx_ids.shape:
+            num_matches += int((torch_ids == onnx_ids).all(axis=1).sum())
+        num_captions += args.batch_size
+
+    num_images = args.num_batches * args.batch_size
+    return [{'runtime': 'pytorch', 'ms_per_image': round(1000 * torch_seconds / num_images, 1), 'exact_match': 1.0},
+            {'runtime': 'onnxruntime', 'ms_per_image': round(1000 * onnx_seconds / num_images, 1),
+             'exact_match': round(num_matches / num_captions, 3)}]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_ckpt', type=str, default=None, help='random tiny models when not given')
+    parser.add_argument('--image_encoder', type=str, default='google/vit-base-patch16-224-in21k')
+    parser.add_argument('--export_dir', type=str, default=None, help='a temporary directory when not given')
+    parser.add_argument('--hidden_size', type=int, default=64)
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--num_batches', type=int, default=10)
+    parser.add_argument('--prompt_length', type=int, default=6)
+    parser.add_argument('--num_beams', type=int, default=5)
+    parser.add_argument('--max_length', type=int, default=24)
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--output_file', type=str, default='benchmark_results/onnx_generation.json')
+
+    args = parser.parse_args()
+
+    rows = run(args)
+    print_table(rows, list(rows[0]))
+    write_results({'benchmark': 'onnx_generation', 'args': vars(args), 'results': rows}, args.output_file)
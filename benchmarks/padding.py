@@ -0,0 +1,122 @@
+import argparse
+import time
+
+import torch
+from transformers import BartTokenizer
+
+from benchmarks.common import write_results, print_table, FilenameImages
+
+
+def padding_ratio(encodings):
+
+    '''
+    Fraction of pad positions in a padded batch
+    '''
+
+    attention_mask = encodings.attention_mask
+    return 1.0 - attention_mask.sum().item() / attention_mask.numel()
+
+
+def text_only(data_module, dataset):
+
+    # Images are not needed to measure padding
+    dataset.embedding_store = FilenameImages()
+    data_module._encode_images = lambda image_tensors: None
+
+
+def data_module_for(args, bucket_by_length):
+
+    tokenizer = BartTokenizer.from_pretrained(args.tokenizer)
+    if args.dataset == 'flickr':
+        from dataset import FlickrDatasetModule
+        data_module = FlickrDatasetModule(train_batch_size=args.batch_size,
+                                          num_workers=0,
+                                          multi_modal=True,
+                                          mask=args.mask,
+                                          token_cache_dir=args.token_cache_dir,
+                                          bucket_by_length=bucket_by_length)
+    else:
+        from vqa_dataset import VQADatasetModule
+        data_module = VQADatasetModule(train_batch_size=args.batch_size,
+                                       num_workers=0,
+                                       annotation_cache_dir=args.annotation_cache_dir,
+                                       token_cache_dir=args.token_cache_dir,
+                                       bucket_by_length=bucket_by_length)
+    data_module._set_tokenizer(tokenizer)
+    data_module.setup('fit')
+    text_only(data_module, data_module.train_dataset)
+    return data_module
+
+
+def measure(data_module, model, num_batches):
+
+    '''
+    Padding ratio of input and label batches and non pad tokens per second of the collate
+    and optionally of the text model forward and backward
+    '''
+
+    input_padding, label_padding, tokens = [], [], 0
+    collate_seconds, model_seconds = 0.0, 0.0
+    iterator = iter(data_module.train_dataloader())
+    for _ in range(num_batches):
+        start = time.perf_counter()
+        try:
+            batch_data = next(iterator)
+        except StopIteration:
+            break
+        collate_seconds += time.perf_counter() - start
+        input_encodings, label_encodings = batch_data[1], batch_data[2]
+        input_padding.append(padding_ratio(input_encodings))
+        label_padding.append(padding_ratio(label_encodings))
+        tokens += input_encodings.attention_mask.sum().item() + label_encodings.attention_mask.sum().item()
+
+        if model is not None:
+            start = time.perf_counter()
+            batch_size = label_encodings.input_ids.size(0)
+            image_embeddings = torch.zeros(batch_size, 1, model.config.d_model)
+            loss = model(input_ids=input_encodings.input_ids,
+                         attention_mask=input_encodings.attention_mask,
+                         image_embeddings=image_embeddings,
+                         labels=label_encodings.input_ids).loss
+            loss.backward()
+            model.zero_grad()
+            model_seconds += time.perf_counter() - start
+
+    result = {'batches': len(label_padding),
+              'input_padding_ratio': round(sum(input_padding) / len(input_padding), 3),
+              'label_padding_ratio': round(sum(label_padding) / len(label_padding), 3),
+              'collate_tokens_per_second': round(tokens / collate_seconds)}
+    if model is not None:
+        result['model_tokens_per_second'] = round(tokens / model_seconds)
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='flickr', choices=['flickr', 'vqa'])
+    parser.add_argument('--mask', type=str, default='text_infilling')
+    parser.add_argument('--tokenizer', type=str, default='facebook/bart-base')
+    parser.add_argument('--model', type=str, default=None, help='e.g. facebook/bart-base to also time the model')
+    parser.add_argument('--annotation_cache_dir', type=str, default=None)
+    parser.add_argument('--token_cache_dir', type=str, default=None)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--num_batches', type=int, default=200)
+    parser.add_argument('--output_file', type=str, default='benchmark_results/padding.json')
+
+    args = parser.parse_args()
+
+    model = None
+    if args.model is not None:
+        from modelling_bartMultiModal import BartMultiModalGenerationModel
+        model = BartMultiModalGenerationModel.from_pretrained(args.model)
+        model.train()
+
+    rows = []
+    for bucket_by_length in [False, True]:
+        torch.manual_seed(0)
+        result = measure(data_module_for(args, bucket_by_length), model, args.num_batches)
+        rows.append(dict(result, sampler='bucketed' if bucket_by_length else 'random'))
+
+    print_table(rows, ['sampler'] + [column for column in rows[0] if column != 'sampler'])
+    write_results({'benchmark': 'padding', 'args': vars(args), 'results': rows}, args.output_file)
@@ -0,0 +1,133 @@
+import argparse
+import sys
+import time
+
+import torch
+from transformers import ViTModel
+
+from benchmarks.common import write_results, print_table, tiny_configs, saved_activation_mb
+from evaluation_metrics import compute_bleu_scores
+from model_utils import Precision, vision_encoder_context
+from modelling_bartMultiModal import BartMultiModalGenerationModel
+
+
+def synthetic_task(args, vocab_size, device):
+
+    '''
+    Fixed pixel values and random captions that the model learns to reproduce from the image
+    '''
+
+    generator = torch.Generator().manual_seed(0)
+    pixel_values = torch.randn(args.num_samples, 3, 224, 224, generator=generator)
+    captions = torch.randint(4, vocab_size, (args.num_samples, args.caption_length), generator=generator)
+    captions[:, 0] = 0
+    captions[:, -1] = 2
+    return pixel_values.to(device), captions.to(device)
+
+
+def run(args, precision_name, device):
+
+    '''
+    Train from the same initialisation in one precision mode, then generate the training captions
+    '''
+
+    vit_config, bart_config = tiny_configs(hidden_size=args.hidden_size,
+                                           num_layers=args.num_layers,
+                                           vocab_size=args.vocab_size)
+    torch.manual_seed(0)
+    image_model = ViTModel(vit_config).to(device).eval().requires_grad_(False)
+    model = BartMultiModalGenerationModel(bart_config).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=args.learning_rate)
+    precision = Precision(precision_name, device)
+    pixel_values, captions = synthetic_task(args, args.vocab_size, device)
+    input_ids = captions[:, [0, -1]]
+
+    def step(batch):
+        with precision.autocast():
+            with vision_encoder_context('frozen'):
+                image_embeddings = image_model(pixel_values[batch]).last_hidden_state
+            return model(input_ids=input_ids[batch], image_embeddings=image_embeddings, labels=captions[batch]).loss
+
+    model.train()
+    losses, step_seconds, activation_mb = [], [], 0.0
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    for i in range(args.steps):
+        batch = torch.arange(i * args.batch_size, (i + 1) * args.batch_size) % args.num_samples
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        loss, activation_mb = saved_activation_mb(lambda: step(batch))
+        optimizer.zero_grad(set_to_none=True)
+        precision.backward(loss)
+        precision.step(optimizer)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        step_seconds.append(time.perf_counter() - start)
+        losses.append(loss.item())
+
+    model.eval()
+    predictions, references = [], []
+    with torch.no_grad(), precision.autocast():
+        for start in range(0, args.num_samples, args.batch_size):
+            batch = torch.arange(start, min(start + args.batch_size, args.num_samples))
+            image_embeddings = image_model(pixel_values[batch]).last_hidden_state
+            generated_ids = model.generate(input_ids=input_ids[batch],
+                                           image_embeddings=image_embeddings,
+                                           num_beams=args.num_beams,
+                                           max_length=args.caption_length + 1)
+            predictions += [' '.join(map(str, ids[ids > 2].tolist())) for ids in generated_ids]
+            references += [[' '.join(map(str, ids[ids > 2].tolist()))] for ids in captions[batch]]
+
+    # Skip the first steps (warmup) in the throughput
+    timed = step_seconds[args.warmup:]
+    result = {'precision': precision_name,
+              'final_loss': round(sum(losses[-args.loss_window:]) / args.loss_window, 4),
+              'bleu': compute_bleu_scores(predictions, references)[0],
+              'samples_per_second': round(args.batch_size * len(timed) / sum(timed), 1),
+              'saved_activation_mb': round(activation_mb, 1)}
+    if device.type == 'cuda':
+        result['peak_memory_mb'] = round(torch.cuda.max_memory_allocated(device) / 2 ** 20, 1)
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--precisions', type=str, nargs='+', default=None,
+                        help='defaults to fp32 bf16 (and fp16 on GPU)')
+    parser.add_argument('--hidden_size', type=int, default=64)
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--vocab_size', type=int, default=1000)
+    parser.add_argument('--num_samples', type=int, default=32)
+    parser.add_argument('--caption_length', type=int, default=12)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--steps', type=int, default=150)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--loss_window', type=int, default=10)
+    parser.add_argument('--learning_rate', type=float, default=1e-3)
+    parser.add_argument('--num_beams', type=int, default=5)
+    parser.add_argument('--loss_tolerance', type=float, default=0.1, help='relative to the fp32 loss')
+    parser.add_argument('--bleu_tolerance', type=float, default=5.0, help='absolute BLEU points')
+    parser.add_argument('--output_file', type=str, default='benchmark_results/precision.json')
+
+    args = parser.parse_args()
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    precisions = args.precisions or (['fp32', 'bf16', 'fp16'] if device.type == 'cuda' else ['fp32', 'bf16'])
+    if 'fp32' not in precisions:
+        precisions = ['fp32'] + precisions
+    rows = [run(args, precision_name, device) for precision_name in precisions]
+
+    # Regression check against fp32
+    reference = rows[0]
+    for row in rows:
+        loss_difference = abs(row['final_loss'] - reference['final_loss']) / max(reference['final_loss'], 1e-8)
+        row['within_tolerance'] = (loss_difference <= args.loss_tolerance and
+                                   abs(row['bleu'] - reference['bleu']) <= args.bleu_tolerance)
+
+    print_table(rows, list(rows[0]))
+    write_results({'benchmark': 'precision', 'device': str(device), 'args': vars(args), 'results': rows},
+                  args.output_file)
+    if not all(row['within_tolerance'] for row in rows):
+        sys.exit(1)
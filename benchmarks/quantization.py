@@ -0,0 +1,114 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import time
+
+import torch
+
+from benchmarks.common import write_results, print_table
+
+
+def load_models(args, mode):
+
+    from transformers import ViTModel
+    from modelling_bartMultiModal import BartMultiModalGenerationModel
+    from quantization import quantize_dynamic, load_quantized, is_quantized_checkpoint, VISION_ENCODER_DIR
+
+    if mode == 'int8' and is_quantized_checkpoint(args.quantized_ckpt):
+        return load_quantized(args.quantized_ckpt)
+    vision_path = os.path.join(args.model_ckpt, VISION_ENCODER_DIR)
+    image_model = ViTModel.from_pretrained(vision_path if os.path.isdir(vision_path) else args.image_encoder)
+    model = BartMultiModalGenerationModel.from_pretrained(args.model_ckpt)
+    if mode == 'int8':
+        return quantize_dynamic(model), quantize_dynamic(image_model)
+    return model.eval(), image_model.eval()
+
+
+def data_module_for(args):
+
+    from transformers import BartTokenizer, ViTFeatureExtractor
+    from dataset import FlickrDatasetModule
+
+    data_module = FlickrDatasetModule(multi_modal=True,
+                                      mask='empty',
+                                      predict_file=args.split,
+                                      eval_batch_size=args.batch_size,
+                                      num_workers=0,
+                                      pixel_cache_dir=args.pixel_cache_dir)
+    data_module._set_tokenizer(BartTokenizer.from_pretrained(args.tokenizer))
+    data_module._set_image_feature_extractor(ViTFeatureExtractor.from_pretrained(args.image_encoder))
+    data_module.setup('predict')
+    return data_module
+
+
+def run(args, mode):
+
+    '''
+    Caption the held out split with the fp32 or int8 models. Runs in its own process so that
+    the peak RSS belongs to this mode only.
+    '''
+
+    from evaluation_metrics import compute_bleu_scores, compute_meteor_score
+    from quantization import model_size_mb
+
+    torch.set_num_threads(args.num_threads)
+    model, image_model = load_models(args, mode)
+    data_module = data_module_for(args)
+
+    seconds, num_images = 0.0, 0
+    bleu_scores, meteor_scores = [], []
+    with torch.no_grad():
+        for batch_idx, batch_data in enumerate(data_module.predict_dataloader()):
+            if batch_idx == args.num_batches:
+                break
+            input_encodings = batch_data[1]
+            start = time.perf_counter()
+            image_embeddings = image_model(batch_data[0]).last_hidden_state
+            generated_ids = model.generate(input_ids=input_encodings.input_ids,
+                                           attention_mask=input_encodings.attention_mask,
+                                           image_embeddings=image_embeddings,
+                                           num_beams=args.num_beams,
+                                           max_length=24)
+            seconds += time.perf_counter() - start
+            num_images += len(batch_data[3])
+            generated_text = data_module.tokenizer.batch_decode(generated_ids,
+                                                                skip_special_tokens=True,
+                                                                clean_up_tokenization_spaces=False)
+            bleu_scores += compute_bleu_scores(generated_text, batch_data[2])[1]
+            meteor_scores += compute_meteor_score(generated_text, batch_data[2])[1]
+
+    return {'mode': mode,
+            'ms_per_image': round(1000 * seconds / num_images, 1),
+            'model_size_mb': round(model_size_mb(model) + model_size_mb(image_model), 1),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'bleu': round(sum(bleu_scores) / len(bleu_scores), 2),
+            'meteor': round(sum(meteor_scores) / len(meteor_scores), 2)}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_ckpt', type=str, required=True, help='fp32 checkpoint')
+    parser.add_argument('--quantized_ckpt', type=str, default=None,
+                        help='int8 artifacts saved by quantization.py, the fp32 checkpoint is quantized if not given')
+    parser.add_argument('--image_encoder', type=str, default='google/vit-base-patch16-224-in21k')
+    parser.add_argument('--tokenizer', type=str, default='facebook/bart-base')
+    parser.add_argument('--pixel_cache_dir', type=str, default=None)
+    parser.add_argument('--split', type=str, default='test', choices=['train', 'valid', 'test'])
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_batches', type=int, default=50)
+    parser.add_argument('--num_beams', type=int, default=5)
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--output_file', type=str, default='benchmark_results/quantization.json')
+
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    rows = []
+    for mode in ['fp32', 'int8']:
+        with context.Pool(1) as pool:
+            rows.append(pool.apply(run, (args, mode)))
+
+    print_table(rows, list(rows[0]))
+    write_results({'benchmark': 'quantization', 'args': vars(args), 'results': rows}, args.output_file)
@@ -0,0 +1,97 @@
+import os
+import random
+from collections import OrderedDict
+
+import torch
+
+from dataset import FlickrDatasetModule
+
+SUBJECTS = ['a man', 'a woman', 'two children', 'a young girl', 'an old man', 'a brown dog', 'a group of people',
+            'a boy', 'three men', 'a black cat', 'a little boy', 'a crowd']
+ACTIONS = ['is running', 'is sitting', 'is playing', 'is walking', 'is standing', 'is jumping', 'is riding a bike',
+           'is climbing a rock', 'is holding a ball', 'is eating', 'is swimming', 'is looking at the camera']
+PLACES = ['on the beach', 'in a park', 'on a city street', 'in the snow', 'near the water', 'in front of a building',
+          'on a wooden bench', 'in the grass', 'at a concert', 'in a kitchen', 'under a tree', 'on a mountain']
+DETAILS = ['', 'wearing a red shirt', 'with a blue hat', 'while smiling', 'in the sun', 'next to a white car',
+           'with friends', 'on a cold day']
+
+
+def synthetic_captions(num_captions, seed=0):
+
+    '''
+    Flickr30k like captions ("a man is running on the beach wearing a red shirt .") of 8 to 20 words
+    '''
+
+    rng = random.Random(seed)
+    captions = []
+    for _ in range(num_captions):
+        words = [rng.choice(SUBJECTS), rng.choice(ACTIONS), rng.choice(PLACES), rng.choice(DETAILS), '.']
+        captions.append(' '.join(word for word in words if word))
+    return captions
+
+
+def synthetic_images(num_images, image_size=224, seed=0):
+
+    '''
+    Random uint8 (channels, height, width) tensors, like the images of the dataloaders (PILToTensor)
+    '''
+
+    generator = torch.Generator().manual_seed(seed)
+    return [torch.randint(0, 256, (3, image_size, image_size), dtype=torch.uint8, generator=generator)
+            for _ in range(num_images)]
+
+
+def synthetic_flickr_dataset(num_images, captions_per_image=5, seed=0):
+
+    '''
+    {image filename: captions} in the format of FlickrDatasetModule._load_dataset
+    '''
+
+    captions = synthetic_captions(num_images * captions_per_image, seed)
+    return OrderedDict((f'{i}.jpg', captions[i * captions_per_image:(i + 1) * captions_per_image])
+                       for i in range(num_images))
+
+
+def offline_tokenizer(output_dir, seed=0):
+
+    '''
+    BartTokenizer with a byte level BPE vocabulary learnt from the synthetic captions.
+    It has the special tokens of BART (<s>=0, <pad>=1, </s>=2, <unk>=3 and <mask>) and is built
+    without the Hugging Face hub.
+    '''
+
+    from tokenizers import ByteLevelBPETokenizer
+    from transformers import BartTokenizer
+
+    os.makedirs(output_dir, exist_ok=True)
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(synthetic_captions(2000, seed),
+                            vocab_size=1000,
+                            min_frequency=1,
+                            special_tokens=['<s>', '<pad>', '</s>', '<unk>', '<mask>'])
+    bpe.save_model(output_dir)
+    return BartTokenizer.from_pretrained(output_dir)
+
+
+def offline_feature_extractor(image_size=224):
+
+    # Default ViT preprocessing (resize, scale, normalize with mean and std 0.5) of google/vit-base-patch16-224-in21k
+    from transformers import ViTFeatureExtractor
+
+    return ViTFeatureExtractor(size=image_size)
+
+
+class SyntheticFlickrDatasetModule(FlickrDatasetModule):
+
+    def __init__(self, dataset, **kwargs):
+
+        '''
+        FlickrDatasetModule on a synthetic {image filename: captions} dataset instead of the Flickr30k annotations
+        '''
+
+        self.synthetic_dataset = dataset
+        super().__init__(**kwargs)
+
+    def _load_dataset(self):
+
+        return self.synthetic_dataset
@@ -0,0 +1,103 @@
+import argparse
+import time
+
+import torch
+from transformers import ViTModel
+
+from benchmarks.common import write_results, print_table, tiny_configs
+from modelling_bartMultiModal import BartMultiModalGenerationModel
+
+
+def synthetic_templates(args, vocab_size, mask_token_id):
+
+    '''
+    Templates like "<s> w w <mask> w <mask> <mask> w </s>" with random words w
+    '''
+
+    generator = torch.Generator().manual_seed(0)
+    templates = []
+    for _ in range(args.num_templates):
+        is_mask = torch.rand(args.template_length, generator=generator) < args.mask_fraction
+        words = torch.randint(4, vocab_size - 1, (args.template_length,), generator=generator)
+        templates.append([0] + torch.where(is_mask, torch.tensor(mask_token_id), words).tolist() + [2])
+    return templates
+
+
+def keeps_template(generated_ids, template, mask_token_id):
+
+    # The fixed template tokens appear in order in the caption
+    generated = iter(generated_ids.tolist())
+    return all(token_id in generated for token_id in template if token_id != mask_token_id)
+
+
+def run(args, mode, model, image_model, templates, mask_token_id):
+
+    # Decoder forward passes and decoded positions (rows x new tokens of every pass, padding included),
+    # counted at the lm_head, which both decoders call once per pass
+    decoder_calls, decoded_positions = [0], [0]
+
+    def count(module, inputs, outputs):
+        decoder_calls[0] += 1
+        decoded_positions[0] += outputs.size(0) * outputs.size(1)
+
+    handle = model.lm_head.register_forward_hook(count)
+    generator = torch.Generator().manual_seed(0)
+    image_size = image_model.config.image_size
+    seconds, kept = 0.0, 0
+    for start in range(0, len(templates), args.batch_size):
+        batch_templates = templates[start:start + args.batch_size]
+        input_ids = torch.full((len(batch_templates), max(map(len, batch_templates))), 1, dtype=torch.long)
+        for i, template in enumerate(batch_templates):
+            input_ids[i, :len(template)] = torch.tensor(template)
+        pixel_values = torch.randn(len(batch_templates), 3, image_size, image_size, generator=generator)
+        begin = time.perf_counter()
+        with torch.no_grad():
+            image_embeddings = image_model(pixel_values).last_hidden_state
+            generated_ids = model.generate(input_ids=input_ids,
+                                           attention_mask=input_ids.ne(1).long(),
+                                           image_embeddings=image_embeddings,
+                                           num_beams=args.num_beams,
+                                           max_length=args.max_length,
+                                           template_mask_token_id=mask_token_id if mode == 'template' else None,
+                                           max_span_length=args.max_span_length if mode == 'template' else None)
+        seconds += time.perf_counter() - begin
+        kept += sum(keeps_template(ids, template, mask_token_id)
+                    for ids, template in zip(generated_ids, batch_templates))
+    handle.remove()
+    return {'decoding': mode,
+            'decoder_forward_passes': decoder_calls[0],
+            'decoded_positions': decoded_positions[0],
+            'ms_per_caption': round(1000 * seconds / len(templates), 1),
+            'template_kept': round(kept / len(templates), 3)}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hidden_size', type=int, default=64)
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--vocab_size', type=int, default=1000)
+    parser.add_argument('--num_templates', type=int, default=32)
+    parser.add_argument('--template_length', type=int, default=10)
+    parser.add_argument('--mask_fraction', type=float, default=0.4)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_beams', type=int, default=5)
+    parser.add_argument('--max_length', type=int, default=32)
+    parser.add_argument('--max_span_length', type=int, default=4)
+    parser.add_argument('--output_file', type=str, default='benchmark_results/template_decoding.json')
+
+    args = parser.parse_args()
+
+    vit_config, bart_config = tiny_configs(hidden_size=args.hidden_size,
+                                           num_layers=args.num_layers,
+                                           vocab_size=args.vocab_size)
+    torch.manual_seed(0)
+    model = BartMultiModalGenerationModel(bart_config).eval()
+    image_model = ViTModel(vit_config).eval()
+    # Last token of the vocabulary, like <mask> in the BART vocabulary
+    mask_token_id = args.vocab_size - 1
+    templates = synthetic_templates(args, args.vocab_size, mask_token_id)
+
+    rows = [run(args, mode, model, image_model, templates, mask_token_id) for mode in ['generate', 'template']]
+    print_table(rows, list(rows[0]))
+    write_results({'benchmark': 'template_decoding', 'args': vars(args), 'results': rows}, args.output_file)
@@ -0,0 +1,84 @@
+import argparse
+import time
+
+import torch
+
+from benchmarks.common import write_results, print_table, tiny_configs, saved_activation_mb
+from model_utils import apply_vision_encoder_policy, vision_encoder_context, trainable_parameters, count_parameters
+
+
+def load_models(args):
+
+    from transformers import ViTModel
+    from modelling_bartMultiModal import BartMultiModalGenerationModel
+
+    if args.pretrained:
+        return (ViTModel.from_pretrained('google/vit-base-patch16-224-in21k'),
+                BartMultiModalGenerationModel.from_pretrained('facebook/bart-base'))
+    vit_config, bart_config = tiny_configs(hidden_size=args.hidden_size, num_layers=args.num_layers)
+    return ViTModel(vit_config), BartMultiModalGenerationModel(bart_config)
+
+
+def measure(args, policy, device):
+
+    torch.manual_seed(0)
+    image_model, model = load_models(args)
+    apply_vision_encoder_policy(image_model, policy, args.num_trainable_layers)
+    image_model.to(device).train(policy != 'frozen')
+    model.to(device).train()
+    optimizer = torch.optim.AdamW(trainable_parameters(model, image_model), lr=1e-4)
+
+    pixel_values = torch.randn(args.batch_size, 3, 224, 224, device=device)
+    input_ids = torch.randint(4, model.config.vocab_size, (args.batch_size, args.text_length), device=device)
+
+    def step():
+        with vision_encoder_context(policy):
+            image_embeddings = image_model(pixel_values).last_hidden_state
+        return model(input_ids=input_ids, image_embeddings=image_embeddings, labels=input_ids).loss
+
+    step_seconds, activation_mb = [], 0.0
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    for i in range(args.warmup + args.steps):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        loss, activation_mb = saved_activation_mb(step)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        if i >= args.warmup:
+            step_seconds.append(time.perf_counter() - start)
+
+    parameters = count_parameters(image_model)
+    result = {'policy': policy,
+              'trainable_vit_params': parameters['trainable'],
+              'saved_activation_mb': round(activation_mb, 1),
+              'step_ms': round(1000 * sum(step_seconds) / len(step_seconds), 1)}
+    if device.type == 'cuda':
+        result['peak_memory_mb'] = round(torch.cuda.max_memory_allocated(device) / 2 ** 20, 1)
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pretrained', action='store_true', help='ViT-base and BART-base instead of tiny configs')
+    parser.add_argument('--hidden_size', type=int, default=64)
+    parser.add_argument('--num_layers', type=int, default=4)
+    parser.add_argument('--num_trainable_layers', type=int, default=2)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--text_length', type=int, default=24)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--output_file', type=str, default='benchmark_results/vision_encoder.json')
+
+    args = parser.parse_args()
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    rows = [measure(args, policy, device) for policy in ['trainable', 'last_n', 'frozen']]
+    print_table(rows, list(rows[0]))
+    write_results({'benchmark': 'vision_encoder', 'device': str(device), 'args': vars(args), 'results': rows},
+                  args.output_file)
@@ -0,0 +1,140 @@
+import argparse
+import time
+
+import torch
+from transformers import BartConfig
+
+from benchmarks.common import write_results, print_table, tiny_configs
+from modelling_bartMultiModal import BartMultiModalGenerationModel
+
+
+def model_with_visual_tokens(args, num_visual_tokens):
+
+    '''
+    Model with a (randomly initialised) resampler of num_visual_tokens tokens, 0 for the full image prefix
+    '''
+
+    if args.model is not None:
+        config = BartConfig.from_pretrained(args.model)
+    else:
+        config = tiny_configs(hidden_size=args.hidden_size, num_layers=args.num_layers)[1]
+    config.num_visual_tokens = num_visual_tokens or None
+    torch.manual_seed(0)
+    if args.model is not None:
+        return BartMultiModalGenerationModel.from_pretrained(args.model, config=config)
+    return BartMultiModalGenerationModel(config)
+
+
+def decode_latency(args, model, device):
+
+    '''
+    Milliseconds per generate call of a batch with a fixed number of decoding steps
+    '''
+
+    model.to(device).eval()
+    image_embeddings = torch.randn(args.batch_size, args.image_tokens, model.config.d_model, device=device)
+    # Empty input text (<s></s>) as for the 'empty' mask
+    input_ids = torch.tensor([[model.config.bos_token_id, model.config.eos_token_id]] * args.batch_size, device=device)
+
+    seconds = []
+    with torch.no_grad():
+        for i in range(args.warmup + args.repeats):
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            model.generate(input_ids=input_ids,
+                           image_embeddings=image_embeddings,
+                           num_beams=args.num_beams,
+                           min_length=args.max_length,
+                           max_length=args.max_length)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            if i >= args.warmup:
+                seconds.append(time.perf_counter() - start)
+    return round(1000 * sum(seconds) / len(seconds), 1)
+
+
+def caption_quality(args, checkpoint, device):
+
+    '''
+    BLEU and METEOR of a trained checkpoint on a flickr split, images are read from an ImageEmbeddingStore
+    '''
+
+    from transformers import BartTokenizer
+    from dataset import FlickrDatasetModule
+    from evaluation_metrics import compute_bleu_scores, compute_meteor_score
+
+    model = BartMultiModalGenerationModel.from_pretrained(checkpoint).to(device).eval()
+    data_module = FlickrDatasetModule(multi_modal=True,
+                                      mask='empty',
+                                      predict_file=args.split,
+                                      eval_batch_size=args.batch_size,
+                                      num_workers=0,
+                                      image_embeddings_dir=args.image_embeddings_dir)
+    data_module._set_tokenizer(BartTokenizer.from_pretrained(args.tokenizer))
+    data_module.setup('predict')
+
+    bleu_scores, meteor_scores = [], []
+    with torch.no_grad():
+        for batch_idx, batch_data in enumerate(data_module.predict_dataloader()):
+            if batch_idx == args.num_batches:
+                break
+            input_encodings = batch_data[1].to(device)
+            generated_ids = model.generate(input_ids=input_encodings.input_ids,
+                                           attention_mask=input_encodings.attention_mask,
+                                           image_embeddings=batch_data[0].to(device).float(),
+                                           num_beams=args.num_beams,
+                                           max_length=args.max_length)
+            generated_text = data_module.tokenizer.batch_decode(generated_ids,
+                                                                skip_special_tokens=True,
+                                                                clean_up_tokenization_spaces=False)
+            bleu_scores += compute_bleu_scores(generated_text, batch_data[2])[1]
+            meteor_scores += compute_meteor_score(generated_text, batch_data[2])[1]
+
+    return {'num_visual_tokens': model.config.to_dict().get('num_visual_tokens') or 0,
+            'checkpoint': checkpoint,
+            'decode_ms': decode_latency(args, model, device),
+            'bleu': round(sum(bleu_scores) / len(bleu_scores), 2),
+            'meteor': round(sum(meteor_scores) / len(meteor_scores), 2)}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_visual_tokens', type=int, nargs='+', default=[0, 8, 16, 32, 64],
+                        help='0 is the full image prefix without resampler')
+    parser.add_argument('--model', type=str, default=None, help='e.g. facebook/bart-base instead of a tiny config')
+    parser.add_argument('--hidden_size', type=int, default=64)
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--image_tokens', type=int, default=197)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_beams', type=int, default=5)
+    parser.add_argument('--max_length', type=int, default=24)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--checkpoints', type=str, nargs='*', default=[],
+                        help='trained checkpoints (with different num_visual_tokens) to also compare caption quality')
+    parser.add_argument('--image_embeddings_dir', type=str, default=None)
+    parser.add_argument('--tokenizer', type=str, default='facebook/bart-base')
+    parser.add_argument('--split', type=str, default='valid', choices=['train', 'valid', 'test'])
+    parser.add_argument('--num_batches', type=int, default=50)
+    parser.add_argument('--output_file', type=str, default='benchmark_results/visual_tokens.json')
+
+    args = parser.parse_args()
+    if args.checkpoints and args.image_embeddings_dir is None:
+        parser.error('--checkpoints needs --image_embeddings_dir')
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    latency_rows = []
+    for num_visual_tokens in args.num_visual_tokens:
+        model = model_with_visual_tokens(args, num_visual_tokens)
+        latency_rows.append({'num_visual_tokens': num_visual_tokens,
+                             'decode_ms': decode_latency(args, model, device)})
+    print_table(latency_rows, ['num_visual_tokens', 'decode_ms'])
+
+    quality_rows = [caption_quality(args, checkpoint, device) for checkpoint in args.checkpoints]
+    if quality_rows:
+        print_table(quality_rows, list(quality_rows[0]))
+
+    write_results({'benchmark': 'visual_tokens', 'device': str(device), 'args': vars(args),
+                   'latency': latency_rows, 'quality': quality_rows}, args.output_file)
@@ -0,0 +1,105 @@
+import argparse
+import threading
+import time
+
+import psutil
+import torch
+
+from benchmarks.common import write_results, unique_memory_mb, print_table, FilenameImages
+from benchmarks.synthetic import synthetic_flickr_dataset
+from dataset import FlickrDataset
+
+
+class ListFlickrDataset(torch.utils.data.Dataset):
+
+    '''
+    Previous FlickrDataset layout: one Python string per caption and image filename
+    '''
+
+    def __init__(self, image_files, dataset):
+
+        self.images, self.captions = [], []
+        for image in image_files:
+            for caption in dataset[image]:
+                self.captions.append(caption)
+                self.images.append(image)
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return self.captions[index], self.images[index]
+
+
+def flickr_dataset():
+
+    data = open('datasets/flickr30k/results_20130124.token', 'r').read().splitlines()
+    dataset = {}
+    for line in data:
+        dataset.setdefault(line.split('#')[0], []).append(line.split('\t')[1])
+    return dataset
+
+
+def measure_epoch(dataset, num_workers, batch_size, interval):
+
+    '''
+    Iterate one epoch and sample the USS of every worker process
+    '''
+
+    dataloader = torch.utils.data.DataLoader(dataset,
+                                             batch_size=batch_size,
+                                             shuffle=True,
+                                             num_workers=num_workers,
+                                             collate_fn=len)
+    samples = {}
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            for child in psutil.Process().children():
+                try:
+                    samples.setdefault(child.pid, []).append(unique_memory_mb(child))
+                except psutil.Error:
+                    pass
+            time.sleep(interval)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    start = time.perf_counter()
+    sampler.start()
+    num_samples = sum(dataloader)
+    done.set()
+    sampler.join()
+    elapsed = time.perf_counter() - start
+
+    workers = [values for values in samples.values() if len(values) > 1]
+    return {'samples': num_samples,
+            'seconds': round(elapsed, 2),
+            'worker_uss_start_mb': round(sum(v[0] for v in workers) / max(len(workers), 1), 1),
+            'worker_uss_end_mb': round(sum(v[-1] for v in workers) / max(len(workers), 1), 1),
+            'worker_uss_max_mb': round(max((max(v) for v in workers), default=0.0), 1)}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='synthetic', choices=['synthetic', 'flickr'])
+    parser.add_argument('--num_images', type=int, default=200000)
+    parser.add_argument('--num_workers', type=int, default=12)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--interval', type=float, default=0.5)
+    parser.add_argument('--output_file', type=str, default='benchmark_results/worker_memory.json')
+
+    args = parser.parse_args()
+
+    data = synthetic_flickr_dataset(args.num_images) if args.dataset == 'synthetic' else flickr_dataset()
+    image_files = list(data.keys())
+    rows = []
+    for name, dataset in [('python lists', ListFlickrDataset(image_files, data)),
+                          ('packed arrays', FlickrDataset(image_files, data, embedding_store=FilenameImages()))]:
+        result = measure_epoch(dataset, args.num_workers, args.batch_size, args.interval)
+        rows.append(dict(result, storage=name))
+        del dataset
+
+    print_table(rows, ['storage', 'samples', 'seconds',
+                       'worker_uss_start_mb', 'worker_uss_end_mb', 'worker_uss_max_mb'])
+    write_results({'benchmark': 'worker_memory', 'args': vars(args), 'results': rows}, args.output_file)
@@ -0,0 +1,193 @@
+import copy
+import os
+import queue
+import shutil
+import threading
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+SAFE_WEIGHTS_NAME = 'model.safetensors'
+
+
+def snapshot_state_dict(model, dtype=None, trainable_only=False):
+
+    '''
+    CPU copy of the state dict of a model, taken on the training thread so that the following
+    optimizer steps don't change the weights being written.
+    Tied weights (model.shared, the decoder embeddings and lm_head of BART) are copied once,
+    under their first name, from_pretrained ties them again when loading.
+    :param dtype: dtype of the floating point tensors (torch.float16 halves the checkpoint size), kept if None
+    :param trainable_only: only the parameters with requires_grad, loaded on top of the pretrained model
+    '''
+
+    trainable = {name for name, param in model.named_parameters() if param.requires_grad}
+    state_dict = {}
+    seen = set()
+    for name, tensor in model.state_dict().items():
+        if trainable_only and name not in trainable:
+            continue
+        if tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        tensor = tensor.detach()
+        tensor_dtype = dtype if dtype is not None and tensor.is_floating_point() else tensor.dtype
+        state_dict[name] = tensor.to('cpu', dtype=tensor_dtype, copy=True).contiguous()
+    return state_dict
+
+
+def snapshot_state(state, copies=None):
+
+    '''
+    Copy of a nested dict/list/tuple state (e.g. Trainer.save_training_state) with every tensor copied to the CPU,
+    taken on the training thread like snapshot_state_dict. Tensors sharing their data (tied weights) are copied once.
+    '''
+
+    copies = {} if copies is None else copies
+    if torch.is_tensor(state):
+        key = (state.data_ptr(), state.dtype, tuple(state.size()), state.stride())
+        if key not in copies:
+            copies[key] = state.detach().to('cpu', copy=True)
+        return copies[key]
+    if isinstance(state, dict):
+        return {key: snapshot_state(value, copies) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state(value, copies) for value in state)
+    return state
+
+
+def is_partial_checkpoint(path):
+
+    '''
+    True for a checkpoint written with trainable_only (only the trainable weights)
+    '''
+
+    if path is None or not os.path.isfile(os.path.join(path, SAFE_WEIGHTS_NAME)):
+        return False
+    with safe_open(os.path.join(path, SAFE_WEIGHTS_NAME), framework='pt') as f:
+        return (f.metadata() or {}).get('trainable_only') == 'true'
+
+
+def load_partial_checkpoint(model, path):
+
+    '''
+    Load the weights of a trainable_only checkpoint into a pretrained model
+    '''
+
+    state_dict = {}
+    with safe_open(os.path.join(path, SAFE_WEIGHTS_NAME), framework='pt') as f:
+        for name in f.keys():
+            state_dict[name] = f.get_tensor(name)
+    model.load_state_dict(state_dict, strict=False)
+    return model
+
+
+class CheckpointWriter:
+
+    def __init__(self,
+                 dtype=None,
+                 trainable_only=False,
+                 background=True,
+                 max_pending=1):
+
+        '''
+        Writes checkpoints as safetensors files (model.safetensors and config.json, loadable with from_pretrained).
+        The weights are copied to the CPU in save, the files are written by a background thread so training
+        continues while they are serialised. A checkpoint is written to a temporary dir that is renamed to its
+        path when complete, so a checkpoint dir is never partially written.
+
+        :param dtype: dtype of the saved floating point weights (torch.float16), the model dtype if None
+        :param trainable_only: save only the parameters with requires_grad (a frozen ViT is left out)
+        :param background: write in the background thread, in save otherwise
+        :param max_pending: snapshots waiting to be written, save blocks when the queue is full
+        so at most max_pending + 1 snapshots are in memory
+        '''
+
+        self.dtype = dtype
+        self.trainable_only = trainable_only
+        self.background = background
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        if background:
+            self.thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+            self.thread.start()
+
+    def save(self, path, models):
+
+        '''
+        :param path: checkpoint dir
+        :param models: {sub dir: model}, '' for the checkpoint dir itself (e.g. {'': bart, 'vision_encoder': vit})
+        '''
+
+        self._raise_error()
+        snapshot = {}
+        for sub_dir, model in models.items():
+            config = copy.deepcopy(model.config)
+            config.architectures = [model.__class__.__name__]
+            state_dict = snapshot_state_dict(model, self.dtype, self.trainable_only)
+            config.torch_dtype = str(next(iter(state_dict.values())).dtype).split('.')[1]
+            snapshot[sub_dir] = (config, state_dict)
+        self._put(('checkpoint', path, snapshot))
+
+    def save_state(self, path, state):
+
+        '''
+        torch.save a copy of state (with its tensors on the CPU) to path, through a temporary file
+        that replaces path when complete. Queued behind the checkpoints saved before.
+        '''
+
+        self._raise_error()
+        self._put(('state', path, snapshot_state(state)))
+
+    def flush(self):
+
+        '''
+        Wait until the queued checkpoints are written
+        '''
+
+        if self.background:
+            self.queue.join()
+        self._raise_error()
+
+    def _put(self, item):
+
+        if self.background:
+            self.queue.put(item)
+        else:
+            self._write(*item)
+
+    def _run(self):
+
+        while True:
+            item = self.queue.get()
+            try:
+                self._write(*item)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _write(self, kind, path, snapshot):
+
+        if kind == 'state':
+            torch.save(snapshot, f'{path}.tmp')
+            os.replace(f'{path}.tmp', path)
+            return
+        path = os.path.normpath(path)
+        tmp_path = f'{path}.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        metadata = {'format': 'pt', 'trainable_only': 'true' if self.trainable_only else 'false'}
+        for sub_dir, (config, state_dict) in snapshot.items():
+            save_dir = os.path.join(tmp_path, sub_dir)
+            os.makedirs(save_dir, exist_ok=True)
+            config.save_pretrained(save_dir)
+            save_file(state_dict, os.path.join(save_dir, SAFE_WEIGHTS_NAME), metadata=metadata)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    def _raise_error(self):
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing a checkpoint failed') from error
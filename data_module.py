@@ -0,0 +1,160 @@
+from torch.utils.data import BatchSampler
+import torch
+from torchvision.transforms import transforms
+import pytorch_lightning as pl
+
+from embedding_store import ImageEmbeddingStore
+from pixel_cache import PixelCache, normalize_pixel_values
+from token_store import TokenCache, pad_token_ids
+from samplers import BucketBatchSampler, SkipBatchSampler, batch_sampler
+from distributed import is_distributed, get_rank, get_world_size, distributed_sampler
+
+
+class DataModule(pl.LightningDataModule):
+
+    def __init__(self,
+                 train_batch_size=16,
+                 eval_batch_size=16,
+                 transform=transforms.PILToTensor(),
+                 num_workers=12,
+                 image_embeddings_dir=None,
+                 pixel_cache_dir=None,
+                 pixel_transform=None,
+                 token_cache_dir=None,
+                 tokenizer_revision='main',
+                 hub_cache_dir=None,
+                 local_files_only=False,
+                 bucket_by_length=False,
+                 bucket_size_multiplier=100,
+                 data_seed=42,
+                 ):
+
+        '''
+        Image, token and batch handling shared by the Flickr and VQA data modules
+
+        hub_cache_dir, local_files_only: Hugging Face cache dir and offline loading of the tokenizer of the token cache
+        bucket_by_length: batch samples of similar length together (BucketBatchSampler) to reduce padding.
+        data_seed: seed of the training batch order, with the epoch
+        '''
+
+        super().__init__()
+
+        self.train_batch_size = train_batch_size
+        self.eval_batch_size = eval_batch_size
+        self.transform = transform
+        self.num_workers = num_workers
+        self.image_embeddings_dir = image_embeddings_dir
+        self.embedding_store = None
+        self.pixel_cache_dir = pixel_cache_dir
+        self.pixel_transform = pixel_transform
+        self.pixel_cache = None
+        self.token_cache_dir = token_cache_dir
+        self.tokenizer_revision = tokenizer_revision
+        self.hub_cache_dir = hub_cache_dir
+        self.local_files_only = local_files_only
+        self.token_cache = None
+        self.bucket_by_length = bucket_by_length
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.epoch = 0
+        # First batch of the training epoch, set by the Trainer when it resumes an epoch
+        self.start_batch = 0
+        self.data_seed = data_seed
+
+    def _open_caches(self):
+
+        if self.image_embeddings_dir is not None and self.embedding_store is None:
+            self.embedding_store = ImageEmbeddingStore(self.image_embeddings_dir)
+        if self.pixel_cache_dir is not None and self.pixel_cache is None:
+            self.pixel_cache = PixelCache(self.pixel_cache_dir)
+        if self.token_cache_dir is not None and self.token_cache is None:
+            self.token_cache = TokenCache(self.token_cache_dir,
+                                          self.tokenizer.name_or_path,
+                                          self.tokenizer_revision,
+                                          hub_cache_dir=self.hub_cache_dir,
+                                          local_files_only=self.local_files_only)
+
+    def _dataset_kwargs(self):
+
+        '''
+        Dataset arguments for reading images and tokens. Images from the pixel cache are uint8 tensors,
+        so they get pixel_transform (e.g. tensor augmentations) instead of the PIL transform.
+        '''
+
+        return {'transform': self.pixel_transform if self.pixel_cache is not None else self.transform,
+                'embedding_store': self.embedding_store,
+                'pixel_cache': self.pixel_cache,
+                'token_cache': self.token_cache}
+
+    def _set_image_feature_extractor(self, image_feature_extractor):
+        self.image_feature_extractor = image_feature_extractor
+
+    def _set_tokenizer(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def _set_tokens(self, model):
+        self.start_token = model.start_token
+        self.end_token = model.end_token
+
+    def set_model_variables(self, model):
+
+        self._set_image_feature_extractor(model.image_feature_extractor)
+        self._set_tokenizer(model.tokenizer)
+
+    def _encode_images(self, image_tensors):
+
+        # Embeddings from the store are stacked as they are, the model skips the ViT for them
+        if self.embedding_store is not None:
+            return torch.stack(image_tensors)
+        if self.pixel_cache is not None:
+            return normalize_pixel_values(torch.stack(image_tensors),
+                                          self.image_feature_extractor.image_mean,
+                                          self.image_feature_extractor.image_std)
+        return self.image_feature_extractor(image_tensors, return_tensors='pt').pixel_values
+
+    def _encode_text(self, texts, text_tokens=None):
+
+        # Pre-tokenized ids only need padding
+        if text_tokens is not None:
+            return pad_token_ids(text_tokens, self.tokenizer.pad_token_id)
+        return self.tokenizer(
+            texts,
+            padding="longest",
+            truncation=True,
+            return_tensors="pt",
+        )
+
+    def _dataloader(self, dataset, batch_size, shuffle, collate_fn, shard=True, start_batch=0, pad_shards=True):
+
+        '''
+        Batch orders are seeded by data_seed and the epoch, so an epoch can be resumed (see trainer.py)
+        :param shard: in distributed training every rank reads its own shard of the batches
+        :param pad_shards: pad the shards to the same number of batches (training). Evaluation shards are not padded,
+        so that every sample is counted once.
+        :param start_batch: skip the batches before start_batch
+        '''
+
+        shard = shard and is_distributed()
+        if self.bucket_by_length:
+            sampler = BucketBatchSampler(dataset.sample_lengths(),
+                                         batch_size,
+                                         shuffle=shuffle,
+                                         bucket_size_multiplier=self.bucket_size_multiplier,
+                                         seed=self.data_seed,
+                                         epoch=self.epoch,
+                                         num_replicas=get_world_size() if shard else 1,
+                                         rank=get_rank() if shard else 0,
+                                         pad=pad_shards)
+        elif shard:
+            sampler = BatchSampler(distributed_sampler(dataset, shuffle, self.epoch, self.data_seed, pad=pad_shards),
+                                   batch_size,
+                                   drop_last=False)
+        else:
+            sampler = batch_sampler(dataset, batch_size, shuffle, self.data_seed + self.epoch)
+        return torch.utils.data.DataLoader(
+            dataset,
+            batch_sampler=SkipBatchSampler(sampler, start_batch),
+            num_workers=self.num_workers,
+            collate_fn=collate_fn,
+            # Worker seeds are not drawn from the global torch generator (dropout), which is restored on resume
+            generator=torch.Generator().manual_seed(self.data_seed + self.epoch)
+        )
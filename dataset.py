@@ -1,12 +1,16 @@
 from torch.utils.data import Dataset
+import numpy as np
 import torch
-from PIL import Image
 from torchvision.transforms import transforms
 from collections import OrderedDict
 import random
-import pytorch_lightning as pl
-from utils import calculate_number_of_mask_tokens
+import zlib
+from utils import calculate_number_of_mask_tokens, load_image
+from transformers import BatchEncoding
 from masking_stratergies import epoch_aware_mask, text_infilling
+from packed_strings import PackedStrings
+from token_store import pad_token_ids
+from data_module import DataModule
 
 class FlickrPredictionDataset(Dataset):
 
@@ -14,30 +18,51 @@ class FlickrPredictionDataset(Dataset):
                  image_files,
                  dataset,
                  transform=None,
+                 embedding_store=None,
+                 pixel_cache=None,
+                 token_cache=None,
                  ):
 
         self.image_dir = 'datasets/flickr30k_images/'
-        self.images, self.captions = [], []
+        captions, caption_counts = [], []
         for image in image_files:
-            self.images.append(image)
-            self.captions.append(dataset[image])
-        self.unique_images = image_files
+            captions += dataset[image]
+            caption_counts.append(len(dataset[image]))
+        self.images = PackedStrings.from_list(image_files)
+        self.captions = PackedStrings.from_list(captions)
+        self.caption_offsets = np.zeros(len(caption_counts) + 1, dtype=np.int64)
+        np.cumsum(caption_counts, out=self.caption_offsets[1:])
+        self.caption_tokens = None
+        if token_cache is not None:
+            self.caption_tokens = token_cache.tokens(self.captions, 'flickr30k_captions')
         self.transform = transform
+        self.embedding_store = embedding_store
+        self.pixel_cache = pixel_cache
 
     def __len__(self):
 
         return len(self.images)
 
+    def sample_lengths(self):
+
+        '''
+        Length of the longest caption of every image, in tokens if pre-tokenized else in bytes
+        '''
+
+        caption_lengths = self.caption_tokens.lengths() if self.caption_tokens is not None else self.captions.lengths()
+        return np.maximum.reduceat(caption_lengths, self.caption_offsets[:-1])
+
     def __getitem__(self, index):
         """
         Return Image, Caption, Image File Name
         """
 
-        caption = self.captions[index]
+        caption_indices = range(self.caption_offsets[index], self.caption_offsets[index + 1])
+        caption = [self.captions[i] for i in caption_indices]
         image_filename = self.images[index]
-        img = Image.open(self.image_dir + image_filename)
-        if self.transform:
-            img = self.transform(img)
+        img = load_image(image_filename, self.image_dir, self.transform, self.embedding_store, self.pixel_cache)
+        if self.caption_tokens is not None:
+            return img, caption, image_filename, [self.caption_tokens[i] for i in caption_indices]
         return img, caption, image_filename
 
 
@@ -47,34 +72,53 @@ class FlickrDataset(Dataset):
                  image_files,
                  dataset,
                  transform=None,
+                 embedding_store=None,
+                 pixel_cache=None,
+                 token_cache=None,
                  ):
 
         self.image_dir = 'datasets/flickr30k_images/'
-        self.images, self.captions = [], []
-        for image in image_files:
-            for caption in dataset[image]:
-                self.captions.append(caption)
-                self.images.append(image)
-        self.unique_images = image_files
+        captions, image_indices = [], []
+        for i, image in enumerate(image_files):
+            captions += dataset[image]
+            image_indices += [i] * len(dataset[image])
+        self.unique_images = PackedStrings.from_list(image_files)
+        self.captions = PackedStrings.from_list(captions)
+        self.image_indices = np.array(image_indices, dtype=np.int32)
+        self.caption_tokens = None
+        if token_cache is not None:
+            self.caption_tokens = token_cache.tokens(self.captions, 'flickr30k_captions')
         self.transform = transform
+        self.embedding_store = embedding_store
+        self.pixel_cache = pixel_cache
 
     def __len__(self):
 
-        return len(self.images)
+        return len(self.captions)
+
+    def sample_lengths(self):
+
+        '''
+        Caption length of every sample, in tokens if pre-tokenized else in bytes
+        '''
+
+        if self.caption_tokens is not None:
+            return self.caption_tokens.lengths()
+        return self.captions.lengths()
 
     def __getitem__(self, index):
         '''
         Return Image, Caption
         '''
         caption = self.captions[index]
-        image_filename = self.images[index]
-        img = Image.open(self.image_dir + image_filename)
-        if self.transform:
-            img = self.transform(img)
+        image_filename = self.unique_images[self.image_indices[index]]
+        img = load_image(image_filename, self.image_dir, self.transform, self.embedding_store, self.pixel_cache)
+        if self.caption_tokens is not None:
+            return img, caption, self.caption_tokens[index]
         return img, caption
 
 
-class FlickrDatasetModule(pl.LightningDataModule):
+class FlickrDatasetModule(DataModule):
 
     def _load_dataset(self):
 
@@ -96,9 +140,41 @@ class FlickrDatasetModule(pl.LightningDataModule):
                  predict_file=None,
                  multi_modal=False,
                  mask=False,
+                 image_embeddings_dir=None,
+                 pixel_cache_dir=None,
+                 pixel_transform=None,
+                 group_by_image=False,
+                 captions_per_image=5,
+                 token_cache_dir=None,
+                 tokenizer_revision='main',
+                 hub_cache_dir=None,
+                 local_files_only=False,
+                 bucket_by_length=False,
+                 bucket_size_multiplier=100,
+                 mask_seed=42,
+                 data_seed=42,
                  ):
 
-        super().__init__()
+        '''
+        group_by_image: yield every image once with captions_per_image captions, so the image is
+        decoded and encoded once per step instead of once per caption. Batch sizes then count images.
+        See DataModule for the other arguments.
+        '''
+
+        super().__init__(train_batch_size=train_batch_size,
+                         eval_batch_size=eval_batch_size,
+                         transform=transform,
+                         num_workers=num_workers,
+                         image_embeddings_dir=image_embeddings_dir,
+                         pixel_cache_dir=pixel_cache_dir,
+                         pixel_transform=pixel_transform,
+                         token_cache_dir=token_cache_dir,
+                         tokenizer_revision=tokenizer_revision,
+                         hub_cache_dir=hub_cache_dir,
+                         local_files_only=local_files_only,
+                         bucket_by_length=bucket_by_length,
+                         bucket_size_multiplier=bucket_size_multiplier,
+                         data_seed=data_seed)
 
         flickr_dataset = self._load_dataset()
         flickr_dataset_filenames = list(flickr_dataset.keys())
@@ -116,25 +192,29 @@ class FlickrDatasetModule(pl.LightningDataModule):
         self.train_filenames = train_dataset
         self.val_filenames = val_dataset
         self.test_filenames = test_dataset
-        self.train_batch_size = train_batch_size
-        self.eval_batch_size = eval_batch_size
-        self.transform = transform
-        self.num_workers = num_workers
         self.predict_file = predict_file
         self.multi_modal = multi_modal
         self.mask = mask
+        self.group_by_image = group_by_image
+        self.captions_per_image = captions_per_image
+        self.mask_seed = mask_seed
 
     def setup(self, stage=None):
 
+        self._open_caches()
+
+        # FlickrPredictionDataset already yields each image once with all of its captions
+        train_dataset_class = FlickrPredictionDataset if self.group_by_image else FlickrDataset
+
         if stage == 'fit' or stage is None:
-            self.train_dataset = FlickrDataset(self.train_filenames, self.dataset, self.transform)
-            self.val_dataset = FlickrDataset(self.val_filenames, self.dataset, self.transform)
+            self.train_dataset = train_dataset_class(self.train_filenames, self.dataset, **self._dataset_kwargs())
+            self.val_dataset = train_dataset_class(self.val_filenames, self.dataset, **self._dataset_kwargs())
 
         if stage == 'validate':
-            self.val_dataset = FlickrDataset(self.val_filenames, self.dataset, self.transform)
+            self.val_dataset = train_dataset_class(self.val_filenames, self.dataset, **self._dataset_kwargs())
 
         if stage == 'test':
-            self.test_dataset = FlickrDataset(self.test_filenames, self.dataset, self.transform)
+            self.test_dataset = FlickrDataset(self.test_filenames, self.dataset, **self._dataset_kwargs())
 
         if stage == 'predict':
             if self.predict_file is None:
@@ -146,54 +226,95 @@ class FlickrDatasetModule(pl.LightningDataModule):
             elif self.predict_file == 'test':
                 file_names = self.test_filenames
             self.median_length = calculate_number_of_mask_tokens(self.dataset, self.train_filenames)
-            self.predict_dataset = FlickrPredictionDataset(file_names, self.dataset, self.transform)
+            self.predict_dataset = FlickrPredictionDataset(file_names, self.dataset, **self._dataset_kwargs())
 
-    def _set_image_feature_extractor(self, image_feature_extractor):
-        self.image_feature_extractor = image_feature_extractor
+    def _mask_generator(self, caption_input_ids):
 
-    def _set_tokenizer(self, tokenizer):
-        self.tokenizer = tokenizer
+        '''
+        Random generator of the masking strategies for a batch, seeded by (mask_seed, epoch, batch token ids).
+        The masks of a batch are the same whichever worker or rank collates it, and when an epoch is resumed.
+        '''
+
+        batch_hash = zlib.crc32(caption_input_ids.numpy().tobytes())
+        seed = np.random.SeedSequence([self.mask_seed, self.epoch, batch_hash]).generate_state(1)[0]
+        return torch.Generator().manual_seed(int(seed))
 
-    def _set_tokens(self, model):
-        self.start_token = model.start_token
-        self.end_token = model.end_token
+    def _encode_input_text(self, caption_encodings, num_empty_inputs):
 
-    def set_model_variables(self, model):
+        '''
+        Input text of the multi modal model for the masking strategy.
+        The 'empty' mask gives num_empty_inputs rows, the other strategies mask the tokenized captions.
+        '''
 
-        self._set_image_feature_extractor(model.image_feature_extractor)
-        self._set_tokenizer(model.tokenizer)
+        if not self.mask:
+            return caption_encodings
+        # Masking strategies for input text
+        if self.mask == 'empty':
+            if self.token_cache is not None:
+                empty_tokens = np.array([self.tokenizer.bos_token_id, self.tokenizer.eos_token_id])
+                return pad_token_ids([empty_tokens] * num_empty_inputs, self.tokenizer.pad_token_id)
+            input_text = ['' for _ in range(num_empty_inputs)]
+            return self.tokenizer(input_text,
+                                  padding='longest',
+                                  return_tensors='pt')
+
+        special_token_ids = [self.tokenizer.bos_token_id, self.tokenizer.eos_token_id, self.tokenizer.pad_token_id]
+        if self.mask == 'epoch_aware_mask':
+            input_ids, attention_mask = epoch_aware_mask(self.epoch,
+                                                         caption_encodings.input_ids,
+                                                         caption_encodings.attention_mask,
+                                                         self.tokenizer.mask_token_id,
+                                                         special_token_ids,
+                                                         generator=self._mask_generator(caption_encodings.input_ids))
+        elif self.mask == 'text_infilling':
+            input_ids, attention_mask = text_infilling(caption_encodings.input_ids,
+                                                       caption_encodings.attention_mask,
+                                                       self.tokenizer.mask_token_id,
+                                                       special_token_ids,
+                                                       self.tokenizer.pad_token_id,
+                                                       generator=self._mask_generator(caption_encodings.input_ids))
+        return BatchEncoding({'input_ids': input_ids, 'attention_mask': attention_mask})
 
     def tokenize_data(self, batch_data):
 
         image_tensors = [t[0] for t in batch_data]
         captions = [t[1] for t in batch_data]
+        caption_tokens = [t[2] for t in batch_data] if self.token_cache is not None else None
 
-        image_encodings = self.image_feature_extractor(image_tensors, return_tensors='pt').pixel_values
-        caption_encodings = self.tokenizer(
-            captions,
-            padding="longest",
-            truncation=True,
-            return_tensors="pt",
-        )
+        image_encodings = self._encode_images(image_tensors)
+        caption_encodings = self._encode_text(captions, caption_tokens)
         if self.multi_modal:
-            if self.mask:
-                # Masking strategies for input text
-                if self.mask == 'empty':
-                    input_text = ['' for _ in batch_data]
-                elif self.mask == 'epoch_aware_mask':
-                    input_text = [epoch_aware_mask(self.epoch, x) for x in captions]
-                elif self.mask == 'text_infilling':
-                    input_text = [text_infilling(x) for x in captions]
-                input_text_encodings = self.tokenizer(input_text,
-                                                      padding='longest',
-                                                      return_tensors='pt')
-            else:
-                input_text_encodings = caption_encodings
+            input_text_encodings = self._encode_input_text(caption_encodings, len(batch_data))
             labels = caption_encodings
             return image_encodings, input_text_encodings, labels
         else:
             return image_encodings, caption_encodings
 
+    def tokenize_grouped_data(self, batch_data):
+
+        '''
+        Collate for image grouped training
+
+        :param batch_data: Each sample is (Image Tensor, Captions, Filename)
+        :return: (Image Pixel Values, Input Text Encodings, Label Text Encodings, Captions per Image)
+        Images and labels are aligned as repeat_interleave(images, captions_per_image).
+        When the input text is the same for all captions of an image ('empty' mask)
+        it is encoded once per image and has one row per image.
+        '''
+
+        image_tensors = [t[0] for t in batch_data]
+        captions, caption_tokens = [], []
+        for t in batch_data:
+            caption_indices = [i % len(t[1]) for i in range(self.captions_per_image)]
+            captions += [t[1][i] for i in caption_indices]
+            if self.token_cache is not None:
+                caption_tokens += [t[3][i] for i in caption_indices]
+
+        image_encodings = self._encode_images(image_tensors)
+        caption_encodings = self._encode_text(captions, caption_tokens if self.token_cache is not None else None)
+        input_text_encodings = self._encode_input_text(caption_encodings, len(batch_data))
+        return image_encodings, input_text_encodings, caption_encodings, self.captions_per_image
+
     def prediction_tokenization(self, batch_data):
 
         '''
@@ -206,7 +327,7 @@ class FlickrDatasetModule(pl.LightningDataModule):
         captions = [t[1] for t in batch_data]
         image_filenames = [t[2] for t in batch_data]
 
-        image_encodings = self.image_feature_extractor(image_tensors, return_tensors='pt').pixel_values
+        image_encodings = self._encode_images(image_tensors)
         if self.multi_modal:
             if self.mask == 'empty':
                 input_text = ['' for _ in batch_data]
@@ -215,7 +336,9 @@ class FlickrDatasetModule(pl.LightningDataModule):
             elif self.mask == 'epoch_aware_mask':
                 # input_text = [' '.join(['<mask>']*self.median_length) for _ in batch_data]
                 input_text = [' '.join(['<mask>'] * (len(cap[0].split(' ')))) for cap in captions]
+                # The number of masks differs between images
                 input_text_encodings = self.tokenizer(input_text,
+                                                      padding='longest',
                                                       return_tensors='pt')
             
             elif self.mask == 'text_infilling':
@@ -227,38 +350,27 @@ class FlickrDatasetModule(pl.LightningDataModule):
         else:
             return image_encodings, captions, image_filenames
 
+    def _training_collate_fn(self):
+
+        if self.group_by_image:
+            if not self.multi_modal:
+                raise ValueError('Image grouped training is only supported for the multi modal model')
+            return self.tokenize_grouped_data
+        return self.tokenize_data
+
     def train_dataloader(self):
-        return torch.utils.data.DataLoader(
-            self.train_dataset,
-            batch_size=self.train_batch_size,
-            shuffle=True,
-            num_workers=self.num_workers,
-            collate_fn=self.tokenize_data
-        )
+        return self._dataloader(self.train_dataset, self.train_batch_size, True, self._training_collate_fn(),
+                                start_batch=self.start_batch)
 
     def val_dataloader(self):
-        return torch.utils.data.DataLoader(
-            self.val_dataset,
-            batch_size=self.eval_batch_size,
-            shuffle=False,
-            num_workers=self.num_workers,
-            collate_fn=self.tokenize_data
-        )
+        return self._dataloader(self.val_dataset, self.eval_batch_size, False, self._training_collate_fn(),
+                                pad_shards=False)
 
     def test_dataloader(self):
-        return torch.utils.data.DataLoader(
-            self.test_dataset,
-            batch_size=self.eval_batch_size,
-            shuffle=False,
-            num_workers=self.num_workers,
-            collate_fn=self.tokenize_data
-        )
+        return self._dataloader(self.test_dataset, self.eval_batch_size, False, self.tokenize_data,
+                                pad_shards=False)
 
     def predict_dataloader(self):
-        return torch.utils.data.DataLoader(
-            self.predict_dataset,
-            shuffle=False,
-            batch_size=self.eval_batch_size,
-            num_workers=self.num_workers,
-            collate_fn=self.prediction_tokenization,
-        )
+        # Predictions are written by rank 0 alone
+        return self._dataloader(self.predict_dataset, self.eval_batch_size, False, self.prediction_tokenization,
+                                shard=False)
@@ -0,0 +1,147 @@
+import copy
+import re
+
+import torch
+from torch.nn import functional as F
+from transformers import BatchEncoding
+
+from modelling_bartMultiModal import BartMultiModalGenerationModel
+from multi_modal_module import MultiModalModel
+
+
+def distilled_layer_indices(num_teacher_layers, num_student_layers):
+
+    '''
+    Teacher decoder layers copied into the student: evenly spaced, first and last included
+    (6 -> 3 layers copies 0, 2, 5 like DistilBART)
+    '''
+
+    if num_student_layers == 1:
+        return [0]
+    return [round(i * (num_teacher_layers - 1) / (num_student_layers - 1)) for i in range(num_student_layers)]
+
+
+def student_config(teacher_config, decoder_layers, d_model=None):
+
+    '''
+    Teacher config with fewer decoder layers, and optionally a narrower d_model.
+    A narrower student projects the ViT embeddings to its d_model (image_embedding_dim).
+    '''
+
+    config = copy.deepcopy(teacher_config)
+    config.decoder_layers = decoder_layers
+    if d_model is not None and d_model != teacher_config.d_model:
+        config.image_embedding_dim = getattr(teacher_config, 'image_embedding_dim', None) or teacher_config.d_model
+        config.d_model = d_model
+        config.encoder_ffn_dim = config.decoder_ffn_dim = 4 * d_model
+        config.encoder_attention_heads = config.decoder_attention_heads = max(1, d_model // 64)
+    return config
+
+
+def initialize_student(teacher, config):
+
+    '''
+    Student with the same d_model: copy of the teacher with a subset of its decoder layers.
+    A narrower student starts from random weights.
+    '''
+
+    student = BartMultiModalGenerationModel(config)
+    # lm_head shares the embedding weights like in from_pretrained
+    student.tie_weights()
+    if config.d_model != teacher.config.d_model:
+        return student
+
+    layer_indices = distilled_layer_indices(teacher.config.decoder_layers, config.decoder_layers)
+    teacher_state = teacher.state_dict()
+    student_state = {}
+    for key in student.state_dict():
+        match = re.match(r'model\.decoder\.layers\.(\d+)\.(.*)', key)
+        if match:
+            teacher_key = f'model.decoder.layers.{layer_indices[int(match.group(1))]}.{match.group(2)}'
+        else:
+            teacher_key = key
+        student_state[key] = teacher_state[teacher_key]
+    student.load_state_dict(student_state)
+    return student
+
+
+def distillation_loss(student_logits, teacher_logits, labels, pad_token_id, temperature):
+
+    '''
+    KL divergence between the temperature softened teacher and student distributions,
+    averaged over the non padding label positions and scaled by temperature ** 2
+    '''
+
+    mask = labels != pad_token_id
+    student_log_probs = F.log_softmax(student_logits[mask].float() / temperature, dim=-1)
+    teacher_log_probs = F.log_softmax(teacher_logits[mask].float() / temperature, dim=-1)
+    kl = F.kl_div(student_log_probs, teacher_log_probs, log_target=True, reduction='batchmean')
+    return kl * temperature ** 2
+
+
+class DistillationModel(MultiModalModel):
+
+    def __init__(self,
+                 teacher_ckpt,
+                 student_decoder_layers=2,
+                 student_d_model=None,
+                 temperature=2.0,
+                 alpha=0.5,
+                 sequence_level=False,
+                 **kwargs):
+
+        '''
+        Train a shallow decoder (and optionally narrower) student BartMultiModalGenerationModel
+        from a trained MultiModal checkpoint. self.model is the student, so checkpoints saved during
+        training are regular MultiModal checkpoints (MultiModalModel(model_ckpt=...)).
+
+        :param teacher_ckpt: trained MultiModal checkpoint
+        :param student_decoder_layers: decoder layers of the student, copied from the teacher when d_model is the same
+        :param student_d_model: narrower d_model for the student (randomly initialized), teacher d_model if None
+        :param temperature: softmax temperature of the soft logits
+        :param alpha: weight of the cross entropy on the labels, 1 - alpha for the soft logits
+        :param sequence_level: train on the teacher beam search captions instead of the references
+        (sequence-level distillation), generated for every batch
+        :param kwargs: MultiModalModel parameters
+        '''
+
+        # Used by build_model, the student is set up for training (device, DistributedDataParallel,
+        # optimizer, gradient hooks) by MultiModalModel and the teacher is never wrapped or optimized
+        self.student_decoder_layers = student_decoder_layers
+        self.student_d_model = student_d_model
+        super().__init__(teacher_ckpt, **kwargs)
+        self.temperature = temperature
+        self.alpha = alpha
+        self.sequence_level = sequence_level
+
+    def build_model(self, model):
+
+        # The loaded checkpoint is the teacher
+        self.teacher = model.eval().requires_grad_(False).to(self.device)
+        return initialize_student(self.teacher, student_config(self.teacher.config,
+                                                               self.student_decoder_layers,
+                                                               self.student_d_model))
+
+    def training_loss(self, batch_data):
+
+        image_embeddings = self.get_image_embeddings(batch_data[0].to(self.device))
+        if self.sequence_level:
+            input_encodings = batch_data[1].to(self.device)
+            with torch.no_grad(), self.profiler.phase('generate'):
+                generated_ids = self.teacher.generate(input_ids=input_encodings.input_ids,
+                                                      attention_mask=input_encodings.attention_mask,
+                                                      image_embeddings=image_embeddings,
+                                                      num_beams=self.beam_size,
+                                                      max_length=24)
+            # Drop decoder_start_token_id, the labels start with <s> like the tokenized captions
+            batch_data = (batch_data[0], input_encodings, BatchEncoding({'input_ids': generated_ids[:, 1:].contiguous()}))
+
+        outputs = self.forward_batch(batch_data, image_embeddings=image_embeddings)
+        with torch.no_grad():
+            teacher_outputs = self.forward_batch(batch_data, model=self.teacher, image_embeddings=image_embeddings)
+        soft_loss = distillation_loss(outputs.logits,
+                                      teacher_outputs.logits,
+                                      batch_data[2].input_ids.to(self.device),
+                                      self.model.config.pad_token_id,
+                                      self.temperature)
+        return self.alpha * outputs.loss + (1 - self.alpha) * soft_loss
@@ -0,0 +1,169 @@
+import contextlib
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DistributedSampler
+
+'''
+Data parallel training with torch.distributed, launched with torchrun (one process per rank):
+    torchrun --nproc_per_node 4 experiments.py ...
+    torchrun --nnodes 2 --nproc_per_node 4 --rdzv_backend c10d --rdzv_endpoint host:29500 experiments.py ...
+The gloo backend runs on CPU only nodes. Every rank trains on its shard of the batches,
+DistributedDataParallel averages the gradients, validation losses are averaged over all samples of the ranks
+and only rank 0 logs and writes checkpoints.
+Without torchrun (no WORLD_SIZE in the environment) everything runs in a single process as before.
+'''
+
+
+def init_distributed(backend='gloo'):
+
+    '''
+    Join the process group when launched by torchrun
+    :return: True if running distributed
+    '''
+
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False
+    if backend == 'nccl':
+        if not torch.cuda.is_available():
+            raise ValueError('The nccl backend needs GPUs, use gloo on CPU only nodes')
+        # NCCL collectives and the object collectives run on the current device, the GPU of the local rank
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+    if not dist.is_initialized():
+        dist.init_process_group(backend)
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def get_device():
+
+    '''
+    The GPU of the local rank if there are GPUs, otherwise the CPU
+    '''
+
+    if torch.cuda.is_available():
+        return f"cuda:{int(os.environ.get('LOCAL_RANK', 0))}"
+    return 'cpu'
+
+
+def collective_device():
+
+    '''
+    Device of the tensors of the collectives, NCCL only reduces CUDA tensors
+    '''
+
+    if is_distributed() and dist.get_backend() == 'nccl':
+        return torch.device(get_device())
+    return torch.device('cpu')
+
+
+def wrap_model(model, find_unused_parameters=False):
+
+    '''
+    DistributedDataParallel around a model with trainable parameters, the model itself otherwise
+    '''
+
+    if not is_distributed() or not any(p.requires_grad for p in model.parameters()):
+        return model
+    device_ids = [model.device] if next(model.parameters()).is_cuda else None
+    return DistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=find_unused_parameters)
+
+
+def unwrap_model(model):
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+@contextlib.contextmanager
+def gradient_sync(sync, *models):
+
+    '''
+    Skip the gradient all-reduce of the DistributedDataParallel models when sync is False,
+    used for the micro-batches of gradient accumulation before the optimizer step
+    '''
+
+    with contextlib.ExitStack() as stack:
+        if not sync:
+            for model in models:
+                if isinstance(model, DistributedDataParallel):
+                    stack.enter_context(model.no_sync())
+        yield
+
+
+def all_reduce_sum(*values):
+
+    '''
+    Sums of python numbers over the ranks
+    '''
+
+    if not is_distributed():
+        return values
+    tensor = torch.tensor(values, dtype=torch.float64, device=collective_device())
+    dist.all_reduce(tensor)
+    return tuple(tensor.tolist())
+
+
+def broadcast_object(obj):
+
+    '''
+    obj of rank 0 on every rank
+    '''
+
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def all_gather_object(obj):
+
+    '''
+    List of obj of every rank
+    '''
+
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def distributed_sampler(dataset, shuffle, epoch, seed=42, pad=True):
+
+    '''
+    Shard of the dataset of this rank
+    :param pad: the shards have the same number of samples, padded with repeated samples (training).
+    Otherwise every sample is in exactly one shard and the shards differ by at most one sample (evaluation).
+    '''
+
+    if not pad:
+        if shuffle:
+            indices = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(seed + epoch)).tolist()
+        else:
+            indices = list(range(len(dataset)))
+        return indices[get_rank()::get_world_size()]
+    sampler = DistributedSampler(dataset, shuffle=shuffle, seed=seed)
+    sampler.set_epoch(epoch)
+    return sampler
@@ -0,0 +1,166 @@
+import glob
+import json
+import os
+
+import numpy as np
+import torch
+
+from packed_strings import PackedIndex
+
+
+class ImageEmbeddingStore:
+
+    '''
+    Sharded, memory-mapped store of ViT last_hidden_state embeddings.
+    Every shard is a fp16 .npy file of shape (shard_size, num_tokens, hidden_size).
+    A PackedIndex (files_<version>_*.npy) maps image filename -> (shard, row) and index.json holds its version,
+    so new images are appended to the last shard (or a new one) without rebuilding the store.
+    '''
+
+    index_file = 'index.json'
+    index_columns = ['shard', 'row']
+
+    def __init__(self, store_dir):
+
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, self.index_file), 'r') as f:
+            index = json.load(f)
+        self.num_tokens = index['num_tokens']
+        self.hidden_size = index['hidden_size']
+        self.shard_size = index['shard_size']
+        self.shard_rows = index['shard_rows']
+        self.version = index['version']
+        self.files = PackedIndex.load(self._files_prefix(self.version), self.index_columns)
+        # Images added since the last flush, image filename -> (shard, row)
+        self.new_files = {}
+        self._shards = {}
+
+    @classmethod
+    def create(cls, store_dir, num_tokens=197, hidden_size=768, shard_size=4096):
+        """
+        Create an empty store or open the existing one in store_dir
+        """
+
+        if os.path.exists(os.path.join(store_dir, cls.index_file)):
+            return cls(store_dir)
+        os.makedirs(store_dir, exist_ok=True)
+        PackedIndex.from_lists([], shard=[], row=[]).save(os.path.join(store_dir, 'files_0'))
+        index = {'num_tokens': num_tokens,
+                 'hidden_size': hidden_size,
+                 'shard_size': shard_size,
+                 'shard_rows': [],
+                 'version': 0}
+        cls._write_index(store_dir, index)
+        return cls(store_dir)
+
+    @classmethod
+    def _write_index(cls, store_dir, index):
+
+        # Write to a temporary file and rename so that readers never see a partial index
+        tmp_file = os.path.join(store_dir, cls.index_file + '.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_file, os.path.join(store_dir, cls.index_file))
+
+    def _files_prefix(self, version):
+        return os.path.join(self.store_dir, f'files_{version}')
+
+    def _shard_path(self, shard):
+        return os.path.join(self.store_dir, f'shard_{shard:05d}.npy')
+
+    def _shard(self, shard):
+
+        # Memory maps are opened lazily so that every DataLoader worker maps its own view
+        if shard not in self._shards:
+            self._shards[shard] = np.load(self._shard_path(shard), mmap_mode='r')
+        return self._shards[shard]
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.files) + len(self.new_files)
+
+    def __contains__(self, image_filename):
+        return image_filename in self.new_files or image_filename in self.files
+
+    def __getitem__(self, image_filename):
+        '''
+        Return fp16 tensor of shape (num_tokens, hidden_size)
+        '''
+        if image_filename in self.new_files:
+            shard, row = self.new_files[image_filename]
+        else:
+            shard, row = self.files[image_filename]
+        return torch.from_numpy(np.array(self._shard(shard)[row]))
+
+    def add(self, image_filenames, embeddings):
+
+        '''
+        Append embeddings of new images to the store, flush writes them to the index
+
+        :param image_filenames: list of image filenames
+        :param embeddings: array/tensor of shape (len(image_filenames), num_tokens, hidden_size)
+        :return: None
+        '''
+
+        if isinstance(embeddings, torch.Tensor):
+            embeddings = embeddings.detach().cpu().numpy()
+        embeddings = embeddings.astype(np.float16)
+
+        written = 0
+        while written < len(image_filenames):
+            if not self.shard_rows or self.shard_rows[-1] == self.shard_size:
+                np.lib.format.open_memmap(self._shard_path(len(self.shard_rows)),
+                                          mode='w+',
+                                          dtype=np.float16,
+                                          shape=(self.shard_size, self.num_tokens, self.hidden_size))
+                self.shard_rows.append(0)
+            shard = len(self.shard_rows) - 1
+            start = self.shard_rows[shard]
+            count = min(self.shard_size - start, len(image_filenames) - written)
+
+            self._shards.pop(shard, None)
+            shard_array = np.load(self._shard_path(shard), mmap_mode='r+')
+            shard_array[start:start + count] = embeddings[written:written + count]
+            shard_array.flush()
+            del shard_array
+
+            for row, image_filename in enumerate(image_filenames[written:written + count]):
+                self.new_files[image_filename] = (shard, start + row)
+            self.shard_rows[shard] = start + count
+            written += count
+            # The index is written with every full shard, so an interrupted build keeps the full shards
+            if self.shard_rows[shard] == self.shard_size:
+                self.flush()
+
+    def flush(self):
+
+        '''
+        Write the index, call it when all embeddings have been added. Images added since the last flush
+        are not in the store for new readers until then.
+        '''
+
+        if not self.new_files:
+            return
+        keys, columns = self.files.items()
+        files = dict(zip(keys, zip(columns['shard'], columns['row'])))
+        files.update(self.new_files)
+        version = self.version + 1
+        PackedIndex.from_lists(list(files),
+                               shard=[shard for shard, _ in files.values()],
+                               row=[row for _, row in files.values()]).save(self._files_prefix(version))
+        self._write_index(self.store_dir, {'num_tokens': self.num_tokens,
+                                           'hidden_size': self.hidden_size,
+                                           'shard_size': self.shard_size,
+                                           'shard_rows': self.shard_rows,
+                                           'version': version})
+        # Readers that opened the store before keep their mapping of the old index files
+        for path in glob.glob(self._files_prefix(self.version) + '_*.npy'):
+            os.remove(path)
+        self.version = version
+        self.files = PackedIndex.load(self._files_prefix(version), self.index_columns)
+        self.new_files = {}
@@ -1,10 +1,10 @@
 from trainer import Trainer
-from baseline_module import BaselineModel
-from multi_modal_module import MultiModalModel
-from dataset import FlickrDatasetModule
-from vqa_dataset import VQADatasetModule
+from distributed import init_distributed
 import argparse
 
+# Models and datasets are imported when they are used, so only the modules of the chosen model,
+# dataset and logger are loaded
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
@@ -14,21 +14,141 @@ if __name__ == '__main__':
     parser.add_argument('--mask', type=str, default='empty', choices=['empty', 'epoch_aware_mask','text_infilling'])
     parser.add_argument('--model_ckpt', type=str, required=False)
     parser.add_argument('--predict', type=str, default=None)
+    parser.add_argument('--image_embeddings_dir', type=str, default=None)
+    parser.add_argument('--pixel_cache_dir', type=str, default=None)
+    parser.add_argument('--group_by_image', action='store_true')
+    parser.add_argument('--annotation_cache_dir', type=str, default=None)
+    parser.add_argument('--token_cache_dir', type=str, default=None)
+    parser.add_argument('--bucket_by_length', action='store_true')
+    parser.add_argument('--vision_encoder_policy', type=str, default='frozen', choices=['frozen', 'last_n', 'trainable'])
+    parser.add_argument('--num_trainable_vision_layers', type=int, default=0)
+    parser.add_argument('--num_visual_tokens', type=int, default=None)
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--train_batch_size', type=int, default=16)
+    parser.add_argument('--gradient_accumulation_steps', type=int, default=1)
+    parser.add_argument('--gradient_checkpointing', action='store_true')
+    parser.add_argument('--quantized', action='store_true', help='int8 dynamic quantized CPU inference')
+    parser.add_argument('--template_decoding', action='store_true',
+                        help='keep the words of the masked input text and only generate the <mask> spans')
+
+    parser.add_argument('--student_decoder_layers', type=int, default=2)
+    parser.add_argument('--student_d_model', type=int, default=None)
+    parser.add_argument('--distillation_temperature', type=float, default=2.0)
+    parser.add_argument('--distillation_alpha', type=float, default=0.5)
+    parser.add_argument('--sequence_level_distillation', action='store_true')
+    parser.add_argument('--async_checkpoints', action='store_true',
+                        help='write checkpoints as safetensors in a background thread')
+    parser.add_argument('--checkpoint_dtype', type=str, default='fp32', choices=['fp32', 'fp16'])
+    parser.add_argument('--trainable_only_checkpoints', action='store_true')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time per phase and samples per second of every train, val and predict loop')
+    parser.add_argument('--profile_trace_dir', type=str, default=None,
+                        help='export torch.profiler Chrome traces of the first train, val and predict loops')
+    parser.add_argument('--resume', type=str, default=None,
+                        help='checkpoint version dir of an interrupted run, continued at the batch of its training state')
+    parser.add_argument('--state_save_steps', type=int, default=None,
+                        help='save the training state every n optimizer steps (and at the end of every epoch)')
+    parser.add_argument('--logger', type=str, nargs='+', default=['wandb'], choices=['wandb', 'jsonl', 'none'],
+                        help='metric loggers, e.g. --logger wandb jsonl')
+    parser.add_argument('--metrics_file', type=str, default='metrics.jsonl', help='file of the jsonl logger')
+    parser.add_argument('--watch_gradients', action='store_true',
+                        help='log gradient histograms with wandb.watch (adds hooks to every backward)')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Hugging Face cache dir of the pretrained ViT, BART and tokenizers')
+    parser.add_argument('--local_files_only', action='store_true',
+                        help='load the pretrained ViT, BART and tokenizers from the cache without requests to the hub')
+    parser.add_argument('--dist_backend', type=str, default='gloo', choices=['gloo', 'nccl'],
+                        help='torch.distributed backend when launched with torchrun')
 
     args = parser.parse_args()
 
+    if init_distributed(args.dist_backend) and args.model_name not in ['MultiModal', 'Distillation']:
+        raise ValueError('Distributed training is supported for the MultiModal and Distillation models')
+
+    hub_kwargs = {'cache_dir': args.cache_dir, 'local_files_only': args.local_files_only}
+    mode = 'predict' if args.predict else 'train'
     if args.model_name == 'MultiModal':
-        model = MultiModalModel(args.model_ckpt)
+        from multi_modal_module import MultiModalModel
+        model = MultiModalModel(args.model_ckpt,
+                                vision_encoder_policy=args.vision_encoder_policy,
+                                num_trainable_vision_layers=args.num_trainable_vision_layers,
+                                num_visual_tokens=args.num_visual_tokens,
+                                precision=args.precision,
+                                gradient_accumulation_steps=args.gradient_accumulation_steps,
+                                gradient_checkpointing=args.gradient_checkpointing,
+                                quantized=args.quantized,
+                                template_decoding=args.template_decoding,
+                                async_checkpoints=args.async_checkpoints,
+                                checkpoint_dtype=args.checkpoint_dtype,
+                                trainable_only_checkpoints=args.trainable_only_checkpoints,
+                                profile=args.profile,
+                                profile_trace_dir=args.profile_trace_dir,
+                                mode=mode,
+                                logger=args.logger,
+                                metrics_file=args.metrics_file,
+                                watch_gradients=args.watch_gradients,
+                                **hub_kwargs)
+    elif args.model_name == 'Distillation':
+        from distillation_module import DistillationModel
+        # model_ckpt is the teacher
+        model = DistillationModel(args.model_ckpt,
+                                  student_decoder_layers=args.student_decoder_layers,
+                                  student_d_model=args.student_d_model,
+                                  temperature=args.distillation_temperature,
+                                  alpha=args.distillation_alpha,
+                                  sequence_level=args.sequence_level_distillation,
+                                  vision_encoder_policy=args.vision_encoder_policy,
+                                  num_trainable_vision_layers=args.num_trainable_vision_layers,
+                                  precision=args.precision,
+                                  gradient_accumulation_steps=args.gradient_accumulation_steps,
+                                  gradient_checkpointing=args.gradient_checkpointing,
+                                  async_checkpoints=args.async_checkpoints,
+                                  checkpoint_dtype=args.checkpoint_dtype,
+                                  trainable_only_checkpoints=args.trainable_only_checkpoints,
+                                  profile=args.profile,
+                                  profile_trace_dir=args.profile_trace_dir,
+                                  logger=args.logger,
+                                  metrics_file=args.metrics_file,
+                                  watch_gradients=args.watch_gradients,
+                                  **hub_kwargs)
     else:
-        model = BaselineModel(args.model_ckpt)
+        from baseline_module import BaselineModel
+        model = BaselineModel(args.model_ckpt,
+                              vision_encoder_policy=args.vision_encoder_policy,
+                              num_trainable_vision_layers=args.num_trainable_vision_layers,
+                              precision=args.precision,
+                              gradient_accumulation_steps=args.gradient_accumulation_steps,
+                              gradient_checkpointing=args.gradient_checkpointing,
+                              mode=mode,
+                              logger=args.logger,
+                              metrics_file=args.metrics_file,
+                              watch_gradients=args.watch_gradients,
+                              **hub_kwargs)
     if args.dataset == 'flickr':
+        from dataset import FlickrDatasetModule
         dataset = FlickrDatasetModule(multi_modal=args.multi_modal,
                                       mask=args.mask,
                                       predict_file=args.predict,
-                                      eval_batch_size=1 if args.predict else 32)
+                                      train_batch_size=args.train_batch_size,
+                                      eval_batch_size=1 if args.predict else 32,
+                                      image_embeddings_dir=args.image_embeddings_dir,
+                                      pixel_cache_dir=args.pixel_cache_dir,
+                                      group_by_image=args.group_by_image,
+                                      token_cache_dir=args.token_cache_dir,
+                                      hub_cache_dir=args.cache_dir,
+                                      local_files_only=args.local_files_only,
+                                      bucket_by_length=args.bucket_by_length)
     else:
-        dataset = VQADatasetModule()
-    trainer = Trainer(model, dataset)
+        from vqa_dataset import VQADatasetModule
+        dataset = VQADatasetModule(train_batch_size=args.train_batch_size,
+                                   image_embeddings_dir=args.image_embeddings_dir,
+                                   pixel_cache_dir=args.pixel_cache_dir,
+                                   annotation_cache_dir=args.annotation_cache_dir,
+                                   token_cache_dir=args.token_cache_dir,
+                                   hub_cache_dir=args.cache_dir,
+                                   local_files_only=args.local_files_only,
+                                   bucket_by_length=args.bucket_by_length)
+    trainer = Trainer(model, dataset, resume=args.resume, state_save_steps=args.state_save_steps)
     if args.predict:
         trainer.inference()
     else:
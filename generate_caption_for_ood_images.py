@@ -1,25 +1,32 @@
 import argparse
 
+import torch
 from PIL import Image
-from torchvision import transforms
-from transformers import ViTFeatureExtractor, ViTModel, BartTokenizer
 
 from multi_modal_module import MultiModalModel
 
 
-def generate_caption(model_ckpt, image_location, mask):
+def generate_caption(model_ckpt, image_location, mask, quantized=False, template=False,
+                     cache_dir=None, local_files_only=False):
 
-    model = MultiModalModel(model_ckpt)
+    # Only the inference components are built: no optimizer, logger or gradient hooks
+    model = MultiModalModel(model_ckpt,
+                            quantized=quantized,
+                            mode='predict',
+                            logger='none',
+                            cache_dir=cache_dir,
+                            local_files_only=local_files_only)
 
     image = image_location
 
-    vision_feature_extractor = ViTFeatureExtractor.from_pretrained('google/vit-base-patch16-224-in21k')
-    vision_model = ViTModel.from_pretrained('google/vit-base-patch16-224-in21k')
-    images = [transforms.PILToTensor()(Image.open(image))]
-    image_features = vision_feature_extractor(images, return_tensors='pt').pixel_values
-    img_embed = vision_model(
-        image_features
-    )
+    # The ViT of the model is used, so a quantized model also runs a quantized ViT.
+    # The feature extractor resizes PIL images itself, without converting them to tensors first.
+    images = [Image.open(image).convert('RGB')]
+    image_features = model.image_feature_extractor(images, return_tensors='pt').pixel_values
+    with torch.no_grad():
+        img_embed = model.image_model(
+            image_features.to(model.device)
+        )
 
     # Alter Input text for different masking options to get controlled caption generation
     if mask == 'empty':
@@ -28,16 +35,18 @@ def generate_caption(model_ckpt, image_location, mask):
         input_text = ['A squirrel <mask> nuts <mask> <mask>']
     else:
         input_text = ['<mask> gun <mask>']
-    tokenizer = BartTokenizer.from_pretrained('facebook/bart-base')
+    tokenizer = model.tokenizer
     input_ids = tokenizer(
         input_text,
         padding='longest',
         return_tensors='pt').input_ids
-    o = model.model.generate(input_ids=input_ids,
-                             image_embeddings=img_embed.last_hidden_state,
-                             num_beams=5,
-                             max_length=32
-                             )
+    with torch.no_grad():
+        o = model.model.generate(input_ids=input_ids.to(model.device),
+                                 image_embeddings=img_embed.last_hidden_state,
+                                 num_beams=5,
+                                 max_length=32,
+                                 template_mask_token_id=tokenizer.mask_token_id if template else None
+                                 )
     text = tokenizer.batch_decode(o,
                                   skip_special_tokens=True,
                                   clean_up_tokenization_spaces=False)
@@ -51,6 +60,14 @@ if __name__ == '__main__':
     parser.add_argument('--mask', type=str, default='empty', choices=['empty', 'epoch_aware_mask'])
     parser.add_argument('--model_ckpt', type=str, required=True)
     parser.add_argument('--image_location', type=str, required=True)
+    parser.add_argument('--quantized', action='store_true', help='int8 dynamic quantized CPU inference')
+    parser.add_argument('--template', action='store_true',
+                        help='keep the words of the input text and only generate the <mask> spans')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Hugging Face cache dir of the pretrained ViT and BART')
+    parser.add_argument('--local_files_only', action='store_true',
+                        help='load the pretrained ViT and BART from the cache without requests to the hub')
 
     args = parser.parse_args()
-    generate_caption(args.model_ckpt, args.image_location, args.mask)
\ No newline at end of file
+    generate_caption(args.model_ckpt, args.image_location, args.mask, args.quantized, args.template,
+                     args.cache_dir, args.local_files_only)
\ No newline at end of file
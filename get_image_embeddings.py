@@ -1,47 +1,101 @@
+import argparse
+
 import torch
+from torch.utils.data import Dataset
 from transformers import (
     ViTFeatureExtractor,
     ViTModel
 )
 from PIL import Image
-import pickle
 from torchvision.transforms import transforms
+from tqdm import tqdm
+
+from embedding_store import ImageEmbeddingStore
+from utils import flickr_image_files, vqa_image_files
+
+
+class ImageFileDataset(Dataset):
+
+    def __init__(self, image_dir, image_files):
 
-vision_feature_extractor = ViTFeatureExtractor.from_pretrained('google/vit-base-patch16-224-in21k')
-vision_model = ViTModel.from_pretrained('google/vit-base-patch16-224-in21k')
-vision_model.eval()
+        self.image_dir = image_dir
+        self.image_files = image_files
+        self.transform = transforms.PILToTensor()
 
+    def __len__(self):
+        return len(self.image_files)
 
-def image_features(name,d):
+    def __getitem__(self, index):
+        image_filename = self.image_files[index]
+        img = Image.open(self.image_dir + image_filename).convert('RGB')
+        return self.transform(img), image_filename
+
+
+def build_embedding_store(image_dir,
+                          image_files,
+                          store_dir,
+                          image_encoder='google/vit-base-patch16-224-in21k',
+                          batch_size=64,
+                          num_workers=12):
 
     '''
-    Function to Get Image Embeddings
+    Function to Get Image Embeddings of all images and write them to an ImageEmbeddingStore
 
-    :param name: image filename
-    :param d: dictionary to save image embeddings
-    :return: None
+    :param image_dir: directory containing the images
+    :param image_files: image filenames in image_dir
+    :param store_dir: directory of the embedding store. Images already in the store are skipped
+    :return: ImageEmbeddingStore
     '''
 
-    images = transforms.PILToTensor()(Image.open('datasets/flickr30k_images/'+name))
-    inputs = vision_feature_extractor(images, return_tensors="pt").pixel_values
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    vision_feature_extractor = ViTFeatureExtractor.from_pretrained(image_encoder)
+    vision_model = ViTModel.from_pretrained(image_encoder)
+    vision_model.to(device)
+    vision_model.eval()
+
+    store = ImageEmbeddingStore.create(store_dir,
+                                       num_tokens=(vision_model.config.image_size
+                                                   // vision_model.config.patch_size) ** 2 + 1,
+                                       hidden_size=vision_model.config.hidden_size)
+    new_image_files = [x for x in image_files if x not in store]
+    if not new_image_files:
+        return store
+
+    dataloader = torch.utils.data.DataLoader(
+        ImageFileDataset(image_dir, new_image_files),
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+        collate_fn=lambda batch: ([t[0] for t in batch], [t[1] for t in batch]),
+    )
     with torch.no_grad():
-        outputs = vision_model(
-            inputs
-        ).last_hidden_state
-    d[name] = outputs.detach().numpy()
+        for images, filenames in tqdm(dataloader, desc=f'Embedding {image_dir}'):
+            inputs = vision_feature_extractor(images, return_tensors="pt").pixel_values.to(device)
+            outputs = vision_model(inputs).last_hidden_state
+            store.add(filenames, outputs)
+    store.flush()
+    return store
+
 
 if __name__ == '__main__':
 
-    data = open('datasets/flickr30k/results_20130124.token', 'r').read().splitlines()
-    image_filenames = [x.split('#')[0] for x in data]
-    image_filenames = list(set(image_filenames))[:10]
-    d = {}
-    for img in image_filenames:
-        image_features(img, d)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='flickr', choices=['flickr', 'vqa'])
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'val'])
+    parser.add_argument('--store_dir', type=str, default=None)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=12)
 
-    with open('datasets/flickr30k/image_embeddings.pickle', 'wb') as handle:
-        pickle.dump(d, handle)
+    args = parser.parse_args()
 
-    # with open('datasets/flickr30k/image_embeddings.pickle', 'rb') as handle:
-    #     d = pickle.load(handle)
-    # print()
\ No newline at end of file
+    if args.dataset == 'flickr':
+        store_dir = args.store_dir or 'datasets/image_embeddings/flickr30k'
+        build_embedding_store('datasets/flickr30k_images/', flickr_image_files(), store_dir,
+                              batch_size=args.batch_size, num_workers=args.num_workers)
+    else:
+        # All VQA splits share one store, COCO filenames are unique across splits
+        store_dir = args.store_dir or 'datasets/image_embeddings/vqa'
+        for split in args.splits:
+            image_dir = f'datasets/vqa_images/{split}/'
+            build_embedding_store(image_dir, vqa_image_files(image_dir), store_dir,
+                                  batch_size=args.batch_size, num_workers=args.num_workers)
@@ -0,0 +1,171 @@
+import json
+import os
+import time
+
+from distributed import is_main_process
+
+LOGGERS = ['wandb', 'jsonl', 'none']
+
+
+class NullTable:
+
+    def add_data(self, *data):
+        pass
+
+
+class NullLogger:
+
+    '''
+    Logger that drops everything, used without logging and on the non main ranks in distributed training
+    '''
+
+    def log(self, metrics):
+        pass
+
+    def watch(self, model, log_freq):
+        pass
+
+    def table(self, columns=None, data=None):
+        return NullTable()
+
+    def image(self, path):
+        return None
+
+    def histogram(self, table, value):
+        return None
+
+
+class WandbLogger:
+
+    def __init__(self, project, entity=None):
+
+        '''
+        Logs metrics, prediction tables and gradients (watch) to Weights & Biases.
+        wandb is imported here, so it is only needed (and its import time paid) when it is used.
+        '''
+
+        try:
+            import wandb
+        except ImportError as error:
+            raise ImportError('The wandb logger needs wandb: pip install wandb, or run with --logger none') from error
+        self.wandb = wandb
+        wandb.init(project=project, entity=entity)
+
+    def log(self, metrics):
+        self.wandb.log(metrics)
+
+    def watch(self, model, log_freq):
+        self.wandb.watch(model, log_freq=log_freq)
+
+    def table(self, columns=None, data=None):
+        return self.wandb.Table(columns=columns, data=data)
+
+    def image(self, path):
+        return self.wandb.Image(path)
+
+    def histogram(self, table, value):
+        return self.wandb.plot.histogram(table, value)
+
+
+class RowTable:
+
+    def __init__(self, columns=None, data=None):
+        self.columns = columns
+        self.data = [list(row) for row in data] if data is not None else []
+
+    def add_data(self, *data):
+        self.data.append(list(data))
+
+
+class JsonlLogger:
+
+    def __init__(self, path):
+
+        '''
+        Appends every record as a json line with its wall clock time to path.
+        Tables are written as {'columns': [...], 'data': [[...]]} and images as their path.
+        '''
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+
+    def log(self, metrics):
+        record = dict(metrics, time=time.time())
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=lambda value: vars(value)) + '\n')
+
+    def watch(self, model, log_freq):
+        pass
+
+    def table(self, columns=None, data=None):
+        return RowTable(columns, data)
+
+    def image(self, path):
+        return path
+
+    def histogram(self, table, value):
+        return table
+
+
+class PerLogger:
+
+    '''
+    Table, image or histogram of every logger of a LoggerGroup
+    '''
+
+    def __init__(self, values):
+        self.values = values
+
+    def add_data(self, *data):
+        for i, table in enumerate(self.values):
+            table.add_data(*[value.values[i] if isinstance(value, PerLogger) else value for value in data])
+
+
+class LoggerGroup:
+
+    def __init__(self, loggers):
+
+        '''
+        Logs every record to all loggers
+        '''
+
+        self.loggers = loggers
+
+    def log(self, metrics):
+        for i, logger in enumerate(self.loggers):
+            logger.log({name: value.values[i] if isinstance(value, PerLogger) else value
+                        for name, value in metrics.items()})
+
+    def watch(self, model, log_freq):
+        for logger in self.loggers:
+            logger.watch(model, log_freq)
+
+    def table(self, columns=None, data=None):
+        return PerLogger([logger.table(columns, data) for logger in self.loggers])
+
+    def image(self, path):
+        return PerLogger([logger.image(path) for logger in self.loggers])
+
+    def histogram(self, table, value):
+        return PerLogger([logger.histogram(logger_table, value)
+                          for logger, logger_table in zip(self.loggers, table.values)])
+
+
+def create_logger(names, project, entity=None, metrics_file='metrics.jsonl'):
+
+    '''
+    :param names: 'wandb', 'jsonl' or 'none', or a list of them
+    :param metrics_file: file of the jsonl logger
+    '''
+
+    names = [names] if isinstance(names, str) else list(names)
+    for name in names:
+        if name not in LOGGERS:
+            raise ValueError(f'Unknown logger {name}, expected one of {LOGGERS}')
+    names = [name for name in names if name != 'none']
+    # Only rank 0 logs in distributed training
+    if not names or not is_main_process():
+        return NullLogger()
+    loggers = [WandbLogger(project, entity) if name == 'wandb' else JsonlLogger(metrics_file) for name in names]
+    return loggers[0] if len(loggers) == 1 else LoggerGroup(loggers)
@@ -1,55 +1,80 @@
-import numpy as np
-
-def gaussian_mask(caption):
-    mean = 0.5
-    std = 0.2
-    val = np.random.normal(mean,std, size=(1,))
-    caption_split = caption.split(' ')
-    len_to_mask = int(min(1,max(0,val)) * len(caption_split))
-    masks = np.random.randint(len(caption_split), size=len_to_mask)
-    for m in masks:
-        caption_split[m] = "<mask>" 
-    output = " ".join(caption_split)
-    return output
-
-def epoch_aware_mask(epoch,caption,max_epochs=20):
-    mean = 1 - epoch/max_epochs
-    std = 0.25
-    val = np.random.normal(mean,std, size=(1,))
-    caption_split = caption.split(' ')
-    len_to_mask = int(min(1,max(0,val)) * len(caption_split))
-    masks = np.random.randint(len(caption_split), size=len_to_mask)
-    for m in masks:
-        caption_split[m] = "<mask>" 
-    output = " ".join(caption_split)
-    return output
-
-def text_infilling(caption):
-    caption_split = caption.split(' ')
-    if len(caption_split) <= 6:
-      return "<mask>"
-    try:
-        num_masks = np.random.randint(max(1,len(caption_split)//5),len(caption_split)//3)
-    except Exception as e:
-        print(e,caption)
-
-    masks_pos = set()
-    i=0
-    while i<num_masks:
-        x = np.random.randint(0,len(caption_split))
-        if x not in masks_pos:
-            masks_pos.add(x)
-            i+=1
-    sorted_masks_pos = sorted(list(masks_pos))
-    output = []
-    if sorted_masks_pos[0]!=0:
-        output.append("<mask>")
-    for pos in sorted_masks_pos:
-        output.append(caption_split[pos])
-        output.append("<mask>")
-
-    if sorted_masks_pos[-1]!=len(caption_split)-1:
-        output=output[:-1]
-        
-    output = " ".join(output)
-    return output
\ No newline at end of file
+import torch
+
+'''
+Masking strategies on the padded label input_ids of a batch.
+The masks of all captions are computed at once with tensor ops, so the masked input text
+comes straight from the tokenized labels without splitting, joining and tokenizing strings again.
+Special tokens (<s>, </s>, <pad>) are never masked.
+Every function returns (input_ids, attention_mask) of the masked batch.
+'''
+
+
+def _maskable_tokens(input_ids, attention_mask, special_token_ids):
+
+    maskable = attention_mask != 0
+    for token_id in special_token_ids:
+        maskable &= input_ids != token_id
+    return maskable
+
+
+def _bernoulli_mask(input_ids, attention_mask, mask_token_id, special_token_ids, mean, std, generator=None):
+
+    # Fraction of tokens to mask is drawn per caption, then every token is masked with that probability
+    maskable = _maskable_tokens(input_ids, attention_mask, special_token_ids)
+    fraction = (torch.randn(input_ids.size(0), 1, generator=generator) * std + mean).clamp(0, 1)
+    masked = maskable & (torch.rand(input_ids.size(), generator=generator) < fraction)
+    return input_ids.masked_fill(masked, mask_token_id), attention_mask
+
+
+def gaussian_mask(input_ids, attention_mask, mask_token_id, special_token_ids, generator=None):
+
+    return _bernoulli_mask(input_ids, attention_mask, mask_token_id, special_token_ids,
+                           mean=0.5, std=0.2, generator=generator)
+
+
+def epoch_aware_mask(epoch, input_ids, attention_mask, mask_token_id, special_token_ids,
+                     max_epochs=20, generator=None):
+
+    '''
+    Replace tokens with <mask>. The expected fraction of masked tokens decreases with the epochs.
+    '''
+
+    return _bernoulli_mask(input_ids, attention_mask, mask_token_id, special_token_ids,
+                           mean=1 - epoch / max_epochs, std=0.25, generator=generator)
+
+
+def text_infilling(input_ids, attention_mask, mask_token_id, special_token_ids, pad_token_id, generator=None):
+
+    '''
+    Keep between n//5 and n//3 randomly chosen tokens of a caption with n tokens and replace
+    every contiguous span of the other tokens with a single <mask>.
+    Captions with 6 tokens or less become a single <mask>.
+    '''
+
+    maskable = _maskable_tokens(input_ids, attention_mask, special_token_ids)
+    num_tokens = maskable.sum(dim=1)
+
+    # Number of kept tokens per caption, uniform in [max(1, n // 5), n // 3)
+    low = torch.clamp(num_tokens // 5, min=1)
+    high = torch.maximum(num_tokens // 3, low + 1)
+    num_kept = low + (torch.rand(num_tokens.size(), generator=generator) * (high - low)).long()
+    num_kept = torch.where(num_tokens <= 6, torch.zeros_like(num_kept), num_kept)
+
+    # The num_kept maskable tokens with the lowest random scores are kept
+    scores = torch.rand(input_ids.size(), generator=generator).masked_fill(~maskable, float('inf'))
+    ranks = scores.argsort(dim=1).argsort(dim=1)
+    masked = maskable & (ranks >= num_kept.unsqueeze(1))
+
+    # Collapse spans: a masked token directly after a masked token is dropped
+    previous_masked = torch.nn.functional.pad(masked[:, :-1], (1, 0), value=False)
+    keep = attention_mask.bool() & ~(masked & previous_masked)
+    tokens = input_ids.masked_fill(masked, mask_token_id)
+
+    # Cumulative sum gives the position of every kept token in the collapsed caption
+    positions = keep.long().cumsum(dim=1) - 1
+    lengths = keep.sum(dim=1)
+    masked_input_ids = torch.full((input_ids.size(0), int(lengths.max())), pad_token_id, dtype=input_ids.dtype)
+    rows = torch.arange(input_ids.size(0)).unsqueeze(1).expand_as(input_ids)
+    masked_input_ids[rows[keep], positions[keep]] = tokens[keep]
+    masked_attention_mask = (torch.arange(masked_input_ids.size(1)).unsqueeze(0) < lengths.unsqueeze(1)).long()
+    return masked_input_ids, masked_attention_mask
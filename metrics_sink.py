@@ -0,0 +1,132 @@
+import queue
+import threading
+
+import torch
+
+
+class MetricsSink:
+
+    def __init__(self,
+                 logger,
+                 background=True,
+                 max_pending=100):
+
+        '''
+        Batches the metrics of the training and evaluation loops and ships them to a logger (see loggers.py)
+        from a background thread, so the loops neither wait for the GPU to read a loss nor for logging I/O.
+        Scalar tensors passed to add are summed on their device, flush copies the sums of all metrics to the host
+        in one non blocking copy and the background thread logs their means once the copy is done.
+
+        :param logger: logger the records are sent to
+        :param background: log in the background thread, in flush and log otherwise
+        :param max_pending: records waiting to be logged, flush and log block when the queue is full
+        '''
+
+        self.logger = logger
+        self.background = background
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.sums = {}
+        self.counts = {}
+        # Means of the last flushed record of every metric, e.g. for progress bars
+        self.last_values = {}
+        self.error = None
+        if background:
+            self.thread = threading.Thread(target=self._run, name='metrics-sink', daemon=True)
+            self.thread.start()
+
+    def add(self, name, value):
+
+        '''
+        Add a value (scalar tensor or number) of metric name, its mean since the last flush is logged
+        '''
+
+        if torch.is_tensor(value):
+            value = value.detach().float()
+        self.sums[name] = self.sums[name] + value if name in self.sums else value
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def flush(self):
+
+        '''
+        Send the means of the added values to the logger, without waiting for the device
+        '''
+
+        self._raise_error()
+        if not self.sums:
+            return
+        names = list(self.sums)
+        counts = [self.counts[name] for name in names]
+        device = next((value.device for value in self.sums.values() if torch.is_tensor(value)), torch.device('cpu'))
+        sums = torch.stack([torch.as_tensor(self.sums[name], dtype=torch.float32, device=device) for name in names])
+        event = None
+        if sums.is_cuda:
+            # Copy into pinned memory so the copy is asynchronous, the background thread waits for the event
+            host_sums = torch.empty(sums.size(), dtype=sums.dtype, pin_memory=True)
+            host_sums.copy_(sums, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            host_sums = sums
+        self.sums, self.counts = {}, {}
+        self._put(('metrics', (names, counts, host_sums, event)))
+
+    def log(self, record):
+
+        '''
+        Send a record of host values (numbers, tables, images) to the logger
+        '''
+
+        self._raise_error()
+        self._put(('record', record))
+
+    def wait(self):
+
+        '''
+        Flush and wait until all records are logged
+        '''
+
+        self.flush()
+        if self.background:
+            self.queue.join()
+        self._raise_error()
+
+    def last(self, name):
+
+        return self.last_values.get(name)
+
+    def _put(self, item):
+
+        if self.background:
+            self.queue.put(item)
+        else:
+            self._write(item)
+
+    def _run(self):
+
+        while True:
+            item = self.queue.get()
+            try:
+                self._write(item)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _write(self, item):
+
+        kind, payload = item
+        if kind == 'metrics':
+            names, counts, host_sums, event = payload
+            if event is not None:
+                event.synchronize()
+            record = {name: total / count for name, total, count in zip(names, host_sums.tolist(), counts)}
+            self.last_values.update(record)
+        else:
+            record = payload
+        self.logger.log(record)
+
+    def _raise_error(self):
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Logging metrics failed') from error
@@ -0,0 +1,120 @@
+import contextlib
+
+import torch
+
+VISION_ENCODER_POLICIES = ['frozen', 'last_n', 'trainable']
+
+
+def apply_vision_encoder_policy(vision_model, policy='frozen', num_trainable_layers=0):
+
+    '''
+    Set requires_grad of the ViT weights for the freezing policy
+    frozen: no weight is trained
+    last_n: the last num_trainable_layers encoder layers and the final layernorm (and pooler) are trained
+    trainable: all weights are trained
+
+    Frozen weights never record an autograd graph because their inputs (pixel values) do not require grad.
+    '''
+
+    if policy not in VISION_ENCODER_POLICIES:
+        raise ValueError(f'Unknown vision encoder policy {policy}, expected one of {VISION_ENCODER_POLICIES}')
+    if policy == 'last_n' and num_trainable_layers <= 0:
+        raise ValueError('last_n policy needs num_trainable_layers > 0')
+
+    vision_model.requires_grad_(policy == 'trainable')
+    if policy == 'last_n':
+        for layer in vision_model.encoder.layer[-num_trainable_layers:]:
+            layer.requires_grad_(True)
+        vision_model.layernorm.requires_grad_(True)
+        if getattr(vision_model, 'pooler', None) is not None:
+            vision_model.pooler.requires_grad_(True)
+    return vision_model
+
+
+def enable_vision_gradient_checkpointing(vision_model):
+
+    '''
+    Recompute the activations of the ViT layers in backward instead of keeping them.
+    Checkpointed layers only get gradients when their input requires grad, with frozen embeddings
+    (last_n policy) the embedding output is therefore made to require grad.
+    '''
+
+    vision_model.gradient_checkpointing_enable()
+    vision_model.embeddings.register_forward_hook(lambda module, inputs, output: output.requires_grad_(True))
+    return vision_model
+
+
+def accumulation_size(batch_idx, num_batches, accumulation_steps):
+
+    '''
+    Number of micro-batches in the gradient accumulation window of batch_idx.
+    The last window of an epoch is shorter when num_batches is not a multiple of accumulation_steps.
+    '''
+
+    window_start = batch_idx - batch_idx % accumulation_steps
+    return min(accumulation_steps, num_batches - window_start)
+
+
+def vision_encoder_context(policy):
+
+    '''
+    A fully frozen encoder runs without autograd, the other policies need the graph of the trained layers
+    '''
+
+    return torch.no_grad() if policy == 'frozen' else contextlib.nullcontext()
+
+
+def trainable_parameters(*modules):
+
+    '''
+    Parameters that require grad. Frozen weights are left out of the optimizer
+    so that it does not keep state (AdamW moments) or apply weight decay to them.
+    '''
+
+    return [parameter for module in modules for parameter in module.parameters() if parameter.requires_grad]
+
+
+def count_parameters(*modules):
+
+    parameters = [parameter for module in modules for parameter in module.parameters()]
+    return {'total': sum(parameter.numel() for parameter in parameters),
+            'trainable': sum(parameter.numel() for parameter in parameters if parameter.requires_grad)}
+
+
+PRECISIONS = ['fp32', 'bf16', 'fp16']
+
+
+class Precision:
+
+    '''
+    Autocast and gradient scaling for a precision mode. Weights (and the optimizer) stay in fp32,
+    autocast runs the forward passes, loss and generate in the lower precision.
+    fp16 uses a GradScaler against gradient underflow and needs a GPU, bf16 works on CPU and GPU.
+    '''
+
+    def __init__(self, precision='fp32', device='cpu'):
+
+        if precision not in PRECISIONS:
+            raise ValueError(f'Unknown precision {precision}, expected one of {PRECISIONS}')
+        self.device_type = torch.device(device).type
+        if precision == 'fp16' and self.device_type != 'cuda':
+            raise ValueError('fp16 precision needs a GPU, use bf16 on CPU')
+        self.precision = precision
+        self.dtype = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}[precision]
+        # torch.cuda.amp.GradScaler is deprecated since torch 2.3, which added torch.amp.GradScaler
+        if hasattr(torch.amp, 'GradScaler'):
+            self.scaler = torch.amp.GradScaler('cuda', enabled=precision == 'fp16')
+        else:
+            self.scaler = torch.cuda.amp.GradScaler(enabled=precision == 'fp16')
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype, enabled=self.precision != 'fp32')
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def step(self, optimizer):
+
+        # Without scaling (fp32, bf16) this is optimizer.step()
+        self.scaler.step(optimizer)
+        self.scaler.update()
@@ -1,9 +1,11 @@
-from typing import Optional, List, Union, Tuple
+from dataclasses import dataclass
+from typing import Optional, List, Union, Tuple, Any, Dict
 
 import torch
 from torch import nn
 from torch.nn import CrossEntropyLoss
 from transformers import BartTokenizer, BartModel, BartForConditionalGeneration
+from transformers.activations import ACT2FN
 from transformers.modeling_outputs import Seq2SeqModelOutput, BaseModelOutput, Seq2SeqLMOutput
 from transformers.models.bart.modeling_bart import (
     BartEncoder, BartDecoder,
@@ -12,6 +14,93 @@ from transformers.models.bart.modeling_bart import (
     shift_tokens_right
 )
 
+from template_decoding import template_beam_search
+
+
+def fuse_image_text_embeddings(image_embeddings, text_embeddings, attention_mask=None):
+
+    '''
+    Concat image embeddings in front of the text encoder embeddings and extend the attention mask.
+
+    The text batch can be a multiple of the image batch when each image has a group of
+    consecutive text rows (num_beams hypotheses in beam search, or all captions of an
+    image in image grouped training). The image rows are then broadcast into the output
+    with expand instead of being repeated for every row of the group.
+    '''
+
+    batch_size, text_length, hidden_size = text_embeddings.size()
+    num_images, image_length = image_embeddings.size()[:2]
+    group_size = batch_size // num_images
+
+    image_text_embeddings = text_embeddings.new_empty((batch_size, image_length + text_length, hidden_size))
+    image_text_embeddings.view(num_images, group_size, image_length + text_length, hidden_size)[:, :, :image_length] = \
+        image_embeddings.unsqueeze(1).expand(num_images, group_size, image_length, hidden_size)
+    image_text_embeddings[:, image_length:] = text_embeddings
+
+    if attention_mask is None:
+        extended_attention_mask = text_embeddings.new_ones((batch_size, image_length + text_length))
+    else:
+        image_attention_mask = attention_mask.new_ones((batch_size, image_length))
+        extended_attention_mask = torch.concat((image_attention_mask,
+                                                attention_mask),
+                                               axis=1)
+    return image_text_embeddings, extended_attention_mask
+
+
+def expand_to_group(tensor, group_size):
+
+    '''
+    (batch, ...) -> (batch * group_size, ...) with every row repeated for its group, in the
+    same order as repeat_interleave. expand gives a stride-0 view which reshape materialises once.
+    '''
+
+    return tensor.unsqueeze(1).expand(tensor.size(0), group_size, *tensor.size()[1:]).reshape(-1, *tensor.size()[1:])
+
+
+class VisualResampler(nn.Module):
+
+    '''
+    Perceiver style resampler that compresses the ViT patch embeddings to config.num_visual_tokens tokens.
+    A set of learned latent tokens cross attends over the image embeddings, followed by a feed forward layer.
+    The decoder then cross attends over K image tokens instead of all 197 patch tokens.
+    '''
+
+    def __init__(self, config):
+
+        super().__init__()
+        embed_dim = config.d_model
+        self.latents = nn.Parameter(torch.randn(config.num_visual_tokens, embed_dim) * config.init_std)
+        self.image_layer_norm = nn.LayerNorm(embed_dim)
+        self.attention = nn.MultiheadAttention(embed_dim,
+                                               config.encoder_attention_heads,
+                                               dropout=config.attention_dropout,
+                                               batch_first=True)
+        self.attention_layer_norm = nn.LayerNorm(embed_dim)
+        self.activation_fn = ACT2FN[config.activation_function]
+        self.fc1 = nn.Linear(embed_dim, config.encoder_ffn_dim)
+        self.fc2 = nn.Linear(config.encoder_ffn_dim, embed_dim)
+        self.final_layer_norm = nn.LayerNorm(embed_dim)
+
+    def forward(self, image_embeddings):
+
+        image_embeddings = self.image_layer_norm(image_embeddings)
+        latents = self.latents.unsqueeze(0).expand(image_embeddings.size(0), -1, -1)
+        attention_output = self.attention(latents, image_embeddings, image_embeddings, need_weights=False)[0]
+        hidden_states = self.attention_layer_norm(latents + attention_output)
+        hidden_states = self.final_layer_norm(hidden_states + self.fc2(self.activation_fn(self.fc1(hidden_states))))
+        return hidden_states
+
+
+@dataclass
+class MultiModalEncoderOutput(BaseModelOutput):
+
+    '''
+    Encoder output with the image embeddings already concatenated in front of the text embeddings.
+    attention_mask is the extended (image + text) mask for the cross attention of the decoder.
+    '''
+
+    attention_mask: Optional[torch.LongTensor] = None
+
 
 class BartMultiModalEncoder(BartEncoder):
 
@@ -22,6 +111,39 @@ class BartMultiModalEncoder(BartEncoder):
     def __init__(self, config, embed_tokens=None):
         super().__init__(config, embed_tokens=None)
         self.config = config
+        # Projection of the ViT embeddings when they are wider or narrower than d_model (distilled students)
+        image_embedding_dim = getattr(config, 'image_embedding_dim', None)
+        if image_embedding_dim is not None and image_embedding_dim != config.d_model:
+            self.image_projection = nn.Linear(image_embedding_dim, config.d_model)
+        else:
+            self.image_projection = None
+        # Optional resampler to shrink the image prefix to num_visual_tokens tokens
+        if getattr(config, 'num_visual_tokens', None):
+            self.visual_resampler = VisualResampler(config)
+        else:
+            self.visual_resampler = None
+
+    def image_prefix(self, image_embeddings, dtype):
+
+        '''
+        Image embeddings as they are put in front of the text embeddings: projected and resampled if configured
+        '''
+
+        image_embeddings = image_embeddings.to(dtype)
+        if self.image_projection is not None:
+            image_embeddings = self.image_projection(image_embeddings)
+        if self.visual_resampler is not None:
+            image_embeddings = self.visual_resampler(image_embeddings)
+        return image_embeddings
+
+    def fuse(self, image_embeddings, text_embeddings, attention_mask=None):
+
+        '''
+        Project and resample (if configured) the image embeddings and concat them in front of the text embeddings
+        '''
+
+        image_embeddings = self.image_prefix(image_embeddings, text_embeddings.dtype)
+        return fuse_image_text_embeddings(image_embeddings, text_embeddings, attention_mask)
 
 
     def forward(self,
@@ -37,15 +159,31 @@ class BartMultiModalEncoder(BartEncoder):
 
         # Image Embeddings are not passed to BartEncoder
         # Call parent class forward. The image embeddings are not passed to encoder
-        return super().forward(
+        encoder_outputs = super().forward(
             input_ids,
             attention_mask,
             head_mask,
             inputs_embeds,
             output_attentions,
             output_hidden_states,
-            return_dict
+            return_dict=True
+        )
+        if image_embeddings is None:
+            return encoder_outputs if return_dict else encoder_outputs.to_tuple()
+
+        # Fuse image and text embeddings once here instead of in every decoder step of generate
+        image_text_embeddings, extended_attention_mask = self.fuse(
+            image_embeddings,
+            encoder_outputs.last_hidden_state,
+            attention_mask
+        )
+        encoder_outputs = MultiModalEncoderOutput(
+            last_hidden_state=image_text_embeddings,
+            hidden_states=encoder_outputs.hidden_states,
+            attentions=encoder_outputs.attentions,
+            attention_mask=extended_attention_mask,
         )
+        return encoder_outputs if return_dict else encoder_outputs.to_tuple()
 
 
 class BartMultiModalModel(BartModel):
@@ -140,31 +278,20 @@ class BartMultiModalModel(BartModel):
         # END: COPIED FROM https://github.com/huggingface/transformers/blob/main/src/transformers/models/bart/modeling_bart.py
 
         '''
-        Beam Search creates (num_beams*enocder_input_ids) and passes to encoder which gives
-        (num_beams*encoder_embeddings). 
-        Multiply (num_beams*Image Embeddings) and attach them to encoder_embeddings and get
-        new Image+Text embeddings.
+        The encoder returns fused Image+Text embeddings when it is given the image embeddings,
+        generate runs it once and expands the fused states to the beams.
+        Encoder outputs computed without images (e.g. shared by the captions of an image) are fused here,
+        the image embeddings are broadcast to the groups of text rows.
         '''
-        beam_batch_size = encoder_outputs.last_hidden_state.size()[0]
-        if image_embeddings.size()[0] != beam_batch_size:
-            image_embeddings = image_embeddings.repeat(beam_batch_size // image_embeddings.size()[0], 1, 1)
-
-        image_text_embeddings = torch.concat((image_embeddings,
-                                              encoder_outputs.last_hidden_state),
-                                             axis=1)
-        if torch.cuda.is_available():
-            device = 'cuda:0'
+        if isinstance(encoder_outputs, MultiModalEncoderOutput):
+            image_text_embeddings = encoder_outputs.last_hidden_state
+            extended_attention_mask = encoder_outputs.attention_mask
         else:
-            device = 'cpu'
-        if attention_mask is None:
-            extended_attention_mask = torch.ones((image_text_embeddings.size()[0],
-                                                  image_text_embeddings.size()[1])).to(device)
-        else:
-            image_attention_mask = torch.ones((image_embeddings.size()[0],
-                                               image_embeddings.size()[1])).to(device)
-            extended_attention_mask = torch.concat((image_attention_mask,
-                                                    attention_mask),
-                                                   axis=1)
+            image_text_embeddings, extended_attention_mask = self.encoder.fuse(
+                image_embeddings,
+                encoder_outputs.last_hidden_state,
+                attention_mask
+            )
         # START: COPIED FROM https://github.com/huggingface/transformers/blob/main/src/transformers/models/bart/modeling_bart.py
 
         decoder_outputs = self.decoder(
@@ -211,6 +338,9 @@ class BartMultiModalGenerationModel(BartForConditionalGeneration):
         r"encoder\.version",
         r"decoder\.version",
         r"lm_head\.weight",
+        r"visual_resampler",
+        # Shared with model.shared, saved once in checkpoints written by checkpoint_writer.py
+        r"decoder\.embed_tokens\.weight",
     ]
 
     def __init__(self, config: BartConfig):
@@ -324,12 +454,85 @@ class BartMultiModalGenerationModel(BartForConditionalGeneration):
         }
 
         # Modified
-        if "image_embeddings" in kwargs:
+        # Fused encoder outputs already contain the image embeddings
+        if "image_embeddings" in kwargs and not isinstance(encoder_outputs, MultiModalEncoderOutput):
             output["image_embeddings"] = kwargs['image_embeddings']
 
         return output
     # END: COPIED FROM https://github.com/huggingface/transformers/blob/main/src/transformers/models/bart/modeling_bart.py
 
+    def generate(self, inputs=None, template_mask_token_id=None, max_span_length=None, **kwargs):
+
+        '''
+        Hugging Face generate, or template decoding (see template_decoding) when template_mask_token_id is given:
+        the input_ids are caption templates, their fixed tokens are copied and only the spans of
+        template_mask_token_id tokens are searched. Supports num_beams, max_length, length_penalty
+        and early_stopping.
+        :param max_span_length: maximum number of tokens generated for a span in template decoding
+        '''
+
+        if template_mask_token_id is None:
+            return super().generate(inputs, **kwargs)
+
+        input_ids = inputs if inputs is not None else kwargs.pop('input_ids')
+        attention_mask = kwargs.pop('attention_mask', None)
+        if attention_mask is None:
+            attention_mask = input_ids.ne(self.config.pad_token_id).long()
+        template_ids = [ids[mask.bool()].tolist() for ids, mask in zip(input_ids, attention_mask)]
+        image_embeddings = kwargs.pop('image_embeddings', None)
+        search_kwargs = {key: kwargs.pop(key) for key in ['length_penalty', 'early_stopping'] if key in kwargs}
+        num_beams = kwargs.pop('num_beams', None) or self.config.num_beams
+        max_length = kwargs.pop('max_length', None) or self.config.max_length
+        if kwargs:
+            raise ValueError(f'{sorted(kwargs)} are not supported with template decoding')
+
+        with torch.no_grad():
+            encoder_outputs = self.get_encoder()(input_ids=input_ids,
+                                                 attention_mask=attention_mask,
+                                                 image_embeddings=image_embeddings,
+                                                 return_dict=True)
+        if isinstance(encoder_outputs, MultiModalEncoderOutput):
+            # Mask of the fused image and text states
+            attention_mask = encoder_outputs.attention_mask
+        return template_beam_search(self,
+                                    template_ids,
+                                    encoder_outputs.last_hidden_state,
+                                    attention_mask,
+                                    template_mask_token_id,
+                                    num_beams=num_beams,
+                                    max_length=max_length,
+                                    max_span_length=max_span_length,
+                                    **search_kwargs)
+
+    @staticmethod
+    def _expand_inputs_for_generation(
+            input_ids: torch.LongTensor,
+            expand_size: int = 1,
+            is_encoder_decoder: bool = False,
+            attention_mask: Optional[torch.LongTensor] = None,
+            encoder_outputs: Optional[BaseModelOutput] = None,
+            **model_kwargs,
+    ) -> Tuple[torch.LongTensor, Dict[str, Any]]:
+
+        '''
+        Expand the inputs to the beams with expand_to_group instead of index_select.
+        The fused encoder states and the extended attention mask computed once by the encoder
+        are expanded with them and reused in every decoding step.
+        '''
+
+        input_ids = expand_to_group(input_ids, expand_size)
+        if attention_mask is not None:
+            model_kwargs["attention_mask"] = expand_to_group(attention_mask, expand_size)
+        if is_encoder_decoder:
+            if encoder_outputs is None:
+                raise ValueError("If `is_encoder_decoder` is True, make sure that `encoder_outputs` is defined.")
+            encoder_outputs["last_hidden_state"] = expand_to_group(encoder_outputs.last_hidden_state, expand_size)
+            if isinstance(encoder_outputs, MultiModalEncoderOutput):
+                encoder_outputs["attention_mask"] = expand_to_group(encoder_outputs.attention_mask, expand_size)
+                model_kwargs.pop("image_embeddings", None)
+            model_kwargs["encoder_outputs"] = encoder_outputs
+        return input_ids, model_kwargs
+
 
 if __name__ == '__main__':
     from transformers import (
@@ -2,53 +2,209 @@ from transformers import (
     ViTFeatureExtractor,
     ViTModel,
     BartTokenizer,
+    BartConfig,
 )
-from modelling_bartMultiModal import BartMultiModalGenerationModel
+from modelling_bartMultiModal import BartMultiModalGenerationModel, expand_to_group
+from quantization import quantize_dynamic, is_quantized_checkpoint, load_quantized
+from checkpoint_writer import CheckpointWriter, is_partial_checkpoint, load_partial_checkpoint
+from profiler import PhaseProfiler
+from loggers import create_logger
+from metrics_sink import MetricsSink
+from distributed import (
+    get_device,
+    wrap_model,
+    unwrap_model,
+    gradient_sync,
+    all_reduce_sum,
+    is_main_process,
+)
+from model_utils import (
+    apply_vision_encoder_policy,
+    vision_encoder_context,
+    trainable_parameters,
+    enable_vision_gradient_checkpointing,
+    accumulation_size,
+    Precision,
+)
+import os
 import torch
-import wandb
 from tqdm import tqdm
 import pickle
-from evaluation_metrics import compute_bleu_scores, compute_bert_score, compute_rouge_score, compute_meteor_score
 
 
 class MultiModalModel:
 
     def __init__(self,
                  model_ckpt=None,
-                 beam_size=5):
+                 beam_size=5,
+                 vision_encoder_policy='frozen',
+                 num_trainable_vision_layers=0,
+                 num_visual_tokens=None,
+                 precision='fp32',
+                 gradient_accumulation_steps=1,
+                 gradient_checkpointing=False,
+                 quantized=False,
+                 template_decoding=False,
+                 async_checkpoints=False,
+                 checkpoint_dtype='fp32',
+                 trainable_only_checkpoints=False,
+                 profile=False,
+                 profile_trace_dir=None,
+                 mode='train',
+                 logger='wandb',
+                 metrics_file='metrics.jsonl',
+                 watch_gradients=False,
+                 cache_dir=None,
+                 local_files_only=False):
 
         # Vit Image Extractor and Encoder and BART Decoder
         '''
         Set Modified BART Model architecture as model for text generation
         Pass Image Embeddings and Text as Input and Get Text as Output
+
+        :param vision_encoder_policy: 'frozen', 'last_n' or 'trainable' ViT weights (see model_utils)
+        :param num_trainable_vision_layers: number of trained ViT layers for 'last_n'
+        :param num_visual_tokens: compress the image embeddings to this many tokens with a VisualResampler.
+        Checkpoints keep the value in their config.
+        :param precision: 'fp32', 'bf16' or 'fp16' (see model_utils.Precision)
+        :param gradient_accumulation_steps: micro-batches per optimizer step
+        :param gradient_checkpointing: recompute BART (and trained ViT) layer activations in backward
+        :param quantized: int8 dynamic quantized ViT and BART for CPU inference (see quantization.py).
+        Checkpoints saved by quantization.py are always loaded quantized.
+        :param template_decoding: in predict, copy the words of the masked input text into the caption and
+        only generate the <mask> spans (see template_decoding.py)
+        :param async_checkpoints: write checkpoints in a background thread (see checkpoint_writer.py)
+        :param checkpoint_dtype: 'fp32' or 'fp16' weights in the saved checkpoints
+        :param trainable_only_checkpoints: save only the trained weights, loaded on top of the pretrained models
+        :param profile: print the time per phase (data, vision, text, backward, optimizer, generate, metrics)
+        after every train, test and predict loop (see profiler.py)
+        :param profile_trace_dir: export torch.profiler Chrome traces of a few steps of the first loops to this dir
+        :param mode: 'train' or 'predict'. A predict model has no optimizer, checkpoint writer,
+        DistributedDataParallel wrappers or gradient hooks.
+        :param logger: 'wandb', 'jsonl' or 'none', or a list of them (see loggers.py).
+        Metrics are logged from a background thread (see metrics_sink.py).
+        :param metrics_file: file of the jsonl logger
+        :param watch_gradients: log gradient histograms with wandb.watch, its hooks slow down every backward
+        :param cache_dir: Hugging Face cache dir of the pretrained ViT, BART and their tokenizers
+        :param local_files_only: load the pretrained files from the cache without requests to the hub
         '''
 
-        if torch.cuda.is_available():
-            self.device = 'cuda:0'
+        if mode not in ['train', 'predict']:
+            raise ValueError(f'Unknown mode {mode}, expected train or predict')
+        self.mode = mode
+
+        # Quantized models only run on CPU. In distributed training every rank uses the GPU of its local rank.
+        if torch.cuda.is_available() and not quantized and not is_quantized_checkpoint(model_ckpt):
+            self.device = get_device()
         else:
             self.device = 'cpu'
 
         image_encoder = "google/vit-base-patch16-224-in21k"
         text_decoder = "facebook/bart-base"
+        hub_kwargs = {'cache_dir': cache_dir, 'local_files_only': local_files_only}
 
         # Image and Text Tokenizers
-        self.tokenizer = BartTokenizer.from_pretrained(text_decoder)
-        self.image_feature_extractor = ViTFeatureExtractor.from_pretrained(image_encoder)
+        self.tokenizer = BartTokenizer.from_pretrained(text_decoder, **hub_kwargs)
+        self.image_feature_extractor = ViTFeatureExtractor.from_pretrained(image_encoder, **hub_kwargs)
+        self.vision_encoder_policy = vision_encoder_policy
+        if model_ckpt is not None:
+            self.model_ckpt = '_'.join(model_ckpt.split('/'))
 
-        self.image_model = ViTModel.from_pretrained(image_encoder)
+        if is_quantized_checkpoint(model_ckpt):
+            # int8 artifacts saved by quantization.py
+            self.model, self.image_model = load_quantized(model_ckpt)
+        else:
+            # A trained ViT is saved in the vision_encoder dir of the checkpoint
+            vision_path = None if model_ckpt is None else os.path.join(model_ckpt, 'vision_encoder')
+            if vision_path is not None and os.path.isdir(vision_path) and not is_partial_checkpoint(vision_path):
+                self.image_model = ViTModel.from_pretrained(vision_path)
+            else:
+                self.image_model = ViTModel.from_pretrained(image_encoder, **hub_kwargs)
+                if vision_path is not None and os.path.isdir(vision_path):
+                    load_partial_checkpoint(self.image_model, vision_path)
+
+            # Model Initialization
+            model_path = text_decoder if model_ckpt is None else model_ckpt
+            config = BartConfig.from_pretrained(model_path, **hub_kwargs)
+            if num_visual_tokens is not None:
+                config.num_visual_tokens = num_visual_tokens
+            if is_partial_checkpoint(model_ckpt):
+                # Trainable only checkpoints are loaded on top of the pretrained BART
+                self.model = BartMultiModalGenerationModel.from_pretrained(text_decoder, config=config, **hub_kwargs)
+                load_partial_checkpoint(self.model, model_ckpt)
+            else:
+                self.model = BartMultiModalGenerationModel.from_pretrained(model_path, config=config, **hub_kwargs)
+            if quantized:
+                self.model, self.image_model = quantize_dynamic(self.model), quantize_dynamic(self.image_model)
+
+        # Before the device placement, DistributedDataParallel wrappers, optimizer and gradient hooks
+        self.model = self.build_model(self.model)
+        apply_vision_encoder_policy(self.image_model, vision_encoder_policy, num_trainable_vision_layers)
         self.image_model.to(self.device)
         self.image_model.eval()
-
-        # Model Initialization
-        if model_ckpt is None:
-            self.model = BartMultiModalGenerationModel.from_pretrained(text_decoder)
-        else:
-            self.model = BartMultiModalGenerationModel.from_pretrained(model_ckpt)
-            self.model_ckpt = '_'.join(model_ckpt.split('/'))
         self.model.to(self.device)
+        if gradient_checkpointing:
+            self.model.gradient_checkpointing_enable()
+            if vision_encoder_policy != 'frozen':
+                enable_vision_gradient_checkpointing(self.image_model)
+
+        if mode == 'train':
+            self.wrap_models()
+            self.configure_optimizers()
+        else:
+            self.model.eval()
+            self.parallel_model, self.parallel_image_model = self.model, self.image_model
+            self.optimizer = self.lr_scheduler = None
 
         # Hyperparameters
-        self.optimizer = torch.optim.AdamW(self.model.parameters(),
+        self.beam_size = beam_size
+        self.template_mask_token_id = self.tokenizer.mask_token_id if template_decoding else None
+        self.precision = Precision(precision, self.device)
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        if mode == 'train' and (async_checkpoints or checkpoint_dtype != 'fp32' or trainable_only_checkpoints):
+            self.checkpoint_writer = CheckpointWriter(dtype=torch.float16 if checkpoint_dtype == 'fp16' else None,
+                                                      trainable_only=trainable_only_checkpoints,
+                                                      background=async_checkpoints)
+        else:
+            self.checkpoint_writer = None
+        # Only rank 0 profiles in distributed training
+        self.profiler = PhaseProfiler(enabled=(profile or profile_trace_dir is not None) and is_main_process(),
+                                      device=self.device,
+                                      trace_dir=profile_trace_dir)
+
+        # Logging
+        self.log_freq = 40
+        self.watch_gradients = watch_gradients
+        self.logger = create_logger(logger,
+                                    project='multi-modal-image-caption-generation',
+                                    entity='multi-modal-image-caption-generation',
+                                    metrics_file=metrics_file)
+        self.metrics = MetricsSink(self.logger)
+        if mode == 'train' and watch_gradients:
+            self.logger.watch(self.model, self.log_freq)
+
+    def build_model(self, model):
+
+        '''
+        BART model that is trained and used for prediction, given the loaded one.
+        Subclasses replace it here (see distillation_module).
+        '''
+
+        return model
+
+    def wrap_models(self):
+
+        '''
+        DistributedDataParallel models for distributed training, the models themselves otherwise.
+        A frozen ViT is not wrapped. The ViT pooler is not used, so its DDP allows unused parameters.
+        '''
+
+        self.parallel_model = wrap_model(self.model)
+        self.parallel_image_model = wrap_model(self.image_model, find_unused_parameters=True)
+
+    def configure_optimizers(self):
+
+        self.optimizer = torch.optim.AdamW(trainable_parameters(self.model, self.image_model),
                                            lr=0.0001,
                                            eps=1e-8,
                                            weight_decay=0.01
@@ -56,53 +212,157 @@ class MultiModalModel:
         self.lr_scheduler = torch.optim.lr_scheduler.ExponentialLR(
             self.optimizer,
             gamma=0.9)
-        self.beam_size = beam_size
 
-        # Wandb
-        self.log_freq = 40
-        wandb.init(project='multi-modal-image-caption-generation',
-                   entity='multi-modal-image-caption-generation')
-        wandb.watch(self.model, self.log_freq)
+    def get_image_embeddings(self, image_inputs, image_model=None):
 
-    def train(self,
-              epoch,
-              train_dataloader,
-              path):
+        '''
+        Image inputs are either pixel values (batch, channels, height, width) or
+        ViT last_hidden_state (batch, tokens, hidden) read from an ImageEmbeddingStore.
+        Embeddings from the store are used as they are without running the ViT.
+        :param image_model: ViT to run, self.parallel_image_model if None
+        '''
 
-        self.model.train()
-        set_steps = set([10, 50, 100, 500, 1000, 5000, 10000])
-        total_loss = 0.0
-        progress_bar = tqdm(train_dataloader)
-        for batch_idx, batch_data in enumerate(progress_bar):
-            progress_bar.set_description(f'Train Epoch {epoch}')
-            image_pixel_values = batch_data[0].to(self.device)
-            input_encodings = batch_data[1].to(self.device)
-            input_ids = input_encodings.input_ids
-            input_attention_mask = input_encodings.attention_mask
-            label_input_ids = batch_data[2].input_ids.to(self.device)
-
-            image_embeddings = self.image_model(image_pixel_values).last_hidden_state
-            outputs = self.model(
+        image_model = image_model if image_model is not None else self.parallel_image_model
+
+        if image_inputs.dim() == 3:
+            if self.vision_encoder_policy != 'frozen':
+                raise ValueError('Precomputed image embeddings can only be used with a frozen vision encoder')
+            return image_inputs.float()
+        with self.profiler.phase('vision'), vision_encoder_context(self.vision_encoder_policy):
+            return image_model(image_inputs).last_hidden_state
+
+    def forward_batch(self, batch_data, model=None, image_embeddings=None):
+
+        '''
+        :param batch_data: (Image Inputs, Input Text Encodings, Label Text Encodings) or
+        image grouped (Image Inputs, Input Text Encodings, Label Text Encodings, Captions per Image)
+        :param model: BART model to run, self.model (DistributedDataParallel in distributed training) if None
+        :param image_embeddings: image embeddings of the batch when already computed
+        :return: Seq2SeqLMOutput with loss
+        '''
+
+        model = model if model is not None else self.parallel_model
+        input_encodings = batch_data[1].to(self.device)
+        input_ids = input_encodings.input_ids
+        input_attention_mask = input_encodings.attention_mask
+        label_input_ids = batch_data[2].input_ids.to(self.device)
+        encoder_outputs = None
+
+        # ViT runs once per image, the image embeddings are broadcast to its captions in the model
+        if image_embeddings is None:
+            image_embeddings = self.get_image_embeddings(batch_data[0].to(self.device))
+        with self.profiler.phase('text'):
+            if len(batch_data) > 3 and input_ids.size(0) != label_input_ids.size(0):
+                # Input text is shared by all captions of an image, run the BART encoder once per image
+                captions_per_image = batch_data[3]
+                encoder_outputs = unwrap_model(model).get_encoder()(
+                    input_ids=input_ids,
+                    attention_mask=input_attention_mask,
+                    return_dict=True,
+                )
+                encoder_outputs.last_hidden_state = expand_to_group(encoder_outputs.last_hidden_state,
+                                                                    captions_per_image)
+                input_attention_mask = expand_to_group(input_attention_mask, captions_per_image)
+                input_ids = None
+
+            return model(
                 input_ids=input_ids,
                 attention_mask=input_attention_mask,
+                encoder_outputs=encoder_outputs,
                 image_embeddings=image_embeddings,
                 labels=label_input_ids,
                 return_dict=True,
             )
-            loss = outputs.loss
-            progress_bar.set_postfix(loss=loss.item())
-            total_loss += loss.item()
-            self.model.zero_grad()
-            loss.backward()
-            self.optimizer.step()
 
-            if batch_idx in set_steps and epoch == 0:
-                self.model.save_pretrained(f'{path}_batch{batch_idx}/')
+    def training_loss(self, batch_data):
 
-            if batch_idx % self.log_freq == 0:
-                wandb.log({"train/loss": loss.item()})
+        '''
+        Loss that train optimizes, subclasses change the objective here (see distillation_module)
+        '''
+
+        return self.forward_batch(batch_data).loss
+
+    def training_state(self):
 
-        return total_loss / (batch_idx + 1)
+        '''
+        Weights, optimizer, lr scheduler and gradient scaler states to resume training (see trainer.py)
+        '''
+
+        return {'model': self.model.state_dict(),
+                'image_model': self.image_model.state_dict() if self.vision_encoder_policy != 'frozen' else None,
+                'optimizer': self.optimizer.state_dict(),
+                'lr_scheduler': self.lr_scheduler.state_dict(),
+                'scaler': self.precision.scaler.state_dict()}
+
+    def load_training_state(self, state):
+
+        self.model.load_state_dict(state['model'])
+        if state['image_model'] is not None:
+            self.image_model.load_state_dict(state['image_model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.lr_scheduler.load_state_dict(state['lr_scheduler'])
+        self.precision.scaler.load_state_dict(state['scaler'])
+
+    def train(self,
+              epoch,
+              train_dataloader,
+              path,
+              start_batch=0,
+              step_callback=None):
+
+        '''
+        :param start_batch: index of the first batch of train_dataloader in the epoch, when resuming an epoch
+        :param step_callback: called with the index of the next batch after every optimizer step
+        '''
+
+        self.model.train()
+        # Frozen ViT stays in eval mode
+        self.image_model.train(self.vision_encoder_policy != 'frozen')
+        set_steps = set([10, 50, 100, 500, 1000, 5000, 10000])
+        # Losses stay on the device, they are only read at the end of the epoch and by the metrics sink
+        total_loss = torch.zeros((), device=self.device)
+        optimizer_steps = start_batch // self.gradient_accumulation_steps
+        num_batches = start_batch + len(train_dataloader)
+        self.optimizer.zero_grad(set_to_none=True)
+        progress_bar = tqdm(train_dataloader, disable=not is_main_process())
+        self.profiler.start_loop('train')
+        for batch_idx, batch_data in enumerate(self.profiler.iterate(progress_bar), start=start_batch):
+            progress_bar.set_description(f'Train Epoch {epoch}')
+            optimizer_step = (batch_idx + 1) % self.gradient_accumulation_steps == 0 or batch_idx + 1 == num_batches
+            # Gradients are all-reduced across the ranks only in the backward before an optimizer step
+            with gradient_sync(optimizer_step, self.parallel_model, self.parallel_image_model):
+                with self.precision.autocast():
+                    loss = self.training_loss(batch_data)
+                total_loss += loss.detach()
+                self.metrics.add('train/loss', loss)
+
+                # Gradients of the micro-batches are summed, scale the loss to get their mean
+                window_size = accumulation_size(batch_idx, num_batches, self.gradient_accumulation_steps)
+                with self.profiler.phase('backward'):
+                    self.precision.backward(loss / window_size)
+            self.profiler.step(len(batch_data[0]))
+            if not optimizer_step:
+                continue
+
+            with self.profiler.phase('optimizer'):
+                self.precision.step(self.optimizer)
+                self.optimizer.zero_grad(set_to_none=True)
+            optimizer_steps += 1
+            # Mean loss of the last log_freq optimizer steps, the progress bar shows the previous one
+            if optimizer_steps % self.log_freq == 0:
+                self.metrics.flush()
+                progress_bar.set_postfix(loss=self.metrics.last('train/loss'))
+
+            if optimizer_steps in set_steps and epoch == 0 and is_main_process():
+                self.save_pretrained(f'{path}_batch{optimizer_steps}/')
+            if step_callback is not None:
+                step_callback(batch_idx + 1)
+
+        self.metrics.flush()
+        self.log_profile(f'Train Epoch {epoch}')
+        # An epoch resumed after its last batch has no batches left to train
+        num_trained = num_batches - start_batch
+        return total_loss.item() / num_trained if num_trained else 0.0
 
     def test(self,
              epoch,
@@ -110,34 +370,37 @@ class MultiModalModel:
              validation=True):
 
         self.model.eval()
+        self.image_model.eval()
         loss_name = 'val/loss' if validation else 'test/loss'
         step = 'Val' if validation else 'Test'
-        total_loss = 0.0
-        progress_bar = tqdm(dataloader)
+        # Loss summed over the samples (label rows) and the number of samples of this rank
+        total_loss = torch.zeros((), device=self.device)
+        num_samples = 0
+        progress_bar = tqdm(dataloader, disable=not is_main_process())
+        self.profiler.start_loop('test')
         with torch.no_grad():
-            for batch_idx, batch_data in enumerate(progress_bar):
+            for batch_idx, batch_data in enumerate(self.profiler.iterate(progress_bar)):
                 progress_bar.set_description(f'{step} Epoch {epoch}')
-                image_pixel_values = batch_data[0].to(self.device)
-                input_encodings = batch_data[1].to(self.device)
-                input_ids = input_encodings.input_ids
-                input_attention_mask = input_encodings.attention_mask
-                label_input_ids = batch_data[2].input_ids.to(self.device)
-
-                image_embeddings = self.image_model(image_pixel_values).last_hidden_state
-                outputs = self.model(
-                    input_ids=input_ids,
-                    attention_mask=input_attention_mask,
-                    image_embeddings=image_embeddings,
-                    labels=label_input_ids,
-                    return_dict=True,
-                )
-                loss = outputs.loss.item()
-                progress_bar.set_postfix(loss=loss)
-                total_loss += loss
-                if batch_idx % self.log_freq == 0:
-                    wandb.log({loss_name: loss})
-
-        return total_loss / (batch_idx + 1)
+                # Evaluation shards are not padded and ranks may run a different number of batches,
+                # so the models run without their DistributedDataParallel wrappers
+                with self.precision.autocast():
+                    image_embeddings = self.get_image_embeddings(batch_data[0].to(self.device),
+                                                                 image_model=self.image_model)
+                    outputs = self.forward_batch(batch_data, model=self.model, image_embeddings=image_embeddings)
+                batch_size = batch_data[2].input_ids.size(0)
+                total_loss += outputs.loss.detach() * batch_size
+                num_samples += batch_size
+                self.metrics.add(loss_name, outputs.loss)
+                if (batch_idx + 1) % self.log_freq == 0:
+                    self.metrics.flush()
+                    progress_bar.set_postfix(loss=self.metrics.last(loss_name))
+                self.profiler.step(len(batch_data[0]))
+        self.metrics.flush()
+        self.log_profile(f'{step} Epoch {epoch}')
+
+        # Mean over the samples of all ranks, every sample is in exactly one shard
+        total_loss, num_samples = all_reduce_sum(total_loss.item(), num_samples)
+        return total_loss / num_samples
 
     def predict(self,
                 dataloader,
@@ -148,20 +411,25 @@ class MultiModalModel:
                 calculate_rouge_score=True,
                 experiment_setting='vqa'):
 
+        # nltk and torchmetrics are only imported when predicting
+        from evaluation_metrics import compute_bleu_scores, compute_bert_score, compute_rouge_score, compute_meteor_score
+
         self.model.eval()
+        self.image_model.eval()
         progress_bar = tqdm(dataloader)
         progress_bar.set_description('Inference')
         bleu_scores, bert_scores, rouge_scores, meteor_scores = [], [], [], []
         columns = self.wandb_column_names(experiment_setting)
-        wandb_table = wandb.Table(columns=columns)
+        wandb_table = self.logger.table(columns=columns)
 
         model_inputs = []
         predictions = []
         targets = []
         images = []
 
+        self.profiler.start_loop('predict')
         with torch.no_grad():
-            for batch_idx, batch_data in enumerate(progress_bar):
+            for batch_idx, batch_data in enumerate(self.profiler.iterate(progress_bar)):
                 image_pixel_values = batch_data[0].to(self.device)
                 input_encodings = batch_data[1].to(self.device)
                 input_ids = input_encodings.input_ids
@@ -169,12 +437,15 @@ class MultiModalModel:
                 reference_text = batch_data[2]
                 image_file_name = batch_data[3]
 
-                image_embeddings = self.image_model(image_pixel_values).last_hidden_state
-                generated_ids = self.model.generate(input_ids=input_ids,
-                                                    attention_mask=input_attention_mask,
-                                                    image_embeddings=image_embeddings,
-                                                    num_beams=self.beam_size,
-                                                    max_length=24)
+                with self.precision.autocast():
+                    image_embeddings = self.get_image_embeddings(image_pixel_values)
+                    with self.profiler.phase('generate'):
+                        generated_ids = self.model.generate(input_ids=input_ids,
+                                                            attention_mask=input_attention_mask,
+                                                            image_embeddings=image_embeddings,
+                                                            num_beams=self.beam_size,
+                                                            max_length=24,
+                                                            template_mask_token_id=self.template_mask_token_id)
                 generated_text = self.tokenizer.batch_decode(generated_ids,
                                                              skip_special_tokens=True,
                                                              clean_up_tokenization_spaces=False)
@@ -199,18 +470,19 @@ class MultiModalModel:
                         f.write(f"{target}\n")
 
                 # Evaluation Metrics
-                if calculate_bleu_score:
-                    avg_bleu_score, bleu_score_list = compute_bleu_scores(generated_text, reference_text)
-                    bleu_scores += bleu_score_list
-                if calculate_bert_score:
-                    avg_bert_score, bert_score_list = compute_bert_score(generated_text, reference_text)
-                    bert_scores += bert_score_list
-                if calculate_rouge_score:
-                    avg_rouge_score, rouge_score_list = compute_rouge_score(generated_text, reference_text)
-                    rouge_scores += rouge_score_list
-                if calculate_meteor_score:
-                    avg_meteor_score, meteor_score_list = compute_meteor_score(generated_text, reference_text)
-                    meteor_scores += meteor_score_list
+                with self.profiler.phase('metrics'):
+                    if calculate_bleu_score:
+                        avg_bleu_score, bleu_score_list = compute_bleu_scores(generated_text, reference_text)
+                        bleu_scores += bleu_score_list
+                    if calculate_bert_score:
+                        avg_bert_score, bert_score_list = compute_bert_score(generated_text, reference_text)
+                        bert_scores += bert_score_list
+                    if calculate_rouge_score:
+                        avg_rouge_score, rouge_score_list = compute_rouge_score(generated_text, reference_text)
+                        rouge_scores += rouge_score_list
+                    if calculate_meteor_score:
+                        avg_meteor_score, meteor_score_list = compute_meteor_score(generated_text, reference_text)
+                        meteor_scores += meteor_score_list
                 progress_bar.set_postfix(bleu_score=avg_bleu_score)
 
                 # If batch size is 1, log every 10 the image else log first image in batch
@@ -227,15 +499,18 @@ class MultiModalModel:
                                             input_text, generated_text, reference_text,
                                             bleu_score_list, rouge_score_list, meteor_score_list,
                                             experiment_setting)
+                self.profiler.step(len(batch_data[0]))
 
+        self.log_profile('Inference')
 
         # Log and Save results after prediction
-        wandb.log({'Bleu Score': round(sum(bleu_scores) / len(bleu_scores), 2),
-                   # 'Bert Score': round(sum(bert_scores) / len(bert_scores), 2),
-                   'Rouge Score': round(sum(rouge_scores) / len(rouge_scores), 2),
-                   'Meteor Score': round(sum(meteor_scores) / len(meteor_scores), 2),
-                   f'{filename} Prediction Samples': wandb_table,
-                   })
+        self.metrics.log({'Bleu Score': round(sum(bleu_scores) / len(bleu_scores), 2),
+                          # 'Bert Score': round(sum(bert_scores) / len(bert_scores), 2),
+                          'Rouge Score': round(sum(rouge_scores) / len(rouge_scores), 2),
+                          'Meteor Score': round(sum(meteor_scores) / len(meteor_scores), 2),
+                          f'{filename} Prediction Samples': wandb_table,
+                          })
+        self.metrics.wait()
 
         with open(f"{self.model_ckpt}_model_inputs.pkl", "wb") as save_file:
             pickle.dump(model_inputs, save_file)
@@ -246,6 +521,13 @@ class MultiModalModel:
         with open(f"{self.model_ckpt}_image_filenames.pkl", "wb") as save_file:
             pickle.dump(images, save_file)
 
+    def log_profile(self, title):
+
+        # Printed by the profiler, logged when it is enabled
+        summary = self.profiler.end_loop(title)
+        if summary:
+            self.metrics.log(summary)
+
     def wandb_column_names(self, experiment_setting):
 
         if experiment_setting == 'flickr30k':
@@ -269,7 +551,7 @@ class MultiModalModel:
 
         if experiment_setting == 'vqa':
             wandb_table.add_data(
-                wandb.Image(f'datasets/vqa_images/val/{img_filename[0]}'),
+                self.logger.image(f'datasets/vqa_images/val/{img_filename[0]}'),
                 input_text[0],
                 generated_text[0],
                 reference_text[0],
@@ -280,7 +562,7 @@ class MultiModalModel:
             )
         else:
             wandb_table.add_data(
-                wandb.Image(f'datasets/vqa_images/val/{img_filename[0]}'),
+                self.logger.image(f'datasets/vqa_images/val/{img_filename[0]}'),
                 generated_text[0],
                 reference_text[0],
                 bleu_scores[0],
@@ -290,4 +572,12 @@ class MultiModalModel:
             )
 
     def save_pretrained(self, path):
+        if self.checkpoint_writer is not None:
+            models = {'': self.model}
+            if self.vision_encoder_policy != 'frozen':
+                models['vision_encoder'] = self.image_model
+            self.checkpoint_writer.save(path, models)
+            return
         self.model.save_pretrained(path)
+        if self.vision_encoder_policy != 'frozen':
+            self.image_model.save_pretrained(os.path.join(path, 'vision_encoder'))
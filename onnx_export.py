@@ -0,0 +1,219 @@
+import argparse
+import inspect
+import json
+import os
+
+import torch
+from torch import nn
+
+from modelling_bartMultiModal import BartMultiModalGenerationModel
+from onnx_generation import (
+    VISION_ENCODER_FILE,
+    ENCODER_FILE,
+    DECODER_INIT_FILE,
+    DECODER_WITH_PAST_FILE,
+    GENERATION_CONFIG_FILE,
+    GENERATION_CONFIG_KEYS,
+    past_names,
+)
+
+'''
+Export the multi modal model to ONNX as four graphs that onnx_generation.py runs with ONNX Runtime:
+vision_encoder.onnx: pixel_values -> image_embeddings (ViT last_hidden_state)
+encoder.onnx: input_ids, attention_mask, image_embeddings -> encoder_hidden_states, encoder_attention_mask
+    (text encoder and image fusion, the visual resampler included)
+decoder_init.onnx: first decoder step, also returns the self and cross attention keys/values of every layer
+decoder_with_past.onnx: one decoder step on the cached keys/values
+'''
+
+
+class VisionEncoder(nn.Module):
+
+    def __init__(self, image_model):
+        super().__init__()
+        self.image_model = image_model
+
+    def forward(self, pixel_values):
+        return self.image_model(pixel_values=pixel_values, return_dict=True).last_hidden_state
+
+
+class TextEncoderWithFusion(nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.get_encoder()
+
+    def forward(self, input_ids, attention_mask, image_embeddings):
+
+        # Same result as encoder.fuse, with a concat instead of the in place writes into a view of
+        # the fused buffer, which the ONNX tracer does not record
+        text_embeddings = self.encoder(input_ids=input_ids,
+                                       attention_mask=attention_mask,
+                                       return_dict=True).last_hidden_state
+        image_embeddings = self.encoder.image_prefix(image_embeddings, text_embeddings.dtype)
+        encoder_hidden_states = torch.cat([image_embeddings, text_embeddings], dim=1)
+        encoder_attention_mask = torch.cat([attention_mask.new_ones(image_embeddings.size()[:2]), attention_mask], dim=1)
+        return encoder_hidden_states, encoder_attention_mask
+
+
+class DecoderInit(nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.decoder = model.model.decoder
+        self.lm_head = model.lm_head
+        self.register_buffer('final_logits_bias', model.final_logits_bias)
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask):
+
+        decoder_outputs = self.decoder(input_ids=decoder_input_ids,
+                                       encoder_hidden_states=encoder_hidden_states,
+                                       encoder_attention_mask=encoder_attention_mask,
+                                       use_cache=True,
+                                       return_dict=True)
+        logits = self.lm_head(decoder_outputs.last_hidden_state[:, -1]) + self.final_logits_bias
+        return (logits,) + tuple(state for layer_past in decoder_outputs.past_key_values for state in layer_past)
+
+
+class DecoderWithPast(nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.decoder = model.model.decoder
+        self.lm_head = model.lm_head
+        self.register_buffer('final_logits_bias', model.final_logits_bias)
+
+    def forward(self, decoder_input_ids, encoder_attention_mask, *past):
+
+        past_key_values = tuple(tuple(past[i:i + 4]) for i in range(0, len(past), 4))
+        # Cross attention keys/values come from the past, the encoder states are only checked for None
+        # to apply encoder_attention_mask. The cached cross attention key is passed in their place.
+        decoder_outputs = self.decoder(input_ids=decoder_input_ids,
+                                       encoder_hidden_states=past[2],
+                                       encoder_attention_mask=encoder_attention_mask,
+                                       past_key_values=past_key_values,
+                                       use_cache=True,
+                                       return_dict=True)
+        logits = self.lm_head(decoder_outputs.last_hidden_state[:, -1]) + self.final_logits_bias
+        # Only the self attention keys/values change, the cross attention ones stay those of decoder_init
+        return (logits,) + tuple(state for layer_past in decoder_outputs.past_key_values for state in layer_past[:2])
+
+
+def _export(module, args, path, input_names, output_names, dynamic_axes, opset_version):
+
+    # Newer torch versions default to the dynamo exporter, these graphs use the TorchScript exporter
+    export_kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    # The export restores the training mode of the wrapper afterwards, which would put the wrapped
+    # model back in training mode if the wrapper was left in its default mode
+    torch.onnx.export(module.eval(),
+                      args,
+                      path,
+                      input_names=input_names,
+                      output_names=output_names,
+                      dynamic_axes=dynamic_axes,
+                      opset_version=opset_version,
+                      do_constant_folding=True,
+                      **export_kwargs)
+
+
+def export_multi_modal_model(model, image_model, output_dir, image_size=224, opset_version=14):
+
+    '''
+    :param model: BartMultiModalGenerationModel (fp32)
+    :param image_model: ViTModel, not exported when None (image embeddings from an ImageEmbeddingStore)
+    '''
+
+    os.makedirs(output_dir, exist_ok=True)
+    model = model.to('cpu').eval()
+    config = model.config
+    num_layers = config.decoder_layers
+    hidden_size = config.d_model
+    batch_size, text_length, decoder_length = 2, 5, 3
+
+    with torch.no_grad():
+        if image_model is not None:
+            image_model = image_model.to('cpu').eval()
+            pixel_values = torch.randn(batch_size, 3, image_size, image_size)
+            _export(VisionEncoder(image_model), (pixel_values,), os.path.join(output_dir, VISION_ENCODER_FILE),
+                    input_names=['pixel_values'],
+                    output_names=['image_embeddings'],
+                    dynamic_axes={'pixel_values': {0: 'batch'}, 'image_embeddings': {0: 'batch'}},
+                    opset_version=opset_version)
+            image_embeddings = VisionEncoder(image_model)(pixel_values)
+        else:
+            image_embeddings = torch.randn(batch_size, 197, getattr(config, 'image_embedding_dim', None) or hidden_size)
+
+        input_ids = torch.full((batch_size, text_length), config.pad_token_id, dtype=torch.long)
+        input_ids[:, 0] = config.bos_token_id
+        input_ids[:, 1:text_length - 1] = 4
+        input_ids[:, text_length - 1] = config.eos_token_id
+        attention_mask = torch.ones(batch_size, text_length, dtype=torch.long)
+        encoder = TextEncoderWithFusion(model)
+        _export(encoder, (input_ids, attention_mask, image_embeddings), os.path.join(output_dir, ENCODER_FILE),
+                input_names=['input_ids', 'attention_mask', 'image_embeddings'],
+                output_names=['encoder_hidden_states', 'encoder_attention_mask'],
+                dynamic_axes={'input_ids': {0: 'batch', 1: 'text_length'},
+                              'attention_mask': {0: 'batch', 1: 'text_length'},
+                              'image_embeddings': {0: 'batch', 1: 'image_length'},
+                              'encoder_hidden_states': {0: 'batch', 1: 'encoder_length'},
+                              'encoder_attention_mask': {0: 'batch', 1: 'encoder_length'}},
+                opset_version=opset_version)
+        encoder_hidden_states, encoder_attention_mask = encoder(input_ids, attention_mask, image_embeddings)
+
+        present = past_names('present', num_layers)
+        decoder_input_ids = torch.full((batch_size, 1), config.decoder_start_token_id, dtype=torch.long)
+        past_axes = {name: {0: 'batch', 2: 'past_length' if 'decoder.' in name else 'encoder_length'}
+                     for name in present}
+        _export(DecoderInit(model), (decoder_input_ids, encoder_hidden_states, encoder_attention_mask),
+                os.path.join(output_dir, DECODER_INIT_FILE),
+                input_names=['decoder_input_ids', 'encoder_hidden_states', 'encoder_attention_mask'],
+                output_names=['logits'] + present,
+                dynamic_axes=dict({'decoder_input_ids': {0: 'batch'},
+                                   'encoder_hidden_states': {0: 'batch', 1: 'encoder_length'},
+                                   'encoder_attention_mask': {0: 'batch', 1: 'encoder_length'},
+                                   'logits': {0: 'batch'}}, **past_axes),
+                opset_version=opset_version)
+
+        past = DecoderInit(model)(decoder_input_ids, encoder_hidden_states, encoder_attention_mask)[1:]
+        # Grow the self attention past to decoder_length so that the traced graph does not assume length 1
+        past = tuple(torch.cat([state] * decoder_length, dim=2) if i % 4 < 2 else state for i, state in enumerate(past))
+        past_inputs = past_names('past', num_layers)
+        self_present = [name for name in present if 'decoder.' in name]
+        _export(DecoderWithPast(model), (decoder_input_ids, encoder_attention_mask) + past,
+                os.path.join(output_dir, DECODER_WITH_PAST_FILE),
+                input_names=['decoder_input_ids', 'encoder_attention_mask'] + past_inputs,
+                output_names=['logits'] + self_present,
+                dynamic_axes=dict({'decoder_input_ids': {0: 'batch'},
+                                   'encoder_attention_mask': {0: 'batch', 1: 'encoder_length'},
+                                   'logits': {0: 'batch'}},
+                                  **{name: {0: 'batch', 2: 'past_length' if 'decoder.' in name else 'encoder_length'}
+                                     for name in past_inputs},
+                                  **{name: {0: 'batch', 2: 'present_length'} for name in self_present}),
+                opset_version=opset_version)
+
+    generation_config = {key: getattr(config, key) for key in GENERATION_CONFIG_KEYS}
+    with open(os.path.join(output_dir, GENERATION_CONFIG_FILE), 'w') as f:
+        json.dump(generation_config, f, indent=2)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_ckpt', type=str, required=True)
+    parser.add_argument('--image_encoder', type=str, default='google/vit-base-patch16-224-in21k',
+                        help='used when the checkpoint has no trained vision_encoder')
+    parser.add_argument('--skip_vision_encoder', action='store_true',
+                        help='do not export the ViT, e.g. when serving from an ImageEmbeddingStore')
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--opset_version', type=int, default=14)
+
+    args = parser.parse_args()
+
+    image_model = None
+    if not args.skip_vision_encoder:
+        from transformers import ViTModel
+        vision_path = os.path.join(args.model_ckpt, 'vision_encoder')
+        image_model = ViTModel.from_pretrained(vision_path if os.path.isdir(vision_path) else args.image_encoder)
+    model = BartMultiModalGenerationModel.from_pretrained(args.model_ckpt)
+    export_multi_modal_model(model, image_model, args.output_dir, opset_version=args.opset_version)
+    print(f'Exported ONNX graphs to {args.output_dir}')
@@ -0,0 +1,351 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+'''
+ONNX Runtime (CPU) generation for the graphs of onnx_export.py.
+Greedy and beam search follow Hugging Face generate (transformers 4.23): log softmax scores, the
+no_repeat_ngram, repetition penalty, min_length, forced bos/eos processors, BeamSearchScorer
+hypotheses with length_penalty and early_stopping, so the generated ids are the same as model.generate.
+Only numpy and onnxruntime are needed at serving time.
+'''
+
+VISION_ENCODER_FILE = 'vision_encoder.onnx'
+ENCODER_FILE = 'encoder.onnx'
+DECODER_INIT_FILE = 'decoder_init.onnx'
+DECODER_WITH_PAST_FILE = 'decoder_with_past.onnx'
+GENERATION_CONFIG_FILE = 'generation_config.json'
+
+GENERATION_CONFIG_KEYS = ['decoder_start_token_id', 'bos_token_id', 'eos_token_id', 'pad_token_id',
+                          'forced_bos_token_id', 'forced_eos_token_id', 'num_beams', 'max_length', 'min_length',
+                          'no_repeat_ngram_size', 'repetition_penalty', 'length_penalty', 'early_stopping',
+                          'decoder_layers', 'vocab_size']
+
+
+def past_names(prefix, num_layers):
+
+    # Per layer: self attention key and value, then cross attention key and value (Hugging Face order)
+    return [f'{prefix}.{layer}.{name}'
+            for layer in range(num_layers)
+            for name in ['decoder.key', 'decoder.value', 'encoder.key', 'encoder.value']]
+
+
+def log_softmax(logits):
+
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=-1, keepdims=True))
+
+
+def top_k(scores, k):
+
+    '''
+    Indices of the k largest scores of every row, largest first and ties in index order.
+    Sorting only the candidates at least as large as the k-th largest is much cheaper than
+    sorting num_beams * vocab_size scores.
+    '''
+
+    kth = -np.partition(-scores, k - 1, axis=1)[:, k - 1]
+    top = np.empty((len(scores), k), dtype=np.int64)
+    for row, (row_scores, threshold) in enumerate(zip(scores, kth)):
+        candidates = np.flatnonzero(row_scores >= threshold)
+        top[row] = candidates[np.argsort(-row_scores[candidates], kind='stable')[:k]]
+    return top
+
+
+class BeamHypotheses:
+
+    '''
+    Finished hypotheses of one input, the num_beams best by length normalised score are kept
+    '''
+
+    def __init__(self, num_beams, length_penalty, early_stopping):
+
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+        self.beams = []
+        self.worst_score = 1e9
+
+    def add(self, hypothesis, sum_logprobs):
+
+        score = sum_logprobs / (len(hypothesis) ** self.length_penalty)
+        if len(self.beams) < self.num_beams or score > self.worst_score:
+            self.beams.append((score, hypothesis))
+            if len(self.beams) > self.num_beams:
+                sorted_scores = sorted([(s, idx) for idx, (s, _) in enumerate(self.beams)])
+                del self.beams[sorted_scores[0][1]]
+                self.worst_score = sorted_scores[1][0]
+            else:
+                self.worst_score = min(score, self.worst_score)
+
+    def is_done(self, best_sum_logprobs, cur_len):
+
+        if len(self.beams) < self.num_beams:
+            return False
+        if self.early_stopping:
+            return True
+        return self.worst_score >= best_sum_logprobs / cur_len ** self.length_penalty
+
+
+class OnnxMultiModalGenerator:
+
+    def __init__(self, export_dir, num_threads=None):
+
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+
+        def session(file_name):
+            path = os.path.join(export_dir, file_name)
+            if not os.path.exists(path):
+                return None
+            return onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+        self.vision_encoder = session(VISION_ENCODER_FILE)
+        self.encoder = session(ENCODER_FILE)
+        self.decoder_init = session(DECODER_INIT_FILE)
+        self.decoder_with_past = session(DECODER_WITH_PAST_FILE)
+        with open(os.path.join(export_dir, GENERATION_CONFIG_FILE)) as f:
+            self.config = json.load(f)
+        num_layers = self.config['decoder_layers']
+        self.present_names = past_names('present', num_layers)
+        self.past_names = past_names('past', num_layers)
+        self.self_present_names = [name for name in self.present_names if 'decoder.' in name]
+
+    def image_embeddings(self, pixel_values):
+
+        if self.vision_encoder is None:
+            raise ValueError('The vision encoder was not exported, pass image_embeddings')
+        return self.vision_encoder.run(None, {'pixel_values': pixel_values.astype(np.float32)})[0]
+
+    def encode(self, input_ids, attention_mask, image_embeddings):
+
+        return self.encoder.run(None, {'input_ids': input_ids.astype(np.int64),
+                                       'attention_mask': attention_mask.astype(np.int64),
+                                       'image_embeddings': image_embeddings.astype(np.float32)})
+
+    def _process_scores(self, sequences, scores, max_length, min_length, no_repeat_ngram_size, repetition_penalty):
+
+        '''
+        Logits processors in the order of generate, applied in place to scores (batch, vocab)
+        '''
+
+        cur_len = sequences.shape[1]
+        if repetition_penalty != 1.0:
+            rows = np.arange(len(sequences))[:, None]
+            previous = scores[rows, sequences]
+            scores[rows, sequences] = np.where(previous < 0, previous * repetition_penalty,
+                                               previous / repetition_penalty)
+        if no_repeat_ngram_size and cur_len + 1 >= no_repeat_ngram_size:
+            for row, sequence in enumerate(sequences.tolist()):
+                prefix = tuple(sequence[cur_len + 1 - no_repeat_ngram_size:])
+                banned = [sequence[i + no_repeat_ngram_size - 1]
+                          for i in range(cur_len - no_repeat_ngram_size + 1)
+                          if tuple(sequence[i:i + no_repeat_ngram_size - 1]) == prefix]
+                scores[row, banned] = -np.inf
+        eos_token_id = self.config['eos_token_id']
+        if min_length and cur_len < min_length:
+            scores[:, eos_token_id] = -np.inf
+        forced_bos_token_id = self.config['forced_bos_token_id']
+        if forced_bos_token_id is not None and cur_len == 1:
+            scores[:] = -np.inf
+            scores[:, forced_bos_token_id] = 0
+        forced_eos_token_id = self.config['forced_eos_token_id']
+        if forced_eos_token_id is not None and cur_len == max_length - 1:
+            scores[:] = -np.inf
+            scores[:, forced_eos_token_id] = 0
+        return scores
+
+    def _decoder_step(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask, past):
+
+        '''
+        :return: (logits of the last position, past with the self attention keys/values of this step)
+        '''
+
+        if past is None:
+            outputs = self.decoder_init.run(None, {'decoder_input_ids': decoder_input_ids,
+                                                   'encoder_hidden_states': encoder_hidden_states,
+                                                   'encoder_attention_mask': encoder_attention_mask})
+            return outputs[0], outputs[1:]
+        inputs = dict(zip(self.past_names, past))
+        inputs['decoder_input_ids'] = decoder_input_ids
+        inputs['encoder_attention_mask'] = encoder_attention_mask
+        outputs = self.decoder_with_past.run(None, inputs)
+        # Cross attention keys/values are kept from decoder_init
+        new_past = list(past)
+        for i, state in enumerate(outputs[1:]):
+            new_past[4 * (i // 2) + i % 2] = state
+        return outputs[0], new_past
+
+    def generate(self,
+                 input_ids,
+                 attention_mask=None,
+                 image_embeddings=None,
+                 pixel_values=None,
+                 num_beams=None,
+                 max_length=None,
+                 min_length=None,
+                 no_repeat_ngram_size=None,
+                 repetition_penalty=None,
+                 length_penalty=None,
+                 early_stopping=None):
+
+        '''
+        Same arguments and defaults (from the model config) as model.generate
+        :return: int64 array (batch, generated length) of generated ids
+        '''
+
+        config = self.config
+        num_beams = num_beams if num_beams is not None else config['num_beams']
+        max_length = max_length if max_length is not None else config['max_length']
+        min_length = min_length if min_length is not None else config['min_length']
+        no_repeat_ngram_size = no_repeat_ngram_size if no_repeat_ngram_size is not None else config['no_repeat_ngram_size']
+        repetition_penalty = repetition_penalty if repetition_penalty is not None else config['repetition_penalty']
+        length_penalty = length_penalty if length_penalty is not None else config['length_penalty']
+        early_stopping = early_stopping if early_stopping is not None else config['early_stopping']
+        processor_args = (max_length, min_length, no_repeat_ngram_size, repetition_penalty)
+
+        if image_embeddings is None:
+            image_embeddings = self.image_embeddings(pixel_values)
+        if attention_mask is None:
+            attention_mask = (input_ids != config['pad_token_id']).astype(np.int64)
+        encoder_hidden_states, encoder_attention_mask = self.encode(input_ids, attention_mask, image_embeddings)
+
+        # The encoder runs once, its outputs are repeated for the beams
+        batch_size = len(input_ids)
+        encoder_hidden_states = np.repeat(encoder_hidden_states, num_beams, axis=0)
+        encoder_attention_mask = np.repeat(encoder_attention_mask, num_beams, axis=0)
+        sequences = np.full((batch_size * num_beams, 1), config['decoder_start_token_id'], dtype=np.int64)
+        if num_beams == 1:
+            return self._greedy_search(sequences, encoder_hidden_states, encoder_attention_mask, processor_args)
+        return self._beam_search(sequences, encoder_hidden_states, encoder_attention_mask, batch_size, num_beams,
+                                 length_penalty, early_stopping, processor_args)
+
+    def _greedy_search(self, sequences, encoder_hidden_states, encoder_attention_mask, processor_args):
+
+        eos_token_id, pad_token_id = self.config['eos_token_id'], self.config['pad_token_id']
+        max_length = processor_args[0]
+        unfinished = np.ones(len(sequences), dtype=np.int64)
+        past = None
+        while True:
+            logits, past = self._decoder_step(sequences[:, -1:], encoder_hidden_states, encoder_attention_mask, past)
+            scores = self._process_scores(sequences, logits, *processor_args)
+            next_tokens = scores.argmax(axis=-1)
+            next_tokens = next_tokens * unfinished + pad_token_id * (1 - unfinished)
+            sequences = np.concatenate([sequences, next_tokens[:, None]], axis=1)
+            unfinished = unfinished * (next_tokens != eos_token_id)
+            if unfinished.max() == 0 or sequences.shape[1] >= max_length:
+                return sequences
+
+    def _beam_search(self, sequences, encoder_hidden_states, encoder_attention_mask, batch_size, num_beams,
+                     length_penalty, early_stopping, processor_args):
+
+        eos_token_id, pad_token_id = self.config['eos_token_id'], self.config['pad_token_id']
+        max_length = processor_args[0]
+        hypotheses = [BeamHypotheses(num_beams, length_penalty, early_stopping) for _ in range(batch_size)]
+        done = [False] * batch_size
+        beam_scores = np.zeros((batch_size, num_beams), dtype=np.float32)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.reshape(-1)
+        past = None
+
+        while True:
+            cur_len = sequences.shape[1]
+            logits, past = self._decoder_step(sequences[:, -1:], encoder_hidden_states, encoder_attention_mask, past)
+            scores = self._process_scores(sequences, log_softmax(logits), *processor_args)
+            scores = (scores + beam_scores[:, None]).reshape(batch_size, -1)
+            vocab_size = logits.shape[-1]
+
+            # Top 2 * num_beams candidates per input, so num_beams remain if some of them end with eos
+            top = top_k(scores, 2 * num_beams)
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            top_beams, top_tokens = top // vocab_size, top % vocab_size
+
+            next_scores = np.zeros((batch_size, num_beams), dtype=np.float32)
+            next_tokens = np.full((batch_size, num_beams), pad_token_id, dtype=np.int64)
+            next_indices = np.zeros((batch_size, num_beams), dtype=np.int64)
+            for batch_idx in range(batch_size):
+                if done[batch_idx]:
+                    continue
+                beam_idx = 0
+                for rank in range(2 * num_beams):
+                    batch_beam_idx = batch_idx * num_beams + top_beams[batch_idx, rank]
+                    if top_tokens[batch_idx, rank] == eos_token_id:
+                        # eos outside the top num_beams candidates is not a finished hypothesis
+                        if rank < num_beams:
+                            hypotheses[batch_idx].add(sequences[batch_beam_idx].copy(),
+                                                      float(top_scores[batch_idx, rank]))
+                    else:
+                        next_scores[batch_idx, beam_idx] = top_scores[batch_idx, rank]
+                        next_tokens[batch_idx, beam_idx] = top_tokens[batch_idx, rank]
+                        next_indices[batch_idx, beam_idx] = batch_beam_idx
+                        beam_idx += 1
+                    if beam_idx == num_beams:
+                        break
+                done[batch_idx] = hypotheses[batch_idx].is_done(float(top_scores[batch_idx].max()), cur_len)
+
+            beam_scores = next_scores.reshape(-1)
+            beam_indices = next_indices.reshape(-1)
+            sequences = np.concatenate([sequences[beam_indices], next_tokens.reshape(-1, 1)], axis=1)
+            # Self attention keys/values follow their beams, cross attention ones are the same for all beams
+            past = [state[beam_indices] if i % 4 < 2 else state for i, state in enumerate(past)]
+            if all(done) or sequences.shape[1] >= max_length:
+                break
+
+        # Open beams of unfinished inputs become hypotheses
+        for batch_idx in range(batch_size):
+            if done[batch_idx]:
+                continue
+            for beam_id in range(num_beams):
+                batch_beam_idx = batch_idx * num_beams + beam_id
+                hypotheses[batch_idx].add(sequences[batch_beam_idx], float(beam_scores[batch_beam_idx]))
+
+        best = [max(hypothesis.beams, key=lambda beam: beam[0])[1] for hypothesis in hypotheses]
+        lengths = [len(hypothesis) for hypothesis in best]
+        output_length = min(max(lengths) + 1, max_length)
+        outputs = np.full((batch_size, output_length), pad_token_id, dtype=np.int64)
+        for i, hypothesis in enumerate(best):
+            outputs[i, :lengths[i]] = hypothesis
+            if lengths[i] < output_length:
+                outputs[i, lengths[i]] = eos_token_id
+        return outputs
+
+
+if __name__ == '__main__':
+
+    '''
+    Caption images with the exported graphs
+    '''
+
+    from PIL import Image
+    from transformers import BartTokenizer, ViTFeatureExtractor
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--export_dir', type=str, required=True)
+    parser.add_argument('--image_locations', type=str, nargs='+', required=True)
+    parser.add_argument('--input_text', type=str, default='', help='e.g. "A squirrel <mask>"')
+    parser.add_argument('--image_encoder', type=str, default='google/vit-base-patch16-224-in21k')
+    parser.add_argument('--tokenizer', type=str, default='facebook/bart-base')
+    parser.add_argument('--num_beams', type=int, default=5)
+    parser.add_argument('--max_length', type=int, default=24)
+
+    args = parser.parse_args()
+
+    tokenizer = BartTokenizer.from_pretrained(args.tokenizer)
+    feature_extractor = ViTFeatureExtractor.from_pretrained(args.image_encoder)
+    generator = OnnxMultiModalGenerator(args.export_dir)
+    images = [Image.open(image_location).convert('RGB') for image_location in args.image_locations]
+    pixel_values = feature_extractor(images, return_tensors='np').pixel_values
+    encodings = tokenizer([args.input_text] * len(images), padding='longest', return_tensors='np')
+    generated_ids = generator.generate(encodings.input_ids,
+                                       encodings.attention_mask,
+                                       pixel_values=pixel_values,
+                                       num_beams=args.num_beams,
+                                       max_length=args.max_length)
+    for image_location, caption in zip(args.image_locations,
+                                       tokenizer.batch_decode(generated_ids, skip_special_tokens=True)):
+        print(f'{image_location}: {caption}')
@@ -0,0 +1,130 @@
+import numpy as np
+
+
+class PackedStrings:
+
+    '''
+    List of strings stored as one contiguous UTF-8 buffer and int64 offsets.
+    String i is data[offsets[i]:offsets[i + 1]]. There is no Python object per string, whose reference
+    counts would make forked DataLoader workers turn the shared pages into private copies, so the arrays
+    can be memory mapped and shared by the workers. The datasets keep all their per-sample data this way.
+    '''
+
+    def __init__(self, data, offsets):
+
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, strings):
+
+        encoded = [x.encode('utf-8') for x in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in encoded], out=offsets[1:])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8).copy()
+        return cls(data, offsets)
+
+    @classmethod
+    def load(cls, path_prefix, mmap_mode='r'):
+
+        return cls(np.load(f'{path_prefix}_data.npy', mmap_mode=mmap_mode),
+                   np.load(f'{path_prefix}_offsets.npy', mmap_mode=mmap_mode))
+
+    def save(self, path_prefix):
+
+        np.save(f'{path_prefix}_data.npy', self.data)
+        np.save(f'{path_prefix}_offsets.npy', self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+    def lengths(self):
+        '''
+        Length in bytes of every string
+        '''
+        return np.diff(self.offsets)
+
+    def searchsorted(self, value):
+
+        '''
+        Position of value in the strings, which must be sorted by their UTF-8 bytes (binary search)
+        '''
+
+        value = value.encode('utf-8')
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.data[self.offsets[middle]:self.offsets[middle + 1]].tobytes() < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+class PackedIndex:
+
+    '''
+    Map from strings to rows of int arrays, e.g. image filename -> (shard, row), without a Python object per key.
+    keys are sorted PackedStrings and columns hold the values of every key in the same order.
+    '''
+
+    def __init__(self, keys, columns):
+
+        self.keys = keys
+        self.columns = columns
+
+    @classmethod
+    def from_lists(cls, keys, **columns):
+
+        encoded = np.array([key.encode('utf-8') for key in keys], dtype=object)
+        order = np.argsort(encoded, kind='stable')
+        return cls(PackedStrings.from_list([keys[i] for i in order]),
+                   {name: np.asarray(values, dtype=np.int64)[order] for name, values in columns.items()})
+
+    @classmethod
+    def load(cls, path_prefix, column_names, mmap_mode='r'):
+
+        return cls(PackedStrings.load(f'{path_prefix}_keys', mmap_mode=mmap_mode),
+                   {name: np.load(f'{path_prefix}_{name}.npy', mmap_mode=mmap_mode) for name in column_names})
+
+    def save(self, path_prefix):
+
+        self.keys.save(f'{path_prefix}_keys')
+        for name, values in self.columns.items():
+            np.save(f'{path_prefix}_{name}.npy', values)
+
+    def items(self):
+
+        '''
+        Keys and lists of the column values of every key, e.g. to merge new keys into the index
+        '''
+
+        keys = [self.keys[i] for i in range(len(self.keys))]
+        return keys, {name: values.tolist() for name, values in self.columns.items()}
+
+    def find(self, key):
+
+        '''
+        Position of key in the index, -1 if it is missing
+        '''
+
+        i = self.keys.searchsorted(key)
+        return i if i < len(self.keys) and self.keys[i] == key else -1
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def __getitem__(self, key):
+        '''
+        Values of key in every column
+        '''
+        i = self.find(key)
+        if i < 0:
+            raise KeyError(key)
+        return tuple(int(values[i]) for values in self.columns.values())
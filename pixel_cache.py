@@ -0,0 +1,150 @@
+import argparse
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from PIL import Image
+from tqdm import tqdm
+
+from packed_strings import PackedIndex
+from utils import flickr_image_files, vqa_image_files
+
+
+class PixelCache:
+
+    '''
+    Memory-mapped array of preprocessed images.
+    pixels.npy holds uint8 images of shape (num_images, 3, image_size, image_size),
+    resized the same way as ViTFeatureExtractor. A PackedIndex (index_*.npy) maps image filename -> row.
+    Normalization is left to normalize_pixel_values so that it runs once per batch.
+    '''
+
+    index_prefix = 'index'
+    pixels_file = 'pixels.npy'
+
+    def __init__(self, cache_dir):
+
+        self.cache_dir = cache_dir
+        self.files = PackedIndex.load(os.path.join(cache_dir, self.index_prefix), ['row'])
+        self._pixels = None
+
+    def pixels(self):
+
+        # Copy-on-write mapping gives writable arrays that torch can wrap without a copy
+        if self._pixels is None:
+            self._pixels = np.load(os.path.join(self.cache_dir, self.pixels_file), mmap_mode='c')
+        return self._pixels
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['_pixels'] = None
+        return state
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, image_filename):
+        return image_filename in self.files
+
+    def __getitem__(self, image_filename):
+        '''
+        Return uint8 tensor of shape (3, image_size, image_size) viewing the memory map
+        '''
+        row, = self.files[image_filename]
+        return torch.from_numpy(self.pixels()[row])
+
+
+def normalize_pixel_values(pixels, image_mean, image_std):
+
+    '''
+    Vectorized ViTFeatureExtractor rescale and normalize for a whole batch
+
+    :param pixels: uint8 tensor (batch, 3, height, width)
+    :param image_mean: per channel mean of the feature extractor
+    :param image_std: per channel std of the feature extractor
+    :return: float pixel values
+    '''
+
+    mean = torch.tensor(image_mean, dtype=torch.float32).view(1, -1, 1, 1)
+    std = torch.tensor(image_std, dtype=torch.float32).view(1, -1, 1, 1)
+    return (pixels.float() / 255.0 - mean) / std
+
+
+class ResizedImageDataset(Dataset):
+
+    def __init__(self, image_paths, image_size):
+
+        self.image_paths = image_paths
+        self.image_size = image_size
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, index):
+        img = Image.open(self.image_paths[index]).convert('RGB')
+        img = img.resize((self.image_size, self.image_size), resample=Image.BILINEAR)
+        return torch.from_numpy(np.asarray(img).transpose(2, 0, 1).copy())
+
+
+def build_pixel_cache(image_files, image_paths, cache_dir, image_size=224, batch_size=64, num_workers=12):
+
+    '''
+    One time preprocessing pass writing every image resized to image_size x image_size as uint8
+
+    :param image_files: image filenames used as keys of the cache
+    :param image_paths: paths to read the images from
+    :param cache_dir: output directory
+    :return: PixelCache
+    '''
+
+    os.makedirs(cache_dir, exist_ok=True)
+    pixels = np.lib.format.open_memmap(os.path.join(cache_dir, PixelCache.pixels_file),
+                                       mode='w+',
+                                       dtype=np.uint8,
+                                       shape=(len(image_files), 3, image_size, image_size))
+    dataloader = torch.utils.data.DataLoader(
+        ResizedImageDataset(image_paths, image_size),
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+    )
+    row = 0
+    for batch in tqdm(dataloader, desc='Preprocessing images'):
+        pixels[row:row + len(batch)] = batch.numpy()
+        row += len(batch)
+    pixels.flush()
+    del pixels
+
+    index = PackedIndex.from_lists(image_files, row=range(len(image_files)))
+    index.save(os.path.join(cache_dir, PixelCache.index_prefix))
+    return PixelCache(cache_dir)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='flickr', choices=['flickr', 'vqa'])
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'val'])
+    parser.add_argument('--cache_dir', type=str, default=None)
+    parser.add_argument('--image_size', type=int, default=224)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=12)
+
+    args = parser.parse_args()
+
+    if args.dataset == 'flickr':
+        cache_dir = args.cache_dir or 'datasets/pixel_cache/flickr30k'
+        image_files = flickr_image_files()
+        image_paths = ['datasets/flickr30k_images/' + x for x in image_files]
+    else:
+        # COCO filenames are unique across splits, so all splits share one cache
+        cache_dir = args.cache_dir or 'datasets/pixel_cache/vqa'
+        image_files, image_paths = [], []
+        for split in args.splits:
+            split_files = vqa_image_files(f'datasets/vqa_images/{split}/')
+            image_files += split_files
+            image_paths += [f'datasets/vqa_images/{split}/' + x for x in split_files]
+    build_pixel_cache(image_files, image_paths, cache_dir,
+                      image_size=args.image_size, batch_size=args.batch_size, num_workers=args.num_workers)
@@ -0,0 +1,143 @@
+import contextlib
+import os
+import time
+from collections import OrderedDict
+
+import torch
+
+PHASES = ('data', 'vision', 'text', 'backward', 'optimizer', 'generate', 'metrics')
+
+
+class PhaseProfiler:
+
+    def __init__(self,
+                 enabled=False,
+                 device='cpu',
+                 trace_dir=None,
+                 trace_wait_steps=5,
+                 trace_steps=5):
+
+        '''
+        Wall clock time per phase of the train, test and predict loops:
+        data (waiting for the dataloader), vision (ViT), text (BART forward and loss), backward, optimizer,
+        generate and metrics. At the end of a loop a table with the time per phase and the samples per second is printed.
+        On GPU the phases synchronize the device so that the kernels are timed in their phase.
+
+        :param enabled: time the phases, a disabled profiler adds no synchronization and next to no overhead
+        :param trace_dir: export a torch.profiler Chrome trace (chrome://tracing, perfetto) of trace_steps steps
+        of the first loop of each kind (train, test, predict) to this dir, after trace_wait_steps steps
+        '''
+
+        self.enabled = enabled
+        self.synchronize = enabled and torch.device(device).type == 'cuda'
+        self.trace_dir = trace_dir
+        self.trace_wait_steps = trace_wait_steps
+        self.trace_steps = trace_steps
+        self.traced_loops = set()
+        self.torch_profiler = None
+        self._reset()
+
+    def _reset(self):
+
+        self.seconds = OrderedDict((phase, 0.0) for phase in PHASES)
+        self.num_steps = 0
+        self.num_samples = 0
+        self.start_time = time.perf_counter()
+
+    def phase(self, name):
+
+        '''
+        Context manager timing its block as phase name
+        '''
+
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+            if self.synchronize:
+                torch.cuda.synchronize()
+        self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+
+    def iterate(self, dataloader):
+
+        '''
+        Iterate over dataloader, timing the wait for every batch as the data phase
+        '''
+
+        if not self.enabled:
+            yield from dataloader
+            return
+        iterator = iter(dataloader)
+        while True:
+            with self.phase('data'):
+                try:
+                    batch_data = next(iterator)
+                except StopIteration:
+                    return
+            yield batch_data
+
+    def start_loop(self, name):
+
+        '''
+        Reset the timers, and start the torch profiler for the first loop named name
+        '''
+
+        if not self.enabled:
+            return
+        self._reset()
+        if self.trace_dir is not None and name not in self.traced_loops:
+            self.traced_loops.add(name)
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.synchronize:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            os.makedirs(self.trace_dir, exist_ok=True)
+            trace_file = os.path.join(self.trace_dir, f'{name}_trace.json')
+            self.torch_profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=self.trace_wait_steps, warmup=1, active=self.trace_steps, repeat=1),
+                on_trace_ready=lambda profiler: profiler.export_chrome_trace(trace_file),
+                record_shapes=True)
+            self.torch_profiler.start()
+
+    def step(self, num_samples):
+
+        if not self.enabled:
+            return
+        self.num_steps += 1
+        self.num_samples += num_samples
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+
+    def end_loop(self, title):
+
+        '''
+        Print the time per phase of the loop and stop the torch profiler
+        :return: {'profile/<phase>_seconds': seconds, 'profile/samples_per_second': samples per second}
+        '''
+
+        if not self.enabled:
+            return {}
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
+
+        total = time.perf_counter() - self.start_time
+        other = max(0.0, total - sum(self.seconds.values()))
+        print(f'{title}: {self.num_steps} steps, {self.num_samples} samples, '
+              f'{total:.1f}s, {self.num_samples / total:.1f} samples/s')
+        print(f'{"phase":<10}  {"seconds":>9}  {"%":>6}  {"ms/step":>9}')
+        for phase, seconds in list(self.seconds.items()) + [('other', other)]:
+            if seconds == 0.0:
+                continue
+            print(f'{phase:<10}  {seconds:>9.2f}  {100 * seconds / total:>6.1f}  '
+                  f'{1000 * seconds / max(1, self.num_steps):>9.1f}')
+
+        summary = {f'profile/{phase}_seconds': seconds for phase, seconds in self.seconds.items() if seconds > 0.0}
+        summary['profile/samples_per_second'] = self.num_samples / total
+        return summary
@@ -0,0 +1,92 @@
+import argparse
+import io
+import os
+
+import torch
+from torch import nn
+from transformers import BartConfig, ViTConfig, ViTModel
+
+from modelling_bartMultiModal import BartMultiModalGenerationModel
+
+QUANTIZED_WEIGHTS_NAME = 'quantized_model.pt'
+VISION_ENCODER_DIR = 'vision_encoder'
+
+
+def quantize_dynamic(model):
+
+    '''
+    Dynamic int8 quantization of all nn.Linear layers (attention projections, feed forward layers, lm_head).
+    Weights are stored as int8, activations are quantized on the fly, so no calibration data is needed.
+    Quantized models run on CPU only.
+    '''
+
+    return torch.ao.quantization.quantize_dynamic(model.to('cpu').eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def model_size_mb(model):
+
+    '''
+    Size of the serialized state dict, packed int8 weights included
+    '''
+
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2 ** 20
+
+
+def is_quantized_checkpoint(path):
+    return path is not None and os.path.isfile(os.path.join(path, QUANTIZED_WEIGHTS_NAME))
+
+
+def save_quantized(model, image_model, path):
+
+    '''
+    Save the configs and quantized state dicts of the BART model and the ViT.
+    BART goes to path, the ViT to path/vision_encoder
+    '''
+
+    vision_path = os.path.join(path, VISION_ENCODER_DIR)
+    os.makedirs(vision_path, exist_ok=True)
+    model.config.save_pretrained(path)
+    torch.save(model.state_dict(), os.path.join(path, QUANTIZED_WEIGHTS_NAME))
+    image_model.config.save_pretrained(vision_path)
+    torch.save(image_model.state_dict(), os.path.join(vision_path, QUANTIZED_WEIGHTS_NAME))
+
+
+def load_quantized(path):
+
+    '''
+    Rebuild the quantized module structure from the configs and load the saved int8 weights
+    :return: (BartMultiModalGenerationModel, ViTModel)
+    '''
+
+    vision_path = os.path.join(path, VISION_ENCODER_DIR)
+    model = quantize_dynamic(BartMultiModalGenerationModel(BartConfig.from_pretrained(path)))
+    model.load_state_dict(torch.load(os.path.join(path, QUANTIZED_WEIGHTS_NAME), map_location='cpu'))
+    image_model = quantize_dynamic(ViTModel(ViTConfig.from_pretrained(vision_path)))
+    image_model.load_state_dict(torch.load(os.path.join(vision_path, QUANTIZED_WEIGHTS_NAME), map_location='cpu'))
+    return model, image_model
+
+
+if __name__ == '__main__':
+
+    '''
+    Quantize a trained checkpoint (and its ViT) and save the int8 artifacts
+    '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_ckpt', type=str, required=True)
+    parser.add_argument('--image_encoder', type=str, default='google/vit-base-patch16-224-in21k',
+                        help='used when the checkpoint has no trained vision_encoder')
+    parser.add_argument('--output_dir', type=str, required=True)
+
+    args = parser.parse_args()
+
+    vision_path = os.path.join(args.model_ckpt, VISION_ENCODER_DIR)
+    image_model = ViTModel.from_pretrained(vision_path if os.path.isdir(vision_path) else args.image_encoder)
+    model = BartMultiModalGenerationModel.from_pretrained(args.model_ckpt)
+    print(f'fp32: {model_size_mb(model) + model_size_mb(image_model):.1f} MB')
+    model, image_model = quantize_dynamic(model), quantize_dynamic(image_model)
+    print(f'int8: {model_size_mb(model) + model_size_mb(image_model):.1f} MB')
+    save_quantized(model, image_model, args.output_dir)
+    print(f'Saved quantized model to {args.output_dir}')
@@ -0,0 +1,126 @@
+import itertools
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler, BatchSampler, RandomSampler, SequentialSampler
+
+
+class BucketBatchSampler(Sampler):
+
+    '''
+    Sorted-chunk batch sampler to reduce padding.
+
+    The (shuffled) indices are split into chunks of batch_size * bucket_size_multiplier samples.
+    Each chunk is sorted by length, cut into batches and the order of all batches is shuffled.
+    Samples in a batch have similar lengths while batches still differ between epochs.
+
+    :param lengths: array (num_samples,) or (num_samples, 2) of input and label lengths.
+    With two columns samples are sorted by label length, then by input length.
+    :param num_replicas, rank: distributed training, every rank gets every num_replicas-th batch of the
+    same (seeded) batch order. The batch list is padded with its first batches so that ranks get the same count.
+    :param pad: pad the batch list, without padding every batch is read once and the ranks may differ by one batch
+    '''
+
+    def __init__(self,
+                 lengths,
+                 batch_size,
+                 shuffle=True,
+                 bucket_size_multiplier=100,
+                 drop_last=False,
+                 seed=42,
+                 epoch=0,
+                 num_replicas=1,
+                 rank=0,
+                 pad=True):
+
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = epoch
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.pad = pad
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _sort_keys(self, indices):
+
+        lengths = self.lengths[indices]
+        if lengths.ndim == 1:
+            return np.argsort(lengths, kind='stable')
+        # np.lexsort sorts by the last key first
+        return np.lexsort(lengths.T)
+
+    def batches(self):
+
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            bucket = bucket[self._sort_keys(bucket)]
+            for batch_start in range(0, len(bucket), self.batch_size):
+                batches.append(bucket[batch_start:batch_start + self.batch_size].tolist())
+
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1:
+            num_padding = -len(batches) % self.num_replicas if self.pad else 0
+            batches = (batches + batches[:num_padding])[self.rank::self.num_replicas]
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+
+        num_buckets, last_bucket = divmod(len(self.lengths), self.bucket_size)
+        bucket_sizes = [self.bucket_size] * num_buckets + ([last_bucket] if last_bucket else [])
+        if self.drop_last:
+            num_batches = sum(size // self.batch_size for size in bucket_sizes)
+        else:
+            num_batches = sum(-(-size // self.batch_size) for size in bucket_sizes)
+        if not self.pad:
+            return len(range(self.rank, num_batches, self.num_replicas))
+        return -(-num_batches // self.num_replicas)
+
+
+class SkipBatchSampler(Sampler):
+
+    '''
+    Batches of batch_sampler from batch number start_batch on, to resume an epoch at the batch where it stopped.
+    The batch orders are seeded by the data seed and the epoch, so the skipped batches are the ones already trained on.
+    Skipping only draws the indices of the skipped batches, their samples are not loaded.
+    '''
+
+    def __init__(self, batch_sampler, start_batch=0):
+
+        self.batch_sampler = batch_sampler
+        self.start_batch = start_batch
+
+    def __iter__(self):
+        return itertools.islice(iter(self.batch_sampler), self.start_batch, None)
+
+    def __len__(self):
+        return max(0, len(self.batch_sampler) - self.start_batch)
+
+
+def batch_sampler(dataset, batch_size, shuffle, seed):
+
+    '''
+    Batches of a DataLoader with batch_size and shuffle, but with the shuffle order seeded
+    :param seed: seed of the sample order (data seed + epoch), so that the order can be replayed
+    '''
+
+    if shuffle:
+        sampler = RandomSampler(dataset, generator=torch.Generator().manual_seed(seed))
+    else:
+        sampler = SequentialSampler(dataset)
+    return BatchSampler(sampler, batch_size, drop_last=False)
@@ -0,0 +1,303 @@
+import torch
+from transformers.generation_beam_search import BeamHypotheses
+
+'''
+Beam search over the <mask> spans of a caption template such as "A squirrel <mask> nuts <mask> <mask>".
+The fixed words of the template are copied into the caption instead of being generated: a run of fixed
+tokens goes through the decoder in a single forward pass, and beams are only spent on the spans.
+A span ends when the first token of the next fixed run is chosen (then the whole run is copied), so the
+search decides the span lengths. Consecutive <mask> tokens form one span.
+All hypotheses run through the decoder as one padded batch per step: the new tokens are right padded, the
+cached self attention keys/values of hypotheses of different lengths are masked, and every hypothesis gets the
+positions of its own tokens. The cross attention keys/values are computed once per input and shared by
+all of its hypotheses.
+'''
+
+
+def template_runs(template_ids, mask_token_id, eos_token_id):
+
+    '''
+    Split the template token ids (without padding) at the <mask> spans
+    :return: list of fixed token runs, a span lies between each pair of consecutive runs.
+    The last run ends with eos.
+    '''
+
+    runs = [[]]
+    for token_id in template_ids:
+        if token_id == mask_token_id:
+            if runs[-1] or len(runs) == 1:
+                runs.append([])
+        else:
+            runs[-1].append(token_id)
+    if not runs[-1] or runs[-1][-1] != eos_token_id:
+        runs[-1].append(eos_token_id)
+    return runs
+
+
+class TemplateHypothesis:
+
+    def __init__(self, batch_idx, tokens, score, run_idx, span_length, new_tokens, cache_row):
+
+        self.batch_idx = batch_idx
+        self.tokens = tokens
+        self.score = score
+        # Index of the run that closes the current span
+        self.run_idx = run_idx
+        self.span_length = span_length
+        # Tokens of the next forward pass: one span token or a whole fixed run
+        self.new_tokens = new_tokens
+        # Row of the cached self attention keys/values of tokens[:past_length], None before the first pass
+        self.cache_row = cache_row
+        self.next_logprobs = None
+
+    @property
+    def past_length(self):
+        return len(self.tokens) - len(self.new_tokens)
+
+
+def _additive_mask(allowed, dtype):
+
+    return torch.zeros(allowed.shape, dtype=dtype, device=allowed.device).masked_fill(~allowed, torch.finfo(dtype).min)
+
+
+def _cross_attention_states(model, encoder_hidden_states):
+
+    '''
+    Cross attention keys and values of every decoder layer, (batch, heads, encoder length, head dim) once per input
+    '''
+
+    batch_size = encoder_hidden_states.size(0)
+    states = []
+    for layer in model.model.decoder.layers:
+        attention = layer.encoder_attn
+        states.append((attention._shape(attention.k_proj(encoder_hidden_states), -1, batch_size),
+                       attention._shape(attention.v_proj(encoder_hidden_states), -1, batch_size)))
+    return states
+
+
+def _shared_cross_attention(attention, hidden_states, keys, values, encoder_mask):
+
+    '''
+    BartAttention over the keys/values of the inputs. hidden_states holds num_slots rows per input (row
+    b * num_slots + j is slot j of input b); the slots of an input are folded into the query length, so they
+    attend to the keys and values of their input without a copy per hypothesis.
+    '''
+
+    batch_size, num_heads, _, head_dim = keys.shape
+    rows, length, _ = hidden_states.shape
+    queries = attention.q_proj(hidden_states) * attention.scaling
+    queries = queries.view(batch_size, -1, num_heads, head_dim).transpose(1, 2)
+    weights = torch.softmax(torch.matmul(queries, keys.transpose(-1, -2)) + encoder_mask, dim=-1)
+    outputs = torch.matmul(weights, values).transpose(1, 2).reshape(rows, length, num_heads * head_dim)
+    return attention.out_proj(outputs)
+
+
+def _decoder_step(model, hypotheses, num_inputs, cache, cross_states, encoder_mask):
+
+    '''
+    One forward pass of all hypotheses as a padded batch of num_inputs x num_slots rows.
+    The log probabilities of the new tokens after the first are added to the scores,
+    the first one was scored when it was chosen.
+
+    :param cache: (self attention keys/values of every layer, mask of their valid positions) of the previous
+    step, rows are selected by the cache_row of the hypotheses. None before the first step.
+    :return: cache of this step, the hypotheses point to their rows
+    '''
+
+    decoder = model.model.decoder
+    device = encoder_mask.device
+    slots = [[] for _ in range(num_inputs)]
+    for hypothesis in hypotheses:
+        slots[hypothesis.batch_idx].append(hypothesis)
+    num_slots = max(map(len, slots))
+    rows = num_inputs * num_slots
+    length = max(len(hypothesis.new_tokens) for hypothesis in hypotheses)
+
+    new_tokens = torch.full((rows, length), model.config.pad_token_id, dtype=torch.long)
+    positions = torch.zeros((rows, length), dtype=torch.long)
+    new_valid = torch.zeros((rows, length), dtype=torch.bool)
+    parent_rows = torch.zeros(rows, dtype=torch.long)
+    for batch_idx, batch_hypotheses in enumerate(slots):
+        for j, hypothesis in enumerate(batch_hypotheses):
+            row, num_new = batch_idx * num_slots + j, len(hypothesis.new_tokens)
+            new_tokens[row, :num_new] = torch.tensor(hypothesis.new_tokens)
+            positions[row, :num_new] = torch.arange(hypothesis.past_length, hypothesis.past_length + num_new)
+            new_valid[row, :num_new] = True
+            if hypothesis.cache_row is not None:
+                parent_rows[row] = hypothesis.cache_row
+            hypothesis.cache_row = row
+    new_tokens, positions, new_valid = new_tokens.to(device), positions.to(device), new_valid.to(device)
+
+    if cache is None:
+        past, past_valid = [None] * len(decoder.layers), torch.zeros((rows, 0), dtype=torch.bool, device=device)
+    else:
+        parent_rows = parent_rows.to(device)
+        past = [(keys[parent_rows], values[parent_rows]) for keys, values in cache[0]]
+        past_valid = cache[1][parent_rows] & new_valid[:, :1]
+
+    hidden_states = (decoder.embed_tokens(new_tokens) * decoder.embed_scale +
+                     decoder.embed_positions.weight[positions + decoder.embed_positions.offset])
+    hidden_states = decoder.layernorm_embedding(hidden_states)
+    causal = torch.ones((length, length), dtype=torch.bool, device=device).tril()
+    allowed = torch.cat([past_valid[:, None, :].expand(-1, length, -1), causal & new_valid[:, None, :]], dim=-1)
+    self_mask = _additive_mask(allowed[:, None], hidden_states.dtype)
+
+    next_past = []
+    for layer, layer_past, (keys, values) in zip(decoder.layers, past, cross_states):
+        # BartDecoderLayer.forward in eval mode, with the cross attention shared by the slots of an input
+        residual = hidden_states
+        hidden_states, _, layer_next_past = layer.self_attn(hidden_states=hidden_states,
+                                                            past_key_value=layer_past,
+                                                            attention_mask=self_mask)
+        hidden_states = layer.self_attn_layer_norm(residual + hidden_states)
+        residual = hidden_states
+        hidden_states = _shared_cross_attention(layer.encoder_attn, hidden_states, keys, values, encoder_mask)
+        hidden_states = layer.encoder_attn_layer_norm(residual + hidden_states)
+        residual = hidden_states
+        hidden_states = layer.fc2(layer.activation_fn(layer.fc1(hidden_states)))
+        hidden_states = layer.final_layer_norm(residual + hidden_states)
+        next_past.append(layer_next_past)
+
+    logits = model.lm_head(hidden_states) + model.final_logits_bias
+    logprobs = torch.log_softmax(logits.float(), dim=-1)
+    forced_logprobs = logprobs[:, :-1].gather(-1, new_tokens[:, 1:, None]).squeeze(-1)
+    forced_logprobs = forced_logprobs.masked_fill(~new_valid[:, 1:], 0.0).sum(-1).tolist()
+    for hypothesis in hypotheses:
+        hypothesis.score += forced_logprobs[hypothesis.cache_row]
+        hypothesis.next_logprobs = logprobs[hypothesis.cache_row, len(hypothesis.new_tokens) - 1]
+
+    # Positions that are padding in every row are dropped, so the cache only grows by the longest new tokens
+    valid = torch.cat([past_valid, new_valid], dim=-1)
+    keep = valid.any(0)
+    if not keep.all():
+        next_past = [(keys[:, :, keep], values[:, :, keep]) for keys, values in next_past]
+        valid = valid[:, keep]
+    return next_past, valid
+
+
+@torch.no_grad()
+def template_beam_search(model,
+                         template_ids,
+                         encoder_hidden_states,
+                         encoder_attention_mask,
+                         mask_token_id,
+                         num_beams=5,
+                         max_length=24,
+                         max_span_length=None,
+                         length_penalty=1.0,
+                         early_stopping=False):
+
+    '''
+    :param model: BartMultiModalGenerationModel
+    :param template_ids: list (batch) of template token ids without padding
+    :param encoder_hidden_states: (batch, encoder length, d_model) encoder outputs of the templates
+    :param max_span_length: maximum number of tokens generated for a span, only limited by max_length if None
+    :return: (batch, length) generated ids padded with pad_token_id, like generate
+    '''
+
+    config = model.config
+    vocab_size = model.lm_head.out_features
+    max_span_length = max_span_length or max_length
+    runs = [template_runs(ids, mask_token_id, config.eos_token_id) for ids in template_ids]
+    # Tokens a span may not produce, eos stays allowed when it closes the last span
+    banned_token_ids = torch.tensor([config.bos_token_id, config.pad_token_id, config.eos_token_id, mask_token_id],
+                                    device=encoder_hidden_states.device)
+
+    pending = []
+    for batch_idx, batch_runs in enumerate(runs):
+        if 1 + sum(map(len, batch_runs)) > max_length:
+            raise ValueError(f'Template {batch_idx} does not fit in max_length={max_length}')
+        tokens = [config.decoder_start_token_id] + batch_runs[0]
+        pending.append(TemplateHypothesis(batch_idx, tokens, 0.0, 1, 0, tokens, None))
+    beam_hypotheses = [BeamHypotheses(num_beams, length_penalty, early_stopping) for _ in runs]
+    done = [False] * len(runs)
+    cross_states = _cross_attention_states(model, encoder_hidden_states)
+    encoder_mask = _additive_mask(encoder_attention_mask.bool()[:, None, None, :], encoder_hidden_states.dtype)
+    cache = None
+
+    while pending:
+        # A copied eos alone has no log probabilities left to add
+        decoded = [hypothesis for hypothesis in pending
+                   if hypothesis.run_idx < len(runs[hypothesis.batch_idx]) or len(hypothesis.new_tokens) > 1]
+        if decoded:
+            cache = _decoder_step(model, decoded, len(runs), cache, cross_states, encoder_mask)
+
+        live = [[] for _ in runs]
+        for hypothesis in pending:
+            if hypothesis.run_idx == len(runs[hypothesis.batch_idx]):
+                # The last run (ending with eos) has been copied
+                beam_hypotheses[hypothesis.batch_idx].add(torch.tensor(hypothesis.tokens), hypothesis.score)
+            else:
+                live[hypothesis.batch_idx].append(hypothesis)
+
+        pending = []
+        for batch_idx, hypotheses in enumerate(live):
+            if done[batch_idx] or not hypotheses:
+                done[batch_idx] = True
+                continue
+            best = max(hypotheses, key=lambda hypothesis: hypothesis.score)
+            if beam_hypotheses[batch_idx].is_done(best.score, len(best.tokens)):
+                done[batch_idx] = True
+                continue
+            pending += _select(hypotheses, runs[batch_idx], banned_token_ids, num_beams, vocab_size,
+                               max_length, max_span_length)
+
+    outputs = []
+    for batch_idx, hypotheses in enumerate(beam_hypotheses):
+        if hypotheses.beams:
+            outputs.append(max(hypotheses.beams, key=lambda beam: beam[0])[1])
+        else:
+            outputs.append(torch.tensor([config.decoder_start_token_id] + sum(runs[batch_idx], [])))
+    output_ids = torch.full((len(outputs), max(map(len, outputs))), config.pad_token_id, dtype=torch.long)
+    for i, ids in enumerate(outputs):
+        output_ids[i, :len(ids)] = ids
+    return output_ids.to(encoder_hidden_states.device)
+
+
+def _select(hypotheses, runs, banned_token_ids, num_beams, vocab_size, max_length, max_span_length):
+
+    '''
+    Next hypotheses of one input: the top 2 * num_beams (hypothesis, token) candidates are taken in order
+    until num_beams hypotheses continue. Hypotheses that close the last span do not take a beam,
+    like finished hypotheses in generate, and are kept only if they rank in the top num_beams.
+    '''
+
+    candidate_scores = []
+    for hypothesis in hypotheses:
+        closing_token_id = runs[hypothesis.run_idx][0]
+        remaining_length = sum(map(len, runs[hypothesis.run_idx:]))
+        scores = hypothesis.next_logprobs + hypothesis.score
+        if (hypothesis.span_length < max_span_length and
+                len(hypothesis.tokens) + 1 + remaining_length <= max_length):
+            closing_score = scores[closing_token_id].clone()
+            scores[banned_token_ids] = -float('inf')
+            scores[closing_token_id] = closing_score
+        else:
+            # No room left in the span, the next run is copied
+            closing_score = scores[closing_token_id].clone()
+            scores = torch.full_like(scores, -float('inf'))
+            scores[closing_token_id] = closing_score
+        candidate_scores.append(scores)
+
+    top_scores, top_indices = torch.cat(candidate_scores).topk(min(2 * num_beams, len(hypotheses) * vocab_size))
+    selected = []
+    num_continuing = 0
+    for rank, (score, index) in enumerate(zip(top_scores.tolist(), top_indices.tolist())):
+        if score == -float('inf') or num_continuing == num_beams:
+            break
+        hypothesis = hypotheses[index // vocab_size]
+        token_id = index % vocab_size
+        if token_id == runs[hypothesis.run_idx][0]:
+            run = runs[hypothesis.run_idx]
+            is_last_run = hypothesis.run_idx == len(runs) - 1
+            if is_last_run and rank >= num_beams:
+                continue
+            selected.append(TemplateHypothesis(hypothesis.batch_idx, hypothesis.tokens + run, score,
+                                               hypothesis.run_idx + 1, 0, run, hypothesis.cache_row))
+            num_continuing += not is_last_run
+        else:
+            selected.append(TemplateHypothesis(hypothesis.batch_idx, hypothesis.tokens + [token_id], score,
+                                               hypothesis.run_idx, hypothesis.span_length + 1, [token_id],
+                                               hypothesis.cache_row))
+            num_continuing += 1
+    return selected
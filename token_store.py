@@ -0,0 +1,121 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+from transformers import BatchEncoding
+
+
+class TokenStore:
+
+    '''
+    Token ids of a list of texts as one flat int32 array and int64 offsets.
+    Tokens of text i are ids[offsets[i]:offsets[i + 1]], special tokens included.
+    '''
+
+    def __init__(self, ids, offsets):
+
+        self.ids = ids
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, texts, tokenizer, batch_size=10000):
+
+        '''
+        :param texts: list of strings or PackedStrings
+        :param tokenizer: (fast) tokenizer used to encode the texts once
+        '''
+
+        ids, lengths = [], []
+        for start in range(0, len(texts), batch_size):
+            batch = [texts[i] for i in range(start, min(start + batch_size, len(texts)))]
+            for token_ids in tokenizer(batch, truncation=True)['input_ids']:
+                ids.append(np.asarray(token_ids, dtype=np.int32))
+                lengths.append(len(token_ids))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(np.concatenate(ids) if ids else np.zeros(0, dtype=np.int32), offsets)
+
+    @classmethod
+    def load(cls, path_prefix, mmap_mode='r'):
+
+        return cls(np.load(f'{path_prefix}_ids.npy', mmap_mode=mmap_mode),
+                   np.load(f'{path_prefix}_offsets.npy', mmap_mode=mmap_mode))
+
+    def save(self, path_prefix):
+
+        np.save(f'{path_prefix}_ids.npy', self.ids)
+        np.save(f'{path_prefix}_offsets.npy', self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.ids[self.offsets[index]:self.offsets[index + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+
+class TokenCache:
+
+    '''
+    On disk cache of TokenStores keyed by tokenizer name and revision.
+    Each store is additionally keyed by a hash of the texts, so a changed split or dataset is re-encoded.
+    hub_cache_dir and local_files_only are passed to from_pretrained when the tokenizer is loaded.
+    '''
+
+    def __init__(self, cache_dir, tokenizer_name, revision='main', hub_cache_dir=None, local_files_only=False):
+
+        self.cache_dir = os.path.join(cache_dir, f"{tokenizer_name.replace('/', '--')}@{revision}")
+        self.tokenizer_name = tokenizer_name
+        self.revision = revision
+        self.hub_cache_dir = hub_cache_dir
+        self.local_files_only = local_files_only
+        self._tokenizer = None
+
+    def tokenizer(self):
+
+        if self._tokenizer is None:
+            from transformers import AutoTokenizer
+            self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name,
+                                                            revision=self.revision,
+                                                            use_fast=True,
+                                                            cache_dir=self.hub_cache_dir,
+                                                            local_files_only=self.local_files_only)
+        return self._tokenizer
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['_tokenizer'] = None
+        return state
+
+    def tokens(self, texts, name):
+
+        '''
+        :param texts: PackedStrings to encode
+        :param name: readable name of the texts, e.g. flickr30k_captions
+        :return: TokenStore aligned with texts
+        '''
+
+        text_hash = hashlib.sha1(np.ascontiguousarray(texts.offsets).tobytes())
+        text_hash.update(np.ascontiguousarray(texts.data).tobytes())
+        path_prefix = os.path.join(self.cache_dir, f'{name}_{text_hash.hexdigest()[:16]}')
+        if not os.path.exists(f'{path_prefix}_offsets.npy'):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            TokenStore.build(texts, self.tokenizer()).save(path_prefix)
+        return TokenStore.load(path_prefix)
+
+
+def pad_token_ids(sequences, pad_token_id):
+
+    '''
+    Pad and stack token id arrays into the BatchEncoding the tokenizer would return with padding="longest"
+    '''
+
+    lengths = torch.tensor([len(x) for x in sequences])
+    attention_mask = (torch.arange(int(lengths.max())).unsqueeze(0) < lengths.unsqueeze(1)).long()
+    input_ids = torch.full(attention_mask.size(), pad_token_id, dtype=torch.long)
+    input_ids[attention_mask.bool()] = torch.from_numpy(np.concatenate(sequences).astype(np.int64))
+    return BatchEncoding({'input_ids': input_ids, 'attention_mask': attention_mask})
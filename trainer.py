@@ -1,5 +1,54 @@
-import copy
 import os
+import random
+import shutil
+
+import numpy as np
+import torch
+
+from distributed import is_main_process, broadcast_object, barrier, all_gather_object, get_rank, get_world_size
+
+TRAINING_STATE_FILE = 'training_state.pt'
+
+
+def link_checkpoint(src, dst):
+
+    '''
+    Hard-link the files of the checkpoint dir src into dst, copy them where hard links are not supported.
+    The linked files share their data with src, the weights are neither duplicated in memory nor rewritten.
+    '''
+
+    for root, _, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            try:
+                os.link(os.path.join(root, name), os.path.join(target, name))
+            except OSError:
+                shutil.copy2(os.path.join(root, name), os.path.join(target, name))
+
+
+def rng_state():
+
+    '''
+    States of the python, numpy and torch random generators (dropout, masking strategies) as python types,
+    so that they can be gathered from the ranks and read by torch.load with weights_only
+    '''
+
+    numpy_state = np.random.get_state()
+    return {'python': random.getstate(),
+            'numpy': (numpy_state[0], numpy_state[1].tolist(), *numpy_state[2:]),
+            'torch': torch.get_rng_state().tolist(),
+            'cuda': [state.tolist() for state in torch.cuda.get_rng_state_all()] if torch.cuda.is_available() else None}
+
+
+def set_rng_state(state):
+
+    random.setstate(state['python'])
+    np.random.set_state((state['numpy'][0], np.array(state['numpy'][1], dtype=np.uint32), *state['numpy'][2:]))
+    torch.set_rng_state(torch.tensor(state['torch'], dtype=torch.uint8))
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([torch.tensor(cuda_state, dtype=torch.uint8) for cuda_state in state['cuda']])
+
 
 class Trainer:
 
@@ -7,7 +56,16 @@ class Trainer:
                  model,
                  dataset,
                  epochs=20,
-                 patience=3):
+                 patience=3,
+                 resume=None,
+                 state_save_steps=None):
+
+        '''
+        :param resume: checkpoint version dir (or its training_state.pt) of an interrupted fit,
+        which continues at the batch where the training state was saved
+        :param state_save_steps: also save the training state every state_save_steps optimizer steps,
+        not only at the end of every epoch
+        '''
 
         self.model = model
         self.dataset = dataset
@@ -18,7 +76,17 @@ class Trainer:
         elif dataset.__class__.__name__ == 'FlickrDatasetModule':
             self.experiment_setting = 'flickr30k'
         self.checkpoint_path = 'checkpoints/'
-        self.version = self._get_run_version()
+        self.state_save_steps = state_save_steps
+        self.resume_state = None
+        if resume is not None:
+            if os.path.isdir(resume):
+                resume = os.path.join(resume, TRAINING_STATE_FILE)
+            self.resume_state = torch.load(resume, map_location='cpu')
+            # The resumed run keeps writing to its checkpoint directory
+            self.version = self.resume_state['version']
+        else:
+            # Every rank saves to the checkpoint directory of rank 0
+            self.version = broadcast_object(self._get_run_version() if is_main_process() else None)
         self.checkpoint_path = f'{self.checkpoint_path}{self.version}/'
         self.dataset.set_model_variables(self.model)
 
@@ -26,16 +94,40 @@ class Trainer:
 
         prev_loss = float('inf')
         patience = 0
-        best_model = None
         best_epoch = -1
+        start_epoch = 0
+        start_batch = 0
         self.dataset.setup('fit')
 
-        for epoch in range(self.epochs):
+        if self.resume_state is not None:
+            state = self.resume_state
+            self.model.load_training_state(state['model'])
+            prev_loss, patience, best_epoch = state['prev_loss'], state['patience'], state['best_epoch']
+            start_epoch, start_batch = state['epoch'], state['batch']
+            self.dataset.data_seed = state['data_seed']
+            rng_states = state['rng']
+            set_rng_state(rng_states[get_rank()] if len(rng_states) == get_world_size() else rng_states[0])
+            self.resume_state = None
+
+        for epoch in range(start_epoch, self.epochs):
 
             self.dataset.epoch = epoch
+            self.dataset.start_batch = start_batch if epoch == start_epoch else 0
+            train_dataloader = self.dataset.train_dataloader()
+            num_batches = self.dataset.start_batch + len(train_dataloader)
+            optimizer_steps = 0
+
+            def save_state(next_batch):
+                nonlocal optimizer_steps
+                optimizer_steps += 1
+                if self.state_save_steps and optimizer_steps % self.state_save_steps == 0 and next_batch < num_batches:
+                    self.save_training_state(epoch, next_batch, prev_loss, patience, best_epoch)
 
             train_loss = self.model.train(epoch,
-                                          self.dataset.train_dataloader(),f'{self.checkpoint_path}epoch_{epoch}')
+                                          train_dataloader,
+                                          f'{self.checkpoint_path}epoch_{epoch}',
+                                          start_batch=self.dataset.start_batch,
+                                          step_callback=save_state)
             val_loss = self.model.test(epoch,
                                        self.dataset.val_dataloader())
             self.model.lr_scheduler.step()
@@ -47,16 +139,62 @@ class Trainer:
                     patience += 1
             else:
                 patience = 0
-                best_model = copy.deepcopy(self.model)
-                best_epoch = epoch
+                prev_best_epoch, best_epoch = best_epoch, epoch
             prev_loss = val_loss
 
-            self.model.save_pretrained(f'{self.checkpoint_path}epoch_{epoch}/')
+            # val_loss is the same on every rank, only rank 0 saves models
+            if is_main_process():
+                self.model.save_pretrained(f'{self.checkpoint_path}epoch_{epoch}/')
+                if best_epoch == epoch:
+                    # The best model is the saved epoch checkpoint, linked instead of kept in memory.
+                    # Checkpoints written in the background are complete before they are linked.
+                    if getattr(self.model, 'checkpoint_writer', None) is not None:
+                        self.model.checkpoint_writer.flush()
+                    link_checkpoint(f'{self.checkpoint_path}epoch_{epoch}/',
+                                    f'{self.checkpoint_path}best_epoch_{epoch}/')
+                    shutil.rmtree(f'{self.checkpoint_path}best_epoch_{prev_best_epoch}/', ignore_errors=True)
+            self.save_training_state(epoch + 1, 0, prev_loss, patience, best_epoch)
+            barrier()
+
+        if getattr(self.model, 'checkpoint_writer', None) is not None:
+            self.model.checkpoint_writer.flush()
+        # Metrics are logged in the background, wait until they are written
+        self.model.metrics.wait()
+
+    def save_training_state(self, epoch, batch, prev_loss, patience, best_epoch):
+
+        '''
+        Save what fit needs to continue at batch of epoch: model, optimizer and lr scheduler states, the early stopping
+        variables, the data seed and the random generator states of every rank.
+        Written (by rank 0) to a temporary file that replaces checkpoint_path/training_state.pt, by the
+        checkpoint writer of the model when it has one, so asynchronous checkpoints also write it in the background.
+        '''
 
-        best_model.save_pretrained(f'{self.checkpoint_path}best_epoch_{best_epoch}/')
+        rng_states = all_gather_object(rng_state())
+        if not is_main_process():
+            return
+        state = {'version': self.version,
+                 'epoch': epoch,
+                 'batch': batch,
+                 'prev_loss': prev_loss,
+                 'patience': patience,
+                 'best_epoch': best_epoch,
+                 'data_seed': self.dataset.data_seed,
+                 'rng': rng_states,
+                 'model': self.model.training_state()}
+        os.makedirs(self.checkpoint_path, exist_ok=True)
+        path = os.path.join(self.checkpoint_path, TRAINING_STATE_FILE)
+        if getattr(self.model, 'checkpoint_writer', None) is not None:
+            self.model.checkpoint_writer.save_state(path, state)
+            return
+        torch.save(state, f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
 
     def inference(self):
 
+        # Predictions are written by rank 0 only
+        if not is_main_process():
+            return
         self.dataset.setup('predict')
         dataloader = self.dataset.predict_dataloader()
         self.model.predict(dataloader,
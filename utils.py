@@ -1,6 +1,9 @@
+import os
 import random
 import statistics
 
+from PIL import Image
+
 def random_mask_for_caption_prediction(captions):
 
     caption_index = random.randint(0, len(captions)-1)
@@ -48,6 +51,37 @@ def mask_sentence_for_prediction(captions, median=None):
             prompt.append(word)
     return ' '.join(prompt)
 
+def flickr_image_files():
+
+    """
+    Unique Flickr30K image filenames in order of the caption file
+    """
+
+    data = open('datasets/flickr30k/results_20130124.token', 'r').read().splitlines()
+    image_filenames = [x.split('#')[0] for x in data]
+    return list(dict.fromkeys(image_filenames))
+
+def vqa_image_files(image_dir):
+
+    return sorted(x for x in os.listdir(image_dir) if x.endswith('.jpg'))
+
+def load_image(image_filename, image_dir, transform=None, embedding_store=None, pixel_cache=None):
+
+    """
+    Image of a dataset sample, read from the embedding store, the pixel cache or image_dir in this order.
+    Precomputed ViT embeddings skip both the JPEG decoding and the ViT forward, so they are not transformed.
+    """
+
+    if embedding_store is not None:
+        return embedding_store[image_filename]
+    if pixel_cache is not None:
+        img = pixel_cache[image_filename]
+    else:
+        img = Image.open(image_dir + image_filename).convert('RGB')
+    if transform:
+        img = transform(img)
+    return img
+
 if __name__ == '__main__':
 
     captions = ['My name is Yogesh Patodia it is a longer statement',
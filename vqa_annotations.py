@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+from packed_strings import PackedStrings
+
+
+class VQAAnnotations:
+
+    '''
+    Columnar (image, question, answers) triples of a VQA split.
+
+    image_ids: int64 COCO image id of every question
+    questions: PackedStrings of the questions
+    answer_offsets: int64, answers of question i are answers[answer_offsets[i]:answer_offsets[i + 1]]
+    answers: PackedStrings of the answers
+
+    Questions are grouped by image in order of first appearance, as in the json files.
+    The answers of a question are the confident answers (or all answers if none is confident)
+    without duplicates; the first one is the answer used as training label.
+    '''
+
+    columns = ['image_ids', 'answer_offsets']
+    string_columns = ['questions', 'answers']
+
+    def __init__(self, image_ids, questions, answer_offsets, answers):
+
+        self.image_ids = image_ids
+        self.questions = questions
+        self.answer_offsets = answer_offsets
+        self.answers = answers
+
+    @classmethod
+    def from_json(cls, question_json, answer_json=None):
+
+        f = open(question_json)
+        questions = json.load(f)
+
+        question_answers = {}
+        if answer_json is not None:
+            f = open(answer_json)
+            answers = json.load(f)
+            for val in answers['annotations']:
+                confident_answers = [ans['answer'] for ans in val['answers'] if ans['answer_confidence'] == 'yes']
+                if not confident_answers:
+                    confident_answers = [ans['answer'] for ans in val['answers']]
+                question_answers[val['question_id']] = list(dict.fromkeys(confident_answers))
+
+        images = {}
+        for val in questions['questions']:
+            if val['image_id'] not in images:
+                images[val['image_id']] = []
+            images[val['image_id']].append(val)
+
+        image_ids, question_texts, answer_counts, answer_texts = [], [], [], []
+        for image_id in images:
+            for val in images[image_id]:
+                question_answer = question_answers.get(val['question_id'], [])
+                image_ids.append(image_id)
+                question_texts.append(val['question'])
+                answer_counts.append(len(question_answer))
+                answer_texts += question_answer
+
+        answer_offsets = np.zeros(len(answer_counts) + 1, dtype=np.int64)
+        np.cumsum(answer_counts, out=answer_offsets[1:])
+        return cls(np.array(image_ids, dtype=np.int64),
+                   PackedStrings.from_list(question_texts),
+                   answer_offsets,
+                   PackedStrings.from_list(answer_texts))
+
+    def save(self, cache_dir):
+
+        os.makedirs(cache_dir, exist_ok=True)
+        for column in self.columns:
+            np.save(os.path.join(cache_dir, f'{column}.npy'), getattr(self, column))
+        for column in self.string_columns:
+            getattr(self, column).save(os.path.join(cache_dir, column))
+
+    @classmethod
+    def load(cls, cache_dir, mmap_mode='r'):
+
+        columns = {column: np.load(os.path.join(cache_dir, f'{column}.npy'), mmap_mode=mmap_mode)
+                   for column in cls.columns}
+        for column in cls.string_columns:
+            columns[column] = PackedStrings.load(os.path.join(cache_dir, column), mmap_mode=mmap_mode)
+        return cls(**columns)
+
+    @classmethod
+    def load_or_convert(cls, question_json, answer_json, cache_root):
+
+        '''
+        Memory map the cached annotations of question_json, converting the json files on first use
+        '''
+
+        cache_dir = os.path.join(cache_root, os.path.splitext(os.path.basename(question_json))[0])
+        if not os.path.exists(os.path.join(cache_dir, 'answer_offsets.npy')):
+            cls.from_json(question_json, answer_json).save(cache_dir)
+        return cls.load(cache_dir)
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def image_filename(self, index, prefix):
+        image_id = str(self.image_ids[index])
+        return prefix + '0' * (12 - len(image_id)) + image_id + '.jpg'
+
+    def question(self, index):
+        return self.questions[index]
+
+    def answer_list(self, index):
+        return [self.answers[i] for i in range(self.answer_offsets[index], self.answer_offsets[index + 1])]
+
+    def answer_index(self, index):
+        '''
+        Index in answers of the training label of question index
+        '''
+        start, end = self.answer_offsets[index], self.answer_offsets[index + 1]
+        # An empty range would read the first answer of the next question
+        if start == end:
+            raise ValueError(f'Question {index} ({self.questions[index]!r}) has no annotated answer')
+        return start
+
+    def answer(self, index):
+        '''
+        Training label: first confident answer, or the first answer if none is confident
+        '''
+        return self.answers[self.answer_index(index)]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache_dir', type=str, default='./vqa_jsons/cache')
+
+    args = parser.parse_args()
+
+    splits = [('./vqa_jsons/v2_OpenEnded_mscoco_train2014_questions.json',
+               './vqa_jsons/v2_mscoco_train2014_annotations.json'),
+              ('./vqa_jsons/v2_OpenEnded_mscoco_val2014_questions.json',
+               './vqa_jsons/v2_mscoco_val2014_annotations.json')]
+    for question_json, answer_json in splits:
+        VQAAnnotations.load_or_convert(question_json, answer_json, args.cache_dir)
@@ -1,10 +1,10 @@
 from torch.utils.data import Dataset
-import torch
-from PIL import Image
+import numpy as np
 from torchvision.transforms import transforms
-import pytorch_lightning as pl
 
-import json
+from vqa_annotations import VQAAnnotations
+from data_module import DataModule
+from utils import load_image
 
 
 class VQATestDataset(Dataset):
@@ -12,53 +12,50 @@ class VQATestDataset(Dataset):
     def __init__(self,
                  questions_file,
                  transform=None,
+                 embedding_store=None,
+                 pixel_cache=None,
+                 annotation_cache_dir=None,
+                 token_cache=None,
                  ):
 
         self.image_dir = 'datasets/vqa_images/test/'
-        self.pairs = self.load_dataset(questions_file)
+        if annotation_cache_dir is not None:
+            self.annotations = VQAAnnotations.load_or_convert(questions_file, None, annotation_cache_dir)
+        else:
+            self.annotations = self.load_dataset(questions_file, None)
+        self.question_tokens = None
+        if token_cache is not None:
+            self.question_tokens = token_cache.tokens(self.annotations.questions, 'vqa_test_questions')
         self.transform = transform
+        self.embedding_store = embedding_store
+        self.pixel_cache = pixel_cache
 
-    def load_dataset(self, question_json):
-        f = open(question_json)
-        questions = json.load(f)
-
-        questions_dict = {}
-        images = {}
-        grand_dict = []
+    def load_dataset(self, question_json, answer_json=None):
 
-        for val in questions['questions']:
-            image_id = val['image_id']
-            question = val['question']
-            question_id = val['question_id']
+        return VQAAnnotations.from_json(question_json)
 
-            image_name = 'COCO_test2015_' + '0' * (12 - len(str(image_id))) + str(image_id) + '.jpg'
-            questions_dict[question_id] = {'Question': question}
-            if not image_name in images:
-                images[image_name] = []
-            images[image_name].append(question_id)
+    def __len__(self):
 
-        for v in images:
-            image_name = v
-            question_ids = images[v]
-            for q in question_ids:
-                obj = questions_dict[q]
-                q = obj['Question']
-                grand_dict.append([image_name, q, ' '])
+        return len(self.annotations)
 
-        return grand_dict
+    def sample_lengths(self):
 
-    def __len__(self):
+        '''
+        Question length of every sample, in tokens if pre-tokenized else in bytes
+        '''
 
-        return len(self.pairs)
+        if self.question_tokens is not None:
+            return self.question_tokens.lengths()
+        return self.annotations.questions.lengths()
 
     def __getitem__(self, index):
 
-        question = self.pairs[index][1]
-        answer = self.pairs[index][2]
-        image_filename = self.pairs[index][0]
-        img = Image.open(self.image_dir + image_filename)
-        if self.transform:
-            img = self.transform(img)
+        question = self.annotations.question(index)
+        answer = ' '
+        image_filename = self.annotations.image_filename(index, 'COCO_test2015_')
+        img = load_image(image_filename, self.image_dir, self.transform, self.embedding_store, self.pixel_cache)
+        if self.question_tokens is not None:
+            return img, question, answer, image_filename, self.question_tokens[index]
         return img, question, answer, image_filename
 
 
@@ -68,68 +65,50 @@ class VQAPredictionDataset(Dataset):
                  questions_file,
                  answers_file,
                  transform=None,
+                 embedding_store=None,
+                 pixel_cache=None,
+                 annotation_cache_dir=None,
+                 token_cache=None,
                  ):
 
         self.image_dir = 'datasets/vqa_images/val/'
-        self.pairs = self.load_dataset(questions_file, answers_file)
+        if annotation_cache_dir is not None:
+            self.annotations = VQAAnnotations.load_or_convert(questions_file, answers_file, annotation_cache_dir)
+        else:
+            self.annotations = self.load_dataset(questions_file, answers_file)
+        self.question_tokens = None
+        if token_cache is not None:
+            self.question_tokens = token_cache.tokens(self.annotations.questions, 'vqa_val_questions')
         self.transform = transform
+        self.embedding_store = embedding_store
+        self.pixel_cache = pixel_cache
 
     def load_dataset(self, question_json, answer_json):
-        f = open(answer_json)
-        answers = json.load(f)
-        f = open(question_json)
-        questions = json.load(f)
-
-        questions_dict = {}
-        images = {}
-        grand_dict = []
-
-        for val in questions['questions']:
-            image_id = val['image_id']
-            question = val['question']
-            question_id = val['question_id']
-
-            image_name = 'COCO_val2014_' + '0' * (12 - len(str(image_id))) + str(image_id) + '.jpg'
-            questions_dict[question_id] = {'Question': question, 'answers': set()}
-            if not image_name in images:
-                images[image_name] = []
-            images[image_name].append(question_id)
-
-        for val in answers['annotations']:
-            question_id = val['question_id']
-            flag = False
-            for ans in val['answers']:
-                if ans['answer_confidence'] == 'yes':
-                    questions_dict[question_id]['answers'].add(ans['answer'])
-                    flag = True
-
-            if not flag:
-                for ans in val['answers']:
-                    questions_dict[question_id]['answers'].add(ans['answer'])
-
-        for v in images:
-            image_name = v
-            question_ids = images[v]
-            for q in question_ids:
-                obj = questions_dict[q]
-                q = obj['Question']
-                a = obj['answers']
-                grand_dict.append([image_name, q, a])
-
-        return grand_dict
+
+        return VQAAnnotations.from_json(question_json, answer_json)
 
     def __len__(self):
 
-        return len(self.pairs)
+        return len(self.annotations)
+
+    def sample_lengths(self):
+
+        '''
+        Question length of every sample, in tokens if pre-tokenized else in bytes
+        '''
+
+        if self.question_tokens is not None:
+            return self.question_tokens.lengths()
+        return self.annotations.questions.lengths()
 
     def __getitem__(self, index):
 
-        question = self.pairs[index][1]
-        answer = self.pairs[index][2]
-        image_filename = self.pairs[index][0]
-        img = Image.open(self.image_dir + image_filename).convert('RGB')
-        if self.transform:
-            img = self.transform(img)
+        question = self.annotations.question(index)
+        answer = self.annotations.answer_list(index)
+        image_filename = self.annotations.image_filename(index, 'COCO_val2014_')
+        img = load_image(image_filename, self.image_dir, self.transform, self.embedding_store, self.pixel_cache)
+        if self.question_tokens is not None:
+            return img, question, answer, image_filename, self.question_tokens[index]
         return img, question, answer, image_filename
 
 
@@ -140,6 +119,10 @@ class VQADataset(Dataset):
                  answers_file,
                  split='train',
                  transform=None,
+                 embedding_store=None,
+                 pixel_cache=None,
+                 annotation_cache_dir=None,
+                 token_cache=None,
                  ):
 
         self.image_dir = 'datasets/vqa_images/' + split + '/'
@@ -151,76 +134,90 @@ class VQADataset(Dataset):
         else:
             self.prefix = 'COCO_test2014_'
 
-        self.pairs = self.load_dataset(questions_file, answers_file)
+        if annotation_cache_dir is not None:
+            self.annotations = VQAAnnotations.load_or_convert(questions_file, answers_file, annotation_cache_dir)
+        else:
+            self.annotations = self.load_dataset(questions_file, answers_file)
+        self.question_tokens, self.answer_tokens = None, None
+        if token_cache is not None:
+            self.question_tokens = token_cache.tokens(self.annotations.questions, f'vqa_{split}_questions')
+            self.answer_tokens = token_cache.tokens(self.annotations.answers, f'vqa_{split}_answers')
         self.transform = transform
+        self.embedding_store = embedding_store
+        self.pixel_cache = pixel_cache
 
     def load_dataset(self, question_json, answer_json):
-        f = open(answer_json)
-        answers = json.load(f)
-        f = open(question_json)
-        questions = json.load(f)
-
-        questions_dict = {}
-        images = {}
-        grand_dict = []
-
-        for val in questions['questions']:
-            image_id = val['image_id']
-            question = val['question']
-            question_id = val['question_id']
-
-            image_name = self.prefix + '0' * (12 - len(str(image_id))) + str(image_id) + '.jpg'
-
-            questions_dict[question_id] = {'Question': question}
-            if not image_name in images:
-                images[image_name] = []
-            images[image_name].append(question_id)
-
-        for val in answers['annotations']:
-            question_id = val['question_id']
-            for ans in val['answers']:
-                if ans['answer_confidence'] == 'yes':
-                    questions_dict[question_id]['answers'] = ans['answer']
-                    break
-                else:
-                    questions_dict[question_id]['answers'] = val['answers'][0]['answer']
-
-        for v in images:
-            image_name = v
-            question_ids = images[v]
-            for q in question_ids:
-                obj = questions_dict[q]
-                q = obj['Question']
-                a = obj['answers']
-                grand_dict.append([image_name, q, a])
-
-        return grand_dict
+
+        return VQAAnnotations.from_json(question_json, answer_json)
 
     def __len__(self):
 
-        return len(self.pairs)
+        return len(self.annotations)
+
+    def sample_lengths(self):
+
+        '''
+        (question, answer) lengths of every sample, in tokens if pre-tokenized else in bytes
+        '''
+
+        if self.question_tokens is not None:
+            question_lengths, answer_lengths = self.question_tokens.lengths(), self.answer_tokens.lengths()
+        else:
+            question_lengths, answer_lengths = self.annotations.questions.lengths(), self.annotations.answers.lengths()
+        # Unannotated questions have no training answer, __getitem__ raises for them
+        offsets = self.annotations.answer_offsets
+        label_lengths = np.zeros(len(offsets) - 1, dtype=answer_lengths.dtype)
+        annotated = offsets[1:] > offsets[:-1]
+        label_lengths[annotated] = answer_lengths[offsets[:-1][annotated]]
+        return np.stack((question_lengths, label_lengths), axis=1)
 
     def __getitem__(self, index):
 
-        question = self.pairs[index][1]
-        answer = self.pairs[index][2]
-        image_filename = self.pairs[index][0]
-        img = Image.open(self.image_dir + image_filename).convert('RGB')
-        if self.transform:
-            img = self.transform(img)
+        question = self.annotations.question(index)
+        answer = self.annotations.answer(index)
+        image_filename = self.annotations.image_filename(index, self.prefix)
+        img = load_image(image_filename, self.image_dir, self.transform, self.embedding_store, self.pixel_cache)
+        if self.question_tokens is not None:
+            # Tokens of the training answer, the first answer of the question
+            answer_tokens = self.answer_tokens[self.annotations.answer_index(index)]
+            return img, question, answer, image_filename, self.question_tokens[index], answer_tokens
         return img, question, answer, image_filename
 
 
-class VQADatasetModule(pl.LightningDataModule):
+class VQADatasetModule(DataModule):
 
     def __init__(self,
                  train_batch_size=16,
                  eval_batch_size=16,
                  transform=transforms.PILToTensor(),
                  num_workers=12,
+                 image_embeddings_dir=None,
+                 pixel_cache_dir=None,
+                 pixel_transform=None,
+                 annotation_cache_dir=None,
+                 token_cache_dir=None,
+                 tokenizer_revision='main',
+                 hub_cache_dir=None,
+                 local_files_only=False,
+                 bucket_by_length=False,
+                 bucket_size_multiplier=100,
+                 data_seed=42,
                  ):
 
-        super().__init__()
+        super().__init__(train_batch_size=train_batch_size,
+                         eval_batch_size=eval_batch_size,
+                         transform=transform,
+                         num_workers=num_workers,
+                         image_embeddings_dir=image_embeddings_dir,
+                         pixel_cache_dir=pixel_cache_dir,
+                         pixel_transform=pixel_transform,
+                         token_cache_dir=token_cache_dir,
+                         tokenizer_revision=tokenizer_revision,
+                         hub_cache_dir=hub_cache_dir,
+                         local_files_only=local_files_only,
+                         bucket_by_length=bucket_by_length,
+                         bucket_size_multiplier=bucket_size_multiplier,
+                         data_seed=data_seed)
 
         self.train_questions = './vqa_jsons/v2_OpenEnded_mscoco_train2014_questions.json'
         self.val_questions = './vqa_jsons/v2_OpenEnded_mscoco_val2014_questions.json'
@@ -229,41 +226,33 @@ class VQADatasetModule(pl.LightningDataModule):
         self.train_answers = './vqa_jsons/v2_mscoco_train2014_annotations.json'
         self.val_answers = './vqa_jsons/v2_mscoco_val2014_annotations.json'
 
-        self.train_batch_size = train_batch_size
-        self.eval_batch_size = eval_batch_size
-        self.transform = transform
-        self.num_workers = num_workers
+        self.annotation_cache_dir = annotation_cache_dir
 
     def setup(self, stage=None):
 
+        self._open_caches()
+
         if stage == 'fit' or stage is None:
-            self.train_dataset = VQADataset(self.train_questions, self.train_answers, 'train', self.transform)
-            self.val_dataset = VQADataset(self.val_questions, self.val_answers, 'val', self.transform)
+            self.train_dataset = VQADataset(self.train_questions, self.train_answers, 'train', **self._dataset_kwargs())
+            self.val_dataset = VQADataset(self.val_questions, self.val_answers, 'val', **self._dataset_kwargs())
 
         if stage == 'validate':
-            self.val_dataset = VQADataset(self.val_questions, self.val_answers, 'val', self.transform)
+            self.val_dataset = VQADataset(self.val_questions, self.val_answers, 'val', **self._dataset_kwargs())
 
         if stage == 'test':
-            self.test_dataset = VQADataset(self.val_questions, self.val_answers, 'val', self.transform)
+            self.test_dataset = VQADataset(self.val_questions, self.val_answers, 'val', **self._dataset_kwargs())
 
         if stage == 'predict':
             self.predict_file = 'val'
-            self.predict_dataset = VQAPredictionDataset(self.val_questions, self.val_answers, self.transform)
-
-    def _set_image_feature_extractor(self, image_feature_extractor):
-        self.image_feature_extractor = image_feature_extractor
+            self.predict_dataset = VQAPredictionDataset(self.val_questions, self.val_answers, **self._dataset_kwargs())
 
-    def _set_tokenizer(self, tokenizer):
-        self.tokenizer = tokenizer
+    def _dataset_kwargs(self):
 
-    def _set_tokens(self, model):
-        self.start_token = model.start_token
-        self.end_token = model.end_token
-
-    def set_model_variables(self, model):
+        '''
+        Dataset arguments of DataModule and the annotation cache
+        '''
 
-        self._set_image_feature_extractor(model.image_feature_extractor)
-        self._set_tokenizer(model.tokenizer)
+        return dict(super()._dataset_kwargs(), annotation_cache_dir=self.annotation_cache_dir)
 
     def tokenize_data(self, batch_data):
 
@@ -271,24 +260,18 @@ class VQADatasetModule(pl.LightningDataModule):
         questions = [t[1] for t in batch_data]
         answers = [t[2] for t in batch_data]
         filenames = [t[3] for t in batch_data]
+        question_tokens, answer_tokens = None, None
+        if self.token_cache is not None:
+            question_tokens = [t[4] for t in batch_data]
+            answer_tokens = [t[5] for t in batch_data]
 
         try:
-            image_encodings = self.image_feature_extractor(image_tensors, return_tensors='pt').pixel_values
+            image_encodings = self._encode_images(image_tensors)
         except Exception as e:
             print(e, filenames)
 
-        question_encodings = self.tokenizer(
-            questions,
-            padding="longest",
-            truncation=True,
-            return_tensors="pt",
-        )
-        answer_encodings = self.tokenizer(
-            answers,
-            padding="longest",
-            truncation=True,
-            return_tensors="pt",
-        )
+        question_encodings = self._encode_text(questions, question_tokens)
+        answer_encodings = self._encode_text(answers, answer_tokens)
         return image_encodings, question_encodings, answer_encodings
 
     def prediction_tokenization(self, batch_data):
@@ -304,49 +287,26 @@ class VQADatasetModule(pl.LightningDataModule):
         answers = [list(t[2]) for t in batch_data]
         image_filenames = [t[3] for t in batch_data]
 
-        image_encodings = self.image_feature_extractor(image_tensors, return_tensors='pt').pixel_values
+        image_encodings = self._encode_images(image_tensors)
 
-        question_encodings = self.tokenizer(
-            questions,
-            padding="longest",
-            truncation=True,
-            return_tensors="pt",
-        )
+        question_tokens = [t[4] for t in batch_data] if self.token_cache is not None else None
+        question_encodings = self._encode_text(questions, question_tokens)
 
         return image_encodings, question_encodings, answers, image_filenames
 
     def train_dataloader(self):
-        return torch.utils.data.DataLoader(
-            self.train_dataset,
-            batch_size=self.train_batch_size,
-            shuffle=True,
-            num_workers=self.num_workers,
-            collate_fn=self.tokenize_data
-        )
+        return self._dataloader(self.train_dataset, self.train_batch_size, True, self.tokenize_data,
+                                start_batch=self.start_batch)
 
     def val_dataloader(self):
-        return torch.utils.data.DataLoader(
-            self.val_dataset,
-            batch_size=self.eval_batch_size,
-            shuffle=False,
-            num_workers=self.num_workers,
-            collate_fn=self.tokenize_data
-        )
+        return self._dataloader(self.val_dataset, self.eval_batch_size, False, self.tokenize_data,
+                                pad_shards=False)
 
     def test_dataloader(self):
-        return torch.utils.data.DataLoader(
-            self.test_dataset,
-            batch_size=self.eval_batch_size,
-            shuffle=False,
-            num_workers=self.num_workers,
-            collate_fn=self.tokenize_data
-        )
+        return self._dataloader(self.test_dataset, self.eval_batch_size, False, self.tokenize_data,
+                                pad_shards=False)
 
     def predict_dataloader(self):
-        return torch.utils.data.DataLoader(
-            self.predict_dataset,
-            shuffle=False,
-            batch_size=self.eval_batch_size,
-            num_workers=self.num_workers,
-            collate_fn=self.prediction_tokenization,
-        )
+        # Predictions are written by rank 0 alone
+        return self._dataloader(self.predict_dataset, self.eval_batch_size, False, self.prediction_tokenization,
+                                shard=False)